@@ -1,18 +1,26 @@
 import os
+import re
 import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import itertools
+import unicodedata
+from collections import OrderedDict, deque, namedtuple
+from datetime import timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat
 from telegram.ext import ContextTypes
 # ✅ ДОДАНО: Необхідні імпорти для PTB 22.5 та логування
 from telegram.constants import ChatMemberStatus 
+from telegram.constants import MessageLimit
 from telegram.error import Forbidden, BadRequest
 import logging 
-from dotenv import load_dotenv
-import google.generativeai as genai
-from google.api_core.exceptions import GoogleAPICallError 
 
-load_dotenv()
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID') 
+import metrics
+import outbound
+from ratelimit import RateLimiter
+from config import GEMINI_API_KEY, TELEGRAM_CHAT_ID
 
 # =========================================================================
 # КОНСТАНТИ ДЛЯ GEMINI ТА ПЕРЕВІРКИ ПІДПИСКИ
@@ -25,9 +33,7 @@ FORUM_BUTTON_TEXT = "☇ ꜰ ☻‌ ʀ ᴜ ʍ❓"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-else:
+if not GEMINI_API_KEY:
     logger.error("Ошибка: GEMINI_API_KEY не найден в .env файле. Функциональность Gemini будет недоступна.")
     
 if not TELEGRAM_CHAT_ID:
@@ -36,8 +42,50 @@ if not TELEGRAM_CHAT_ID:
 # ✅ Очищене строкове представлення ID
 TELEGRAM_CHAT_ID_STR = str(TELEGRAM_CHAT_ID).strip() if TELEGRAM_CHAT_ID else None
 
-last_request_time = 0
-MIN_DELAY_SECONDS = 60
+# Квоти Gemini (безкоштовний тариф gemini-2.5-flash: 10 запитів/хв, 250 запитів/добу)
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', 10))
+GEMINI_BURST = float(os.getenv('GEMINI_BURST', 5))
+GEMINI_RPD = float(os.getenv('GEMINI_RPD', 250))
+GEMINI_CHAT_RPM = float(os.getenv('GEMINI_CHAT_RPM', 6))
+GEMINI_CHAT_BURST = float(os.getenv('GEMINI_CHAT_BURST', 3))
+GEMINI_USER_RPM = float(os.getenv('GEMINI_USER_RPM', 2))
+GEMINI_USER_BURST = float(os.getenv('GEMINI_USER_BURST', 2))
+AI_QUEUE_SIZE = int(os.getenv('AI_QUEUE_SIZE', 50))  # скільки запитів може чекати загалом
+AI_QUEUE_PER_USER = int(os.getenv('AI_QUEUE_PER_USER', 2))  # і від одного користувача
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 4))  # одночасних генерацій
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 60))  # таймаут одного запиту, сек
+# Пріоритети черги (менше — раніше) і дедлайни від постановки в чергу, сек:
+# запит, який уже не встигне до дедлайну, не витрачає квоту Gemini
+AI_PRIORITY_RETRY = int(os.getenv('AI_PRIORITY_RETRY', 0))  # повтор після тимчасової помилки Gemini
+AI_PRIORITY_PRIVATE = int(os.getenv('AI_PRIORITY_PRIVATE', 1))  # особисті повідомлення членів клубу
+AI_PRIORITY_GROUP = int(os.getenv('AI_PRIORITY_GROUP', 2))  # "ало" в групах
+AI_DEADLINE_PRIVATE = float(os.getenv('AI_DEADLINE_PRIVATE', 120))
+AI_DEADLINE_GROUP = float(os.getenv('AI_DEADLINE_GROUP', 45))
+AI_RETRIES = int(os.getenv('AI_RETRIES', 1))  # повторів після 429/5xx, поки відповідь не почала стрімитись
+AI_SHORT_MAX_TOKENS = int(os.getenv('AI_SHORT_MAX_TOKENS', 256))  # коротка відповідь для запізнілих, 0 — ні
+AI_EXPECTED_SECONDS = float(os.getenv('AI_EXPECTED_SECONDS', 8))  # початкова оцінка тривалості генерації
+# Як часто оновлювати повідомлення під час стрімінгу (Telegram обмежує редагування)
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', 1.5))
+AI_STREAM_EDIT_INTERVAL_GROUP = float(os.getenv('AI_STREAM_EDIT_INTERVAL_GROUP', 3.0))
+# Кеш відповідей на однакові короткі запитання ("що ти вмієш", привітання...)
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', 500))  # записів у пам'яті, 0 — вимкнено
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', 6 * 3600))  # сек
+AI_CACHE_MAX_PROMPT = int(os.getenv('AI_CACHE_MAX_PROMPT', 200))  # довші запити не кешуються
+AI_CACHE_PATH = os.getenv('AI_CACHE_PATH')  # файл SQLite для кешу на диску (необов'язково)
+AI_CACHE_DISK_SIZE = int(os.getenv('AI_CACHE_DISK_SIZE', 5000))
+# Пам'ять розмови в чаті
+AI_HISTORY_TURNS = int(os.getenv('AI_HISTORY_TURNS', 40))  # реплік у кільцевому буфері, 0 — без пам'яті
+AI_HISTORY_TOKENS = int(os.getenv('AI_HISTORY_TOKENS', 8000))  # бюджет токенів історії чату
+AI_HISTORY_CHAT_BYTES = int(os.getenv('AI_HISTORY_CHAT_BYTES', 64 * 1024))  # жорстка межа на чат
+AI_HISTORY_TOTAL_BYTES = int(os.getenv('AI_HISTORY_TOTAL_BYTES', 32 * 1024 * 1024))  # і на всі чати
+AI_HISTORY_IDLE = float(os.getenv('AI_HISTORY_IDLE', 1800))  # забувати розмову після тиші, сек
+# Явний кеш контексту Gemini для довгих історій (менше вхідних токенів і затримки)
+AI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv('AI_CONTEXT_CACHE_MIN_TOKENS', 2048))  # 0 — вимкнено
+AI_CONTEXT_CACHE_TTL = float(os.getenv('AI_CONTEXT_CACHE_TTL', 900))
+# Кеш членства в клубному чаті (оновлюється подіями chat_member)
+AI_MEMBERSHIP_TTL = float(os.getenv('AI_MEMBERSHIP_TTL', 6 * 3600))
+AI_NON_MEMBER_TTL = float(os.getenv('AI_NON_MEMBER_TTL', 600))
+AI_MEMBERSHIP_CACHE_SIZE = int(os.getenv('AI_MEMBERSHIP_CACHE_SIZE', 50000))
 
 SYSTEM_PROMPT = (
     "Ты — бот-помощник, который отвечает коротко, конструктивно и максимально по сути. "
@@ -45,31 +93,405 @@ SYSTEM_PROMPT = (
     "Используй украинский язык. не используй markdown розмітку"
 )
 
-async def _get_gemini_response(user_text):
+# =========================================================================
+# ПЛАНУВАЛЬНИК ЗАПИТІВ ДО GEMINI
+# =========================================================================
+# Класи запитів: пріоритет і дедлайн
+AI_KIND_PRIVATE = 'private'
+AI_KIND_GROUP = 'group'
+_AI_CLASSES = {
+    AI_KIND_PRIVATE: (AI_PRIORITY_PRIVATE, AI_DEADLINE_PRIVATE),
+    AI_KIND_GROUP: (AI_PRIORITY_GROUP, AI_DEADLINE_GROUP),
+}
+_TRANSIENT_CODES = (429, 500, 502, 503, 504)
+
+
+class AIDeadlineExceeded(Exception):
+    """Запит не встиг би до свого дедлайну, тож його скинуто, не витрачаючи квоту."""
+
+
+class _AIRequest:
+    __slots__ = ('chat_id', 'user_id', 'prompt', 'on_text', 'future', 'task', 'round', 'seq',
+                 'enqueued_at', 'ahead', 'eta', 'kind', 'priority', 'deadline', 'attempts', 'short', 'streamed')
+
+    def __init__(self, chat_id, user_id, prompt, on_text, future, round_, seq, kind=AI_KIND_PRIVATE):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.on_text = on_text
+        self.future = future
+        self.task = None
+        self.round = round_
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.ahead = 0
+        self.eta = 0.0
+        self.kind = kind
+        self.priority, deadline = _AI_CLASSES[kind]
+        self.deadline = self.enqueued_at + deadline
+        self.attempts = 0
+        self.short = False  # знижено до короткої відповіді, щоб устигнути
+        self.streamed = False  # користувач уже бачив частину відповіді
+
+    @property
+    def key(self):
+        return (self.priority, self.round, self.seq)
+
+    @property
+    def label(self):
+        return 'retry' if self.attempts else self.kind
+
+
+class GeminiScheduler:
     """
-    Получает ответ от Gemini (только текст).
+    Черга запитів до Gemini з обмежувачами (ratelimit.RateLimiter) на користувача,
+    на чат і загальними (за хвилину та за добу).
+
+    Запити не відхиляються, а чекають у обмеженій черзі в порядку пріоритету:
+    повтори, особисті повідомлення, групи (AI_PRIORITY_*). Усередині пріоритету
+    чати обслуговуються по колу: k-й запит чату потрапляє в k-й "раунд", тож
+    один активний чат не блокує інші.
+
+    Кожен запит має дедлайн (AI_DEADLINE_*). Перед відправкою тривалість
+    генерації оцінюється за останніми відповідями: якщо повна відповідь не
+    встигає — запит знижується до короткої (AI_SHORT_MAX_TOKENS), якщо не
+    встигає й коротка — скидається з AIDeadlineExceeded ще до витрати квоти.
+    Генерація, що впала з 429/5xx до початку стріму, повторюється з пріоритетом
+    AI_PRIORITY_RETRY у межах того ж дедлайну.
     """
-    global last_request_time
 
-    current_time = time.time()
-    if current_time - last_request_time < MIN_DELAY_SECONDS:
-        remaining_time = int(MIN_DELAY_SECONDS - (current_time - last_request_time))
-        return f"почекай трохи 🫩 {remaining_time} сек."
+    def __init__(self, call, max_queue=AI_QUEUE_SIZE, max_per_user=AI_QUEUE_PER_USER,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY):
+        self._call = call
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.max_concurrency = max_concurrency
+        self._global = [RateLimiter.per_minute(GEMINI_RPM, GEMINI_BURST, name='gemini_minute'),
+                        RateLimiter(GEMINI_RPD, 86400.0, name='gemini_day')]
+        self._chat_limiter = RateLimiter.per_minute(GEMINI_CHAT_RPM, GEMINI_CHAT_BURST, name='gemini_chat')
+        self._user_limiter = RateLimiter.per_minute(GEMINI_USER_RPM, GEMINI_USER_BURST, name='gemini_user')
+        self._pending = []
+        self._running = set()
+        self._chat_rounds = {}
+        self._round = 0
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        # Оцінка тривалості генерації (ковзне середнє): повної і короткої відповіді
+        self._expected = {False: AI_EXPECTED_SECONDS, True: AI_EXPECTED_SECONDS / 2}
+        self.dispatched = 0
+        self.downgraded = 0
+        self.shed = 0
+        self.retried = 0
 
-    if not GEMINI_API_KEY:
-        return "у мене немає api ключа 🔑"
+    def _local_wait(self, request, now):
+        return max(self._chat_limiter.retry_after(request.chat_id, now),
+                   self._user_limiter.retry_after(request.user_id, now))
+
+    def _global_wait(self, now):
+        return max(limiter.retry_after(None, now) for limiter in self._global)
+
+    def _latest_start(self, request):
+        """Найпізніший момент відправки, коли відповідь (хоча б коротка) ще встигає до дедлайну."""
+        return request.deadline - self._expected[AI_SHORT_MAX_TOKENS > 0]
+
+    def submit(self, chat_id, user_id, prompt, on_text=None, kind=AI_KIND_PRIVATE):
+        """
+        Ставить запит у чергу. on_text(text) отримує накопичений текст під час стрімінгу,
+        kind (AI_KIND_PRIVATE / AI_KIND_GROUP) задає пріоритет і дедлайн.
+
+        Returns:
+            _AIRequest: future з відповіддю, кількість запитів попереду (ahead)
+            та орієнтовне очікування в секундах (eta)
+
+        Raises:
+            asyncio.QueueFull: якщо черга (загальна або користувача) переповнена
+        """
+        self._pending = [r for r in self._pending if not r.future.done()]
+        if (len(self._pending) >= self.max_queue
+                or sum(1 for r in self._pending if r.user_id == user_id) >= self.max_per_user):
+            self.shed += 1
+            metrics.ai_shed.inc(kind, 'queue_full')
+            raise asyncio.QueueFull()
+
+        loop = asyncio.get_running_loop()
+        round_ = max(self._round, self._chat_rounds.get(chat_id, -1) + 1)
+        self._chat_rounds[chat_id] = round_
+        request = _AIRequest(chat_id, user_id, prompt, on_text, loop.create_future(), round_, next(self._seq), kind)
+
+        now = time.monotonic()
+        request.ahead = sum(1 for r in self._pending if r.key < request.key)
+        interval = 60.0 / GEMINI_RPM if GEMINI_RPM > 0 else 0.0
+        request.eta = max(self._local_wait(request, now), self._global_wait(now) + request.ahead * interval)
+        self._pending.append(request)
+        self._ensure_worker()
+        return request
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    def queue_depth(self):
+        return sum(1 for r in self._pending if not r.future.done())
+
+    def cancel(self, user_id=None, chat_id=None):
+        """
+        Скасовує запити користувача та/або чату — ті, що чекають у черзі, і ті,
+        що вже генеруються.
+
+        Returns:
+            int: кількість скасованих запитів
+        """
+        def matches(request):
+            return ((user_id is None or request.user_id == user_id)
+                    and (chat_id is None or request.chat_id == chat_id))
+
+        cancelled = 0
+        for request in [r for r in self._pending if matches(r)] + [r for r in self._running if matches(r)]:
+            if request.task is not None and not request.task.done():
+                request.task.cancel()
+            if not request.future.done():
+                request.future.cancel()
+                cancelled += 1
+        if cancelled and self._wakeup is not None:
+            self._wakeup.set()
+        return cancelled
+
+    def _prune(self):
+        active_chats = {r.chat_id for r in self._pending}
+        for chat_id in [c for c, r in self._chat_rounds.items() if r < self._round and c not in active_chats]:
+            del self._chat_rounds[chat_id]
+
+    def _shed_late(self, now):
+        """Скидає запити, які вже не встигнуть до дедлайну навіть з короткою відповіддю."""
+        late = [r for r in self._pending if now >= self._latest_start(r)]
+        for request in late:
+            self._pending.remove(request)
+            self.shed += 1
+            metrics.ai_shed.inc(request.label, 'deadline')
+            request.future.set_exception(AIDeadlineExceeded())
+        if late:
+            logger.warning(f"Скинуто запитів до Gemini після дедлайну: {len(late)}")
+
+    def _acquire(self, request, now):
+        """
+        Займає слоти всіх обмежувачів запиту або жодного. Між воркерами retry_after
+        і try_acquire — різні транзакції, тож слот може забрати інший воркер.
+        """
+        limiters = [(self._chat_limiter, request.chat_id), (self._user_limiter, request.user_id)]
+        limiters += [(limiter, None) for limiter in self._global]
+        taken = []
+        for limiter, key in limiters:
+            if not limiter.try_acquire(key, now):
+                for taken_limiter, taken_key in taken:
+                    taken_limiter.refund(taken_key, now)
+                return False
+            taken.append((limiter, key))
+        return True
+
+    def _dispatch(self, request, now):
+        """Відправляє запит, якщо всі обмежувачі дали слот; інакше він лишається в черзі."""
+        if not self._acquire(request, now):
+            return False
+        if now + self._expected[False] > request.deadline and AI_SHORT_MAX_TOKENS > 0:
+            request.short = True
+            self.downgraded += 1
+        self._pending.remove(request)
+        self._round = max(self._round, request.round)
+        self.dispatched += 1
+        metrics.ai_queue_wait.observe(now - request.enqueued_at, request.label)
+        self._running.add(request)
+        request.task = asyncio.create_task(self._execute(request))
+        self._prune()
+        return True
+
+    async def _run(self):
+        while True:
+            self._pending = [r for r in self._pending if not r.future.done()]
+            now = time.monotonic()
+            self._shed_late(now)
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Квота витрачається лише на запит, який одразу отримає слот генерації
+            if len(self._running) >= self.max_concurrency:
+                wait = None
+            else:
+                wait = self._global_wait(now)
+                if wait <= 0:
+                    ready = [r for r in self._pending if self._local_wait(r, now) <= 0]
+                    if ready:
+                        request = min(ready, key=lambda r: r.key)
+                        if self._dispatch(request, now):
+                            continue
+                        # Слот між перевіркою і захопленням зайняв інший воркер
+                        wait = max(self._global_wait(now), self._local_wait(request, now), 0.05)
+                    else:
+                        wait = min(self._local_wait(r, now) for r in self._pending)
+
+            # Прокинутись вчасно, щоб скинути запит, який перестане встигати
+            shed_in = min(self._latest_start(r) for r in self._pending) - now + 0.01
+            wait = shed_in if wait is None else min(wait, shed_in)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _should_retry(self, request, error):
+        if request.attempts >= AI_RETRIES or request.streamed or request.future.done():
+            return False
+        # Сюди потрапляємо лише після виклику Gemini, тож SDK вже імпортовано
+        from google.api_core.exceptions import GoogleAPICallError
+        return isinstance(error, GoogleAPICallError) and error.code in _TRANSIENT_CODES
+
+    def _retry(self, request, error):
+        logger.warning(f"Тимчасова помилка Gemini ({error}), повтор запиту")
+        request.attempts += 1
+        request.priority = AI_PRIORITY_RETRY
+        request.enqueued_at = time.monotonic()
+        request.task = None
+        self.retried += 1
+        self._pending.append(request)
+        self._ensure_worker()
+
+    async def _execute(self, request):
+        on_text = None
+        if request.on_text is not None:
+            def on_text(text):
+                request.streamed = True
+                request.on_text(text)
+
+        started = time.monotonic()
+        try:
+            result = await self._call(request.prompt, on_text, short=request.short)
+        except asyncio.CancelledError:
+            request.future.cancel()
+            return
+        except Exception as e:
+            if self._should_retry(request, e):
+                self._retry(request, e)
+            elif not request.future.done():
+                request.future.set_exception(e)
+            return
+        finally:
+            self._running.discard(request)
+            self._wakeup.set()
+        expected = self._expected[request.short]
+        self._expected[request.short] = expected + 0.2 * (time.monotonic() - started - expected)
+        if not request.future.done():
+            request.future.set_result(result)
+
+    def stats(self):
+        return {
+            'queued': self.queue_depth(),
+            'running': len(self._running),
+            'dispatched': self.dispatched,
+            'downgraded': self.downgraded,
+            'shed': self.shed,
+            'retried': self.retried,
+            'expected_seconds': self._expected[False],
+            'expected_short_seconds': self._expected[True],
+        }
+
+
+# =========================================================================
+# ВИКЛИК GEMINI
+# =========================================================================
+_genai_module = None
+_model = None
+_generation_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+
+def _genai():
+    """
+    google.generativeai імпортується (~1 с) і налаштовується лише при першому
+    використанні, а не при старті бота.
+    """
+    global _genai_module
+    if _genai_module is None:
+        import google.generativeai as genai
+        if GEMINI_API_KEY:
+            genai.configure(api_key=GEMINI_API_KEY)
+        _genai_module = genai
+    return _genai_module
+
+
+def preload_gemini():
+    """Імпортує Gemini SDK у фоновому потоці, щоб перший запит до ШІ не чекав на імпорт."""
+    if GEMINI_API_KEY and _genai_module is None:
+        asyncio.get_running_loop().run_in_executor(None, _genai)
+
+
+def _get_model():
+    """Модель створюється один раз і перевикористовується всіма запитами."""
+    global _model
+    if _model is None:
+        _model = _genai().GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_PROMPT)
+    return _model
+
+
+async def _call_gemini(user_text, on_text=None, short=False):
+    """
+    Виконує один запит до Gemini (без черги) через асинхронний API.
+
+    Якщо передано on_text, відповідь стрімиться і on_text(text) викликається
+    з накопиченим текстом після кожного фрагмента; short обмежує відповідь
+    AI_SHORT_MAX_TOKENS токенами.
+    Не більше GEMINI_MAX_CONCURRENCY генерацій одночасно, кожна обмежена GEMINI_TIMEOUT.
+    Помилки API не перехоплюються — їх перетворює на текст _describe_gemini_error.
+    """
+    async with _generation_slots:
+        with metrics.upstream('gemini', 'generate' if on_text is None else 'stream'):
+            return await asyncio.wait_for(_generate(user_text, on_text, short), timeout=GEMINI_TIMEOUT)
+
+
+# Що відправити в Gemini: contents (рядок або список реплік) і модель
+# (None — спільна модель, інакше модель поверх кешу контексту чату)
+GeminiPrompt = namedtuple('GeminiPrompt', 'contents model')
 
-    try:
-        model = genai.GenerativeModel(MODEL_NAME, system_instruction=SYSTEM_PROMPT) 
-        
-        response = model.generate_content(
-            user_text
-        )
 
-        last_request_time = current_time
+async def _generate(prompt, on_text, short=False):
+    if isinstance(prompt, GeminiPrompt):
+        model, contents = prompt.model or _get_model(), prompt.contents
+    else:
+        model, contents = _get_model(), prompt
+    options = {"request_options": {"timeout": GEMINI_TIMEOUT}}
+    if short:
+        options["generation_config"] = {"max_output_tokens": AI_SHORT_MAX_TOKENS}
+    if on_text is None:
+        response = await model.generate_content_async(contents, **options)
         return response.text
 
-    except GoogleAPICallError as e:
+    response = await model.generate_content_async(contents, stream=True, **options)
+    text = ""
+    async for chunk in response:
+        try:
+            piece = chunk.text
+        except ValueError:
+            # Фрагмент без тексту (наприклад, лише finish_reason)
+            continue
+        if piece:
+            text += piece
+            on_text(text)
+    if not text:
+        raise ValueError("Gemini повернув порожню відповідь")
+    return text
+
+
+def _describe_gemini_error(e):
+    """Перетворює виняток виклику Gemini на відповідь користувачу."""
+    if isinstance(e, asyncio.TimeoutError):
+        logger.error(f"Gemini не відповів за {GEMINI_TIMEOUT} сек.")
+        return "довго думаю ⌛, спробуй ще раз"
+
+    # Сюди потрапляємо лише після виклику Gemini, тож SDK вже імпортовано
+    from google.api_core.exceptions import GoogleAPICallError
+    if isinstance(e, GoogleAPICallError):
         error_message = str(e)
         logger.error(f"Ошибка при работе с Gemini API: {error_message}")
         if "401" in error_message or "Invalid API Key" in error_message:
@@ -81,15 +503,685 @@ async def _get_gemini_response(user_text):
         else:
             return f"не можу відповісти 🤯: {error_message[:30]}..." 
 
+    logger.error(f"Неизвестная ошибка: {e}")
+    # ПРИМІТКА: Ця помилка ("щось зламалось 💔") виникає, коли виклик API провалюється
+    return "щось зламалось 💔"
+
+
+scheduler = GeminiScheduler(_call_gemini)
+
+
+# =========================================================================
+# КЕШ ВІДПОВІДЕЙ
+# =========================================================================
+_SPACES = re.compile(r'\s+')
+
+
+def _normalize_prompt(text):
+    """
+    Приводить запит до канонічного вигляду: регістр, пробіли та кінцеві ?!. не важливі.
+    Інші символи лишаються в ключі — "2+2" і "2*2", "c++" і "c#" — різні питання.
+    """
+    text = _SPACES.sub(' ', unicodedata.normalize('NFKC', text).casefold()).strip()
+    return text.rstrip('?!.').rstrip()
+
+
+class ResponseCache:
+    """
+    LRU-кеш відповідей Gemini з TTL. Ключ — хеш нормалізованого запиту разом
+    з моделлю та системним промптом, тож зміна будь-якого з них інвалідує кеш.
+    Якщо запит іде з історією чату, до ключа додається її дайджест
+    (ConversationMemory.digest): відповідь на уточнення залежить від розмови.
+
+    Якщо задано path, записи додатково зберігаються в SQLite і переживають
+    перезапуск бота; звернення до диска виконуються в окремому потоці.
+    """
+
+    def __init__(self, max_size=AI_CACHE_SIZE, ttl=AI_CACHE_TTL, path=AI_CACHE_PATH,
+                 disk_size=AI_CACHE_DISK_SIZE, max_prompt=AI_CACHE_MAX_PROMPT):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.disk_size = disk_size
+        self.max_prompt = max_prompt
+        self._entries = OrderedDict()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def key(self, prompt, context=None):
+        """Ключ кешу або None, якщо запит не варто кешувати."""
+        normalized = _normalize_prompt(prompt)
+        if not normalized or len(normalized) > self.max_prompt:
+            return None
+        if context:
+            normalized = f"{context}\0{normalized}"
+        return hashlib.sha256(f"{MODEL_NAME}\0{SYSTEM_PROMPT}\0{normalized}".encode()).digest()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS ai_cache ("
+                "key BLOB PRIMARY KEY, expires_at REAL NOT NULL, text TEXT NOT NULL) WITHOUT ROWID"
+            )
+        return self._db
+
+    def _disk_get(self, key):
+        with self._db_lock:
+            row = self._connect().execute(
+                "SELECT expires_at, text FROM ai_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row
+
+    def _disk_put(self, key, expires_at, text):
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.execute("INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?)", (key, expires_at, text))
+                db.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (time.time(),))
+                db.execute(
+                    "DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache "
+                    "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.disk_size,)
+                )
+
+    def _remember(self, key, expires_at, text):
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, prompt, context=None):
+        key = self.key(prompt, context) if self.enabled else None
+        if key is None:
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self.path:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key)
+            except sqlite3.Error as e:
+                logger.error(f"Помилка читання кешу ШІ: {e}")
+                row = None
+            if row:
+                self._remember(key, *row)
+                self.disk_hits += 1
+                return row[1]
+
+        self.misses += 1
+        return None
+
+    async def put(self, prompt, text, context=None):
+        key = self.key(prompt, context) if self.enabled else None
+        if key is None:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, text)
+        if self.path:
+            try:
+                await asyncio.to_thread(self._disk_put, key, expires_at, text)
+            except sqlite3.Error as e:
+                logger.error(f"Помилка запису кешу ШІ: {e}")
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+        }
+
+
+response_cache = ResponseCache()
+
+
+# =========================================================================
+# ПАМ'ЯТЬ РОЗМОВИ
+# =========================================================================
+def _estimate_tokens(text):
+    # Груба оцінка: ~3 символи на токен для суміші кирилиці та латиниці
+    return len(text) // 3 + 1
+
+
+class ChatMemory:
+    """
+    Історія одного чату: кільцевий буфер реплік (роль, текст у UTF-8).
+    UTF-8 вдвічі-вчетверо компактніший за str, коли у відповіді є емодзі.
+    """
+    __slots__ = ('turns', 'tokens', 'nbytes', 'last_used', 'cache', 'cache_model', 'cached_turns',
+                 'cache_expires_at', 'cache_pending')
+
+    def __init__(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self.cache = None
+        self.cache_model = None
+        self.cached_turns = 0
+        self.cache_expires_at = 0.0
+        self.cache_pending = False
+
+    def contents(self, start=0):
+        return [
+            {'role': 'model' if is_model else 'user', 'parts': [data.decode('utf-8')]}
+            for is_model, data, _ in itertools.islice(self.turns, start, None)
+        ]
+
+
+class ConversationMemory:
+    """
+    Пам'ять розмов з жорсткими межами: бюджет токенів і байтів на чат,
+    загальна межа байтів (найдавніше активні чати витісняються першими).
+
+    Коли історія чату перевищує AI_CONTEXT_CACHE_MIN_TOKENS, системний промпт
+    і вже відомі репліки кладуться в кеш контексту Gemini, а в запиті
+    надсилаються лише нові репліки. Короткий префікс (лише SYSTEM_PROMPT)
+    Gemini 2.5 кешує сам (implicit caching), явний кеш для нього не потрібен.
+    """
+
+    def __init__(self, max_turns=AI_HISTORY_TURNS, max_tokens=AI_HISTORY_TOKENS,
+                 chat_bytes=AI_HISTORY_CHAT_BYTES, total_bytes=AI_HISTORY_TOTAL_BYTES,
+                 idle=AI_HISTORY_IDLE, cache_min_tokens=AI_CONTEXT_CACHE_MIN_TOKENS):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.chat_bytes = chat_bytes
+        self.total_bytes = total_bytes
+        self.idle = idle
+        self.cache_min_tokens = cache_min_tokens
+        self._chats = OrderedDict()
+        self.nbytes = 0
+        self.evicted_chats = 0
+        self.context_caches_created = 0
+
+    @property
+    def enabled(self):
+        return self.max_turns > 0 and self.max_tokens > 0
+
+    def _get(self, chat_id):
+        memory = self._chats.get(chat_id)
+        if memory is not None and time.monotonic() - memory.last_used > self.idle:
+            self._drop(chat_id)
+            memory = None
+        return memory
+
+    def _drop(self, chat_id):
+        memory = self._chats.pop(chat_id, None)
+        if memory is not None:
+            self.nbytes -= memory.nbytes
+            self._drop_cache(memory)
+
+    def _drop_cache(self, memory):
+        if memory.cache is not None:
+            _spawn_cache_delete(memory.cache)
+        memory.cache = memory.cache_model = None
+        memory.cached_turns = 0
+
+    def digest(self, chat_id):
+        """Дайджест історії, яку отримає наступний запит чату (None — історії немає)."""
+        memory = self._get(chat_id) if self.enabled else None
+        if memory is None or not memory.turns:
+            return None
+        digest = hashlib.blake2b(digest_size=16)
+        for is_model, data, _ in memory.turns:
+            digest.update(b'm' if is_model else b'u')
+            digest.update(len(data).to_bytes(4, 'big'))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def prompt(self, chat_id, user_text):
+        """Будує GeminiPrompt: історія чату (або її некешований хвіст) + нове повідомлення."""
+        memory = self._get(chat_id) if self.enabled else None
+        if memory is None or not memory.turns:
+            return GeminiPrompt(user_text, None)
+
+        new_turn = {'role': 'user', 'parts': [user_text]}
+        if memory.cache is not None and memory.cache_expires_at > time.monotonic():
+            return GeminiPrompt(memory.contents(memory.cached_turns) + [new_turn], memory.cache_model)
+        return GeminiPrompt(memory.contents() + [new_turn], None)
+
+    def append(self, chat_id, user_text, model_text):
+        """Додає пару реплік і обрізає історію до бюджетів."""
+        if not self.enabled:
+            return
+        memory = self._get(chat_id)
+        if memory is None:
+            memory = self._chats[chat_id] = ChatMemory()
+        self._chats.move_to_end(chat_id)
+        memory.last_used = time.monotonic()
+
+        for is_model, text in ((False, user_text), (True, model_text)):
+            data = text.encode('utf-8')
+            tokens = _estimate_tokens(text)
+            memory.turns.append((is_model, data, tokens))
+            memory.tokens += tokens
+            memory.nbytes += len(data)
+            self.nbytes += len(data)
+
+        if (len(memory.turns) > self.max_turns or memory.tokens > self.max_tokens
+                or memory.nbytes > self.chat_bytes):
+            # Обрізаємо із запасом (до половини бюджету), щоб кеш контексту
+            # не інвалідувався на кожній новій репліці
+            while memory.turns and (len(memory.turns) > self.max_turns // 2
+                                    or memory.tokens > self.max_tokens // 2
+                                    or memory.nbytes > self.chat_bytes // 2):
+                self._pop_oldest(memory)
+            while memory.turns and memory.turns[0][0]:
+                self._pop_oldest(memory)
+            self._drop_cache(memory)
+
+        while self.nbytes > self.total_bytes and self._chats:
+            oldest = next(iter(self._chats))
+            self._drop(oldest)
+            self.evicted_chats += 1
+
+        if self.cache_min_tokens and chat_id in self._chats:
+            self._maybe_refresh_cache(chat_id, memory)
+
+    def _pop_oldest(self, memory):
+        _, data, tokens = memory.turns.popleft()
+        memory.tokens -= tokens
+        memory.nbytes -= len(data)
+        self.nbytes -= len(data)
+
+    def _maybe_refresh_cache(self, chat_id, memory):
+        if memory.cache_pending or memory.tokens < self.cache_min_tokens:
+            return
+        cache_alive = memory.cache is not None and memory.cache_expires_at > time.monotonic()
+        uncached = sum(t for _, _, t in itertools.islice(memory.turns, memory.cached_turns, None))
+        if cache_alive and uncached < self.cache_min_tokens:
+            return
+        memory.cache_pending = True
+        asyncio.create_task(self._refresh_cache(chat_id, memory))
+
+    async def _refresh_cache(self, chat_id, memory):
+        turns = len(memory.turns)
+        contents = memory.contents()
+        try:
+            caching = _genai().caching
+            with metrics.upstream('gemini', 'cache_create'):
+                cache = await asyncio.to_thread(
+                    caching.CachedContent.create,
+                    model=f"models/{MODEL_NAME}",
+                    system_instruction=SYSTEM_PROMPT,
+                    contents=contents,
+                    ttl=timedelta(seconds=AI_CONTEXT_CACHE_TTL)
+                )
+        except Exception as e:
+            logger.warning(f"Не вдалося створити кеш контексту Gemini: {e}")
+            return
+        finally:
+            memory.cache_pending = False
+
+        # Поки кеш створювався, чат могли витіснити (тоді кеш нікому не належить)
+        # або історію обрізати — тоді він уже не префікс
+        if (self._chats.get(chat_id) is not memory
+                or len(memory.turns) < turns or memory.contents()[:turns] != contents):
+            _spawn_cache_delete(cache)
+            return
+        self._drop_cache(memory)
+        memory.cache = cache
+        memory.cache_model = _genai().GenerativeModel.from_cached_content(cached_content=cache)
+        memory.cached_turns = turns
+        # Запас 30 сек., щоб не звертатися до кешу, який ось-ось зникне
+        memory.cache_expires_at = time.monotonic() + AI_CONTEXT_CACHE_TTL - 30
+        self.context_caches_created += 1
+
+    def forget(self, chat_id):
+        self._drop(chat_id)
+
+    def stats(self):
+        return {
+            'chats': len(self._chats),
+            'bytes': self.nbytes,
+            'max_chat_bytes': max((m.nbytes for m in self._chats.values()), default=0),
+            'tokens': sum(m.tokens for m in self._chats.values()),
+            'turns': sum(len(m.turns) for m in self._chats.values()),
+            'evicted_chats': self.evicted_chats,
+            'context_caches': sum(1 for m in self._chats.values() if m.cache is not None),
+            'context_caches_created': self.context_caches_created,
+        }
+
+
+def _spawn_cache_delete(cache):
+    async def delete():
+        try:
+            await asyncio.to_thread(cache.delete)
+        except Exception as e:
+            logger.warning(f"Не вдалося видалити кеш контексту Gemini: {e}")
+    try:
+        asyncio.get_running_loop().create_task(delete())
+    except RuntimeError:
+        pass
+
+
+conversation_memory = ConversationMemory()
+
+
+async def _get_gemini_response(user_text, chat_id=0, user_id=0, on_queued=None, on_text=None,
+                               use_cache=True, author=None, kind=AI_KIND_PRIVATE):
+    """
+    Получает ответ от Gemini (только текст) через общую очередь запросов.
+
+    kind задает приоритет и срок ожидания в очереди (_AI_CLASSES).
+
+    on_queued(position, eta) вызывается, если запросу придется подождать;
+    on_text(text) — при стриминге, с уже полученным текстом.
+    Запрос отправляется вместе с историей чата из conversation_memory (author — имя автора
+    реплики в группах). Одинаковые (после нормализации) короткие вопросы отвечаются
+    из response_cache, если use_cache не выключен для чата; при наличии истории
+    ключ включает ее дайджест, так что ответ на уточнение берется только из того же разговора.
+    Возвращает None, если запрос отменили (/cancel или пользователь вышел из чата)
+    или если упоминание в группе не дождалось своей очереди.
+    """
+    if not GEMINI_API_KEY:
+        return "у мене немає api ключа 🔑"
+
+    turn_text = f"{author}: {user_text}" if author else user_text
+    context = conversation_memory.digest(chat_id) if use_cache else None
+    if use_cache:
+        cached = await response_cache.get(user_text, context)
+        if cached is not None:
+            conversation_memory.append(chat_id, turn_text, cached)
+            return cached
+
+    try:
+        request = scheduler.submit(
+            chat_id, user_id, conversation_memory.prompt(chat_id, turn_text), on_text, kind=kind
+        )
+    except asyncio.QueueFull:
+        return "забагато запитів 🥵, спробуй трохи пізніше"
+
+    if on_queued and (request.ahead or request.eta >= 1):
+        await on_queued(request.ahead + 1, request.eta)
+
+    try:
+        text = await request.future
+    except asyncio.CancelledError:
+        # Отменили сам обработчик — пробрасываем, отменили только запрос — молча выходим
+        if asyncio.current_task().cancelling():
+            raise
+        return None
+    except AIDeadlineExceeded:
+        # Запоздавший ответ в группе уже никому не нужен — молчим
+        if kind == AI_KIND_GROUP:
+            return None
+        return "не встиг відповісти вчасно ⌛, спробуй ще раз"
     except Exception as e:
-        logger.error(f"Неизвестная ошибка: {e}")
-        # ПРИМІТКА: Ця помилка ("щось зламалось 💔") виникає, коли виклик API провалюється
-        return "щось зламалось 💔"
+        return _describe_gemini_error(e)
+
+    conversation_memory.append(chat_id, turn_text, text)
+    if use_cache:
+        await response_cache.put(user_text, text, context)
+    return text
+
+
+# =========================================================================
+# СТРІМІНГ ВІДПОВІДІ В TELEGRAM
+# =========================================================================
+def _utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _split_text(text, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """
+    Ділить текст на частини не довші за limit (Telegram рахує в UTF-16),
+    по можливості по переносу рядка або пробілу. Межі залежать лише від
+    початку тексту, тож при дописуванні вже відправлені частини не змінюються.
+    """
+    chunks = []
+    while _utf16_len(text) > limit:
+        cut = limit
+        while _utf16_len(text[:cut]) > limit:
+            cut -= 1
+        soft = max(text.rfind('\n', 0, cut), text.rfind(' ', 0, cut))
+        if soft > cut // 2:
+            cut = soft + 1
+        chunks.append(text[:cut])
+        text = text[cut:]
+    chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """
+    Відповідь, що з'являється по мірі генерації: перше повідомлення
+    надсилається одразу, далі текст дописується через edit_message_text
+    не частіше ніж раз на edit_interval секунд. Текст понад 4096 символів
+    переноситься в наступні повідомлення.
+    """
+
+    def __init__(self, message, edit_interval=AI_STREAM_EDIT_INTERVAL):
+        self._source = message
+        self.edit_interval = edit_interval
+        self._messages = []
+        self._shown = []
+        self._text = ""
+        self._last_edit = 0.0
+        self._flush_task = None
+        self._has_answer = False
+        # Повідомлення про чергу і стрім можуть показуватись одночасно — по одному
+        self._show_lock = asyncio.Lock()
+
+    async def show_queue_position(self, position, eta):
+        """Показує місце в черзі; це повідомлення потім замінить відповідь."""
+        await self._show([f"ти {position}-й у черзі ⏳ ~{max(1, round(eta))} сек."])
+
+    def push(self, text):
+        """Новий накопичений текст; редагування групуються у фоні."""
+        self._text = text
+        self._has_answer = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def finish(self, text):
+        """Показує остаточний текст повністю."""
+        self._text = text
+        self._has_answer = True
+        if self._flush_task is not None:
+            await self._flush_task
+        if _split_text(self._text) != self._shown:
+            await self._sync(throttle=bool(self._messages))
+
+    async def cancel(self):
+        """Зупиняє оновлення; повідомлення про чергу прибирається, якщо відповіді ще не було."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if not self._has_answer:
+            for message in self._messages:
+                try:
+                    await message.delete()
+                except (BadRequest, Forbidden):
+                    pass
+
+    async def _flush_loop(self):
+        while _split_text(self._text) != self._shown:
+            await self._sync(throttle=bool(self._messages))
+
+    async def _sync(self, throttle):
+        if throttle:
+            delay = self._last_edit + self.edit_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await self._show(_split_text(self._text))
+        self._last_edit = time.monotonic()
+
+    async def _show(self, chunks):
+        async with self._show_lock:
+            for i, chunk in enumerate(chunks):
+                if i < len(self._messages):
+                    if self._shown[i] == chunk:
+                        continue
+                    await self._call(outbound.edit_text, self._messages[i], chunk)
+                    self._shown[i] = chunk
+                else:
+                    message = await self._call(outbound.reply_text, self._source, chunk)
+                    self._messages.append(message)
+                    self._shown.append(chunk)
+
+    async def _call(self, send, message, text):
+        # RetryAfter обробляє outbound: чат відкладається, повідомлення надсилається повторно
+        try:
+            return await send(message, text)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return None
+            raise
+
+
+async def _answer_with_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE, edit_interval):
+    """Ставить текст повідомлення в чергу до Gemini і стрімить відповідь у чат."""
+    reply = StreamingReply(update.message, edit_interval=edit_interval)
+    private = update.effective_chat.type == Chat.PRIVATE
+    try:
+        text = await _get_gemini_response(
+            update.message.text,
+            chat_id=update.effective_chat.id,
+            user_id=update.effective_user.id,
+            on_queued=reply.show_queue_position,
+            on_text=reply.push,
+            use_cache=context.chat_data.get('ai_cache', True),
+            author=None if private else update.effective_user.first_name,
+            kind=AI_KIND_PRIVATE if private else AI_KIND_GROUP
+        )
+    except BaseException:
+        await reply.cancel()
+        raise
+
+    if text:
+        await reply.finish(text)
+    else:
+        await reply.cancel()
+
+
+# =========================================================================
+# КЕШ ЧЛЕНСТВА В КЛУБІ
+# =========================================================================
+def _is_member_status(chat_member):
+    # Логіка, яка виключає лише LEFT та BANNED (використовує ChatMemberStatus)
+    return chat_member.status not in [
+        ChatMemberStatus.LEFT, 
+        ChatMemberStatus.BANNED # ✅ ВИПРАВЛЕНО: Замінено KICKED на BANNED
+    ]
+
+
+def _is_club_chat(chat):
+    if not TELEGRAM_CHAT_ID_STR:
+        return False
+    return (str(chat.id) == TELEGRAM_CHAT_ID_STR
+            or (chat.username is not None and f"@{chat.username}".lower() == TELEGRAM_CHAT_ID_STR.lower()))
+
+
+class MembershipCache:
+    """
+    Хто є членом клубного чату, щоб не питати get_chat_member на кожне особисте повідомлення.
+
+    Записи живуть AI_MEMBERSHIP_TTL (не-члени — AI_NON_MEMBER_TTL) і одразу
+    оновлюються подіями chat_member клубного чату: вступ, вихід, бан.
+    Якщо задано shared (shared_state.SharedState), записи спільні для всіх воркерів;
+    поки спільний файл зайнятий іншим воркером, використовуються локальні записи.
+    """
+
+    def __init__(self, member_ttl=AI_MEMBERSHIP_TTL, non_member_ttl=AI_NON_MEMBER_TTL,
+                 max_size=AI_MEMBERSHIP_CACHE_SIZE):
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.shared = None
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def get(self, user_id):
+        if self.shared is not None:
+            try:
+                is_member = self.shared.get_member(user_id)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+            else:
+                if is_member is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                return is_member
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            expires_at, is_member = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return is_member
+            del self._entries[user_id]
+        self.misses += 1
+        return None
+
+    def set(self, user_id, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        if self.shared is not None:
+            try:
+                self.shared.set_member(user_id, is_member, ttl)
+                return
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        self._entries[user_id] = (time.monotonic() + ttl, is_member)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        if self.shared is not None:
+            try:
+                self.shared.invalidate_members(user_id)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        # Локальные записи (если были) — всегда: они могли появиться, пока файл был занят
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'updates': self.updates,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+membership_cache = MembershipCache()
+
+
+def note_club_member(chat, user_id):
+    """Запам'ятовує члена клубу (наприклад, після схвалення заявки в handle_join_request)."""
+    if _is_club_chat(chat):
+        membership_cache.set(user_id, True)
 
 
 async def _check_and_reply_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     Проверяет, является ли пользователь участником целевого чата (используется только для личных сообщений).
+    Результат берется из membership_cache, к Telegram API обращаемся только при промахе.
     """
     if not TELEGRAM_CHAT_ID:
         # КОМЕНТАР: Якщо TELEGRAM_CHAT_ID відсутній, підписка не потрібна.
@@ -99,7 +1191,7 @@ async def _check_and_reply_subscription(update: Update, context: ContextTypes.DE
     
     if not cleaned_chat_id:
         logger.error("TELEGRAM_CHAT_ID містить лише пробіли або відсутній після очищення.")
-        await update.message.reply_text("не можу перевірити підписку 💔: ID чату порожній.")
+        await outbound.reply_text(update.message, "не можу перевірити підписку 💔: ID чату порожній.")
         return False 
 
     user_id = update.effective_user.id
@@ -108,19 +1200,18 @@ async def _check_and_reply_subscription(update: Update, context: ContextTypes.DE
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        chat_member = await context.bot.get_chat_member(
-            chat_id=cleaned_chat_id, 
-            user_id=user_id
-        )
-        
-        # Логіка, яка виключає лише LEFT та BANNED (використовує ChatMemberStatus)
-        is_member = chat_member.status not in [
-            ChatMemberStatus.LEFT, 
-            ChatMemberStatus.BANNED # ✅ ВИПРАВЛЕНО: Замінено KICKED на BANNED
-        ]
+        is_member = membership_cache.get(user_id)
+        if is_member is None:
+            chat_member = await context.bot.get_chat_member(
+                chat_id=cleaned_chat_id, 
+                user_id=user_id
+            )
+            is_member = _is_member_status(chat_member)
+            membership_cache.set(user_id, is_member)
 
         if not is_member:
-            await update.message.reply_text(
+            await outbound.reply_text(
+                update.message,
                 "тільки для членів клубу 👑",
                 reply_markup=reply_markup
             )
@@ -128,7 +1219,8 @@ async def _check_and_reply_subscription(update: Update, context: ContextTypes.DE
             
     except Forbidden as e:
         logger.error(f"Помилка Forbidden: Бот не може отримати інформацію про членство в чаті {cleaned_chat_id}. Перевір, чи є бот адміністратором. Помилка: {e}")
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             "не можу перевірити підписку ⚠️\n"
             "Помилка доступу. Бот не адмін у чаті."
         ) 
@@ -137,7 +1229,8 @@ async def _check_and_reply_subscription(update: Update, context: ContextTypes.DE
         
     except BadRequest as e:
         logger.error(f"Помилка BadRequest: Невірний TELEGRAM_CHAT_ID '{cleaned_chat_id}' або інші помилки. Помилка: {e}")
-        await update.message.reply_text(
+        await outbound.reply_text(
+            update.message,
             "не можу перевірити підписку ⚠️\n"
             "Помилка запиту. Перевір ID чату."
         ) 
@@ -146,38 +1239,28 @@ async def _check_and_reply_subscription(update: Update, context: ContextTypes.DE
         
     except Exception as e:
         logger.error(f"Неизвестная ошибка проверки подписки: {e}")
-        await update.message.reply_text("не можу перевірити підписку 💔") 
+        await outbound.reply_text(update.message, "не можу перевірити підписку 💔") 
         return False
     
     return True
 
 async def handle_gemini_message_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Обрабатывает сообщения в групповом чате, содержащие слово "ало" (только текст).
+    Обрабатывает сообщения в групповом чате, на которых сработал триггер "ai"
+    (по умолчанию слово "ало", см. triggers.py; только текст).
     Проверка подписки в группах полностью отключена.
     """
     if not update.message: 
         return
 
-    # Перевірка на ключове слово "ало"
-    if update.message.text is None or "ало" not in update.message.text.lower():
-        return
-
     # Проверка подписки полностью удалена для группы.
     
     if not update.message.text:
         return
 
     await update.message.reply_chat_action("typing")
-    user_text = update.message.text
     
-    reply = await _get_gemini_response(user_text)
-    
-    if reply:
-        await update.message.reply_text(
-            reply,
-            message_thread_id=update.message.message_thread_id
-        )
+    await _answer_with_gemini(update, context, AI_STREAM_EDIT_INTERVAL_GROUP)
 
 async def handle_gemini_message_private(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -198,7 +1281,88 @@ async def handle_gemini_message_private(update: Update, context: ContextTypes.DE
 
     await update.message.reply_chat_action("typing")
     
-    reply = await _get_gemini_response(user_text)
-    
-    if reply:
-        await update.message.reply_text(reply)
\ No newline at end of file
+    await _answer_with_gemini(update, context, AI_STREAM_EDIT_INTERVAL)
+
+
+async def handle_ai_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /cancel — скасовує запити користувача до ШІ в цьому чаті (у черзі та ті, що генеруються).
+    Відповідає лише якщо було що скасовувати, щоб не дублювати /cancel для /font.
+    """
+    if not update.message or not update.effective_user:
+        return
+
+    cancelled = scheduler.cancel(user_id=update.effective_user.id, chat_id=update.effective_chat.id)
+    if cancelled:
+        await outbound.reply_text(
+            update.message,
+            "запит до ШІ скасовано 🛑",
+            message_thread_id=update.message.message_thread_id
+        )
+
+
+async def handle_ai_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Обробляє зміни членства (chat_member / my_chat_member):
+    оновлює membership_cache для клубного чату і скасовує запити до ШІ,
+    коли користувач покидає чат (або блокує бота в особистих).
+    Вихід із клубного чату скасовує всі запити користувача — ШІ лише для членів клубу.
+    """
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
+
+    club_chat = _is_club_chat(member_update.chat)
+    if club_chat:
+        membership_cache.updates += 1
+        if update.chat_member:
+            membership_cache.set(member_update.new_chat_member.user.id,
+                                 _is_member_status(member_update.new_chat_member))
+        else:
+            # Змінилися права самого бота — без адмінки події можуть не приходити
+            membership_cache.invalidate()
+
+    if _is_member_status(member_update.new_chat_member):
+        return
+
+    chat_id = member_update.chat.id
+    if update.my_chat_member:
+        # Бота заблокували або видалили з чату — відповідати вже нікуди
+        cancelled = scheduler.cancel(chat_id=chat_id)
+    else:
+        user_id = member_update.new_chat_member.user.id
+        cancelled = scheduler.cancel(user_id=user_id, chat_id=None if club_chat else chat_id)
+
+    if cancelled:
+        logger.info(f"Скасовано {cancelled} запитів до ШІ: вихід з чату {chat_id}")
+
+
+async def handle_ai_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /aicache on|off — вмикає або вимикає кеш відповідей ШІ для цього чату.
+    У групах змінювати налаштування можуть лише адміністратори.
+    """
+    if not update.message or not update.effective_user:
+        return
+
+    if not context.args or context.args[0].lower() not in ('on', 'off'):
+        state = "увімкнено" if context.chat_data.get('ai_cache', True) else "вимкнено"
+        stats = response_cache.stats()
+        await outbound.reply_text(
+            update.message,
+            f"кеш ШІ: {state} 🗂\n"
+            f"влучань: {stats['hits'] + stats['disk_hits']}, промахів: {stats['misses']} "
+            f"({stats['hit_rate']:.0%})\n\n"
+            "/aicache on | off"
+        )
+        return
+
+    if update.effective_chat.type != Chat.PRIVATE:
+        member = await context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
+        if member.status not in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER):
+            await outbound.reply_text(update.message, "тільки для адмінів 👮")
+            return
+
+    enabled = context.args[0].lower() == 'on'
+    context.chat_data['ai_cache'] = enabled
+    await outbound.reply_text(update.message, "кеш ШІ увімкнено ✅" if enabled else "кеш ШІ вимкнено 🚫")
@@ -0,0 +1,167 @@
+# art.py
+"""
+Обработка артов из Web App (ART|ключ|base64).
+
+Декодирование, проверка и перекодирование выполняются в пуле процессов,
+чтобы тяжелая работа Pillow не блокировала цикл событий и не держала GIL.
+На выходе — нормализованный PNG (или WebP) и JPEG-миниатюра, которые
+бот отправляет пользователю документом.
+Бенчмарк: python -m bench.art
+"""
+
+import io
+import os
+import re
+import base64
+import asyncio
+import hashlib
+import logging
+import binascii
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, NamedTuple, Optional
+
+if TYPE_CHECKING:
+    from PIL import Image  # Pillow импортируется только в процессах пула
+
+logger = logging.getLogger(__name__)
+
+ART_MAX_BYTES = int(os.getenv('ART_MAX_BYTES', 5 * 1024 * 1024))  # размер декодированного файла
+ART_MAX_PIXELS = int(os.getenv('ART_MAX_PIXELS', 4096 * 4096))  # ширина × высота
+ART_MAX_SIDE = int(os.getenv('ART_MAX_SIDE', 4096))  # самая длинная сторона после нормализации
+ART_THUMB_SIZE = int(os.getenv('ART_THUMB_SIZE', 320))  # Telegram принимает миниатюры до 320×320
+ART_FORMAT = os.getenv('ART_FORMAT', 'png').lower()  # png | webp
+ART_WORKERS = int(os.getenv('ART_WORKERS', min(2, os.cpu_count() or 1)))
+ART_MAX_PENDING = int(os.getenv('ART_MAX_PENDING', 16))  # артов в обработке одновременно
+
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'WEBP', 'GIF', 'BMP'}
+_DATA_URL = re.compile(r'^data:image/[\w.+-]+;base64,', re.IGNORECASE)
+
+
+class ArtError(ValueError):
+    """Арт отклонен; текст ошибки можно показать пользователю."""
+
+
+class ArtResult(NamedTuple):
+    image: bytes  # нормализованный файл в ART_FORMAT
+    thumbnail: bytes  # JPEG не больше ART_THUMB_SIZE по длинной стороне
+    width: int
+    height: int
+    format: str  # 'png' или 'webp'
+    sha256: str  # хеш нормализованного файла
+
+
+def _decode_payload(payload: str, max_bytes: int) -> bytes:
+    payload = _DATA_URL.sub('', payload.strip(), count=1)
+    # base64 раздувает данные в 4/3 раза — отсекаем слишком большие до декодирования
+    if len(payload) > (max_bytes + 2) // 3 * 4:
+        raise ArtError("Арт занадто великий.")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise ArtError("Невірний формат даних.")
+
+
+def _flatten(image: 'Image.Image', background=(255, 255, 255)) -> 'Image.Image':
+    """RGBA -> RGB на белом фоне (для JPEG)."""
+    from PIL import Image
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, background)
+        flat.paste(image, mask=image.getchannel('A'))
+        return flat
+    return image.convert('RGB')
+
+
+def process_art(payload: str, max_bytes: int = ART_MAX_BYTES, max_pixels: int = ART_MAX_PIXELS,
+                max_side: int = ART_MAX_SIDE, thumb_size: int = ART_THUMB_SIZE,
+                output_format: str = ART_FORMAT) -> ArtResult:
+    """
+    Синхронная обработка одного арта (выполняется в процессе пула).
+
+    Raises:
+        ArtError: данные не base64, не изображение, неподдерживаемый формат
+                  или превышены лимиты размера
+    """
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    data = _decode_payload(payload, max_bytes)
+    if len(data) > max_bytes:
+        raise ArtError("Арт занадто великий.")
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Размер известен из заголовка — проверяем до распаковки пикселей
+        if image.format not in ALLOWED_FORMATS:
+            raise ArtError("Непідтримуваний формат зображення.")
+        width, height = image.size
+        if width * height > max_pixels:
+            raise ArtError("Арт має забагато пікселів.")
+        image.load()
+    except ArtError:
+        raise
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError):
+        raise ArtError("Файл не є зображенням.")
+
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P', 'PA') else 'RGB')
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if output_format == 'webp':
+        image.save(output, 'WEBP', lossless=True, method=4)
+    else:
+        output_format = 'png'
+        image.save(output, 'PNG', compress_level=6)
+    normalized = output.getvalue()
+
+    thumb = _flatten(image)
+    thumb.thumbnail((thumb_size, thumb_size), Image.LANCZOS)
+    thumb_output = io.BytesIO()
+    thumb.save(thumb_output, 'JPEG', quality=85, optimize=True)
+
+    return ArtResult(
+        image=normalized,
+        thumbnail=thumb_output.getvalue(),
+        width=image.width,
+        height=image.height,
+        format=output_format,
+        sha256=hashlib.sha256(normalized).hexdigest()
+    )
+
+
+# ========================================
+# ПУЛ ПРОЦЕССОВ
+# ========================================
+_executor: Optional[ProcessPoolExecutor] = None
+_pending: Optional[asyncio.Semaphore] = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max(1, ART_WORKERS))
+    return _executor
+
+
+async def process_art_async(payload: str, executor: Optional[ProcessPoolExecutor] = None) -> ArtResult:
+    """Обрабатывает арт в пуле процессов; не больше ART_MAX_PENDING одновременно."""
+    global _pending
+    if _pending is None:
+        _pending = asyncio.Semaphore(ART_MAX_PENDING)
+    loop = asyncio.get_running_loop()
+    async with _pending:
+        return await loop.run_in_executor(executor or get_executor(), process_art, payload)
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def safe_filename(key: str, extension: str) -> str:
+    """Имя файла из ключа арта (ключ приходит от клиента)."""
+    name = re.sub(r'[^\w.-]+', '_', key).strip('._')[:64] or 'art'
+    return f"{name}.{extension}"
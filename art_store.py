@@ -0,0 +1,264 @@
+# art_store.py
+"""
+Локальное хранилище артов с адресацией по содержимому.
+
+Файлы лежат под именем sha256 нормализованного изображения, поэтому
+одинаковые арты хранятся один раз. Индекс в SQLite связывает full_item_key
+из Web App и хеш исходного base64 с уже обработанным результатом: повторная
+отправка того же арта (под тем же или другим ключом) не декодируется и не
+занимает места. После первой отправки запоминается file_id Telegram, и
+дальше файл вообще не загружается заново. Старые арты вытесняются по LRU, когда
+хранилище превышает ART_STORE_BUDGET.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from typing import Dict, NamedTuple, Optional
+
+from art import ArtResult
+
+logger = logging.getLogger(__name__)
+
+ART_STORE_PATH = os.getenv('ART_STORE_PATH', 'art_store')  # каталог хранилища; пусто — выключено
+ART_STORE_BUDGET = int(os.getenv('ART_STORE_BUDGET', 256 * 1024 * 1024))  # байт на диске
+
+
+class StoredArt(NamedTuple):
+    sha256: str
+    format: str
+    width: int
+    height: int
+    size: int  # байт: изображение + миниатюра
+    file_id: Optional[str]  # file_id документа в Telegram, если уже отправлялся
+    path: str
+    thumb_path: str
+
+
+def payload_hash(payload: str) -> str:
+    """Хеш исходного base64 из Web App — ключ для пропуска повторной обработки."""
+    return hashlib.sha256(payload.strip().encode()).hexdigest()
+
+
+class ArtStore:
+    """
+    Хранилище: objects/<2 символа>/<sha256>.<формат> и .thumb.jpg плюс index.sqlite3.
+
+    Все обращения к диску синхронны и выполняются через asyncio.to_thread
+    в async-методах; SQLite защищен замком, как в ai.ResponseCache.
+    """
+
+    def __init__(self, root: str = ART_STORE_PATH, budget: int = ART_STORE_BUDGET):
+        self.root = root
+        self.budget = budget
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dedup_hits = 0
+        self.evictions = 0
+        self.usage: Dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root) and self.budget > 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.root, 'index.sqlite3'), check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " sha256 TEXT PRIMARY KEY, format TEXT NOT NULL, width INTEGER NOT NULL,"
+                " height INTEGER NOT NULL, size INTEGER NOT NULL, file_id TEXT,"
+                " last_access REAL NOT NULL) WITHOUT ROWID;"
+                "CREATE INDEX IF NOT EXISTS blobs_lru ON blobs (last_access);"
+                "CREATE TABLE IF NOT EXISTS payloads ("
+                " payload_hash TEXT PRIMARY KEY, sha256 TEXT NOT NULL) WITHOUT ROWID;"
+                "CREATE INDEX IF NOT EXISTS payloads_sha ON payloads (sha256);"
+                # Ключ Web App может прийти снова с измененным артом — поэтому хранится и хеш base64
+                "CREATE TABLE IF NOT EXISTS item_keys ("
+                " item_key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, payload_hash TEXT NOT NULL,"
+                " user_id INTEGER, updated REAL NOT NULL) WITHOUT ROWID;"
+                "CREATE INDEX IF NOT EXISTS item_keys_sha ON item_keys (sha256);"
+            )
+        return self._db
+
+    def _paths(self, sha256: str, fmt: str):
+        directory = os.path.join(self.root, 'objects', sha256[:2])
+        return os.path.join(directory, f"{sha256}.{fmt}"), os.path.join(directory, f"{sha256}.thumb.jpg")
+
+    def _stored(self, row) -> StoredArt:
+        sha256, fmt, width, height, size, file_id = row
+        path, thumb_path = self._paths(sha256, fmt)
+        return StoredArt(sha256, fmt, width, height, size, file_id, path, thumb_path)
+
+    def _select(self, db, where: str, *params: str) -> Optional[StoredArt]:
+        row = db.execute(
+            "SELECT b.sha256, b.format, b.width, b.height, b.size, b.file_id FROM blobs b " + where, params
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute("UPDATE blobs SET last_access = ? WHERE sha256 = ?", (time.time(), row[0]))
+        return self._stored(row)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes) -> None:
+        # Пишем во временный файл и переименовываем — читатель не увидит половину файла
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # --- синхронная часть (в потоке) ---
+
+    @staticmethod
+    def _link(db, item_key: str, sha256: str, payload_hash: str, user_id: Optional[int]) -> None:
+        db.execute("INSERT OR REPLACE INTO item_keys VALUES (?, ?, ?, ?, ?)",
+                   (item_key, sha256, payload_hash, user_id, time.time()))
+
+    def _find(self, item_key: str, payload_hash: str, user_id: Optional[int]) -> Optional[StoredArt]:
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                # Тот же ключ с тем же содержимым — арт уже привязан к ключу
+                stored = self._select(db, "JOIN item_keys i ON i.sha256 = b.sha256 "
+                                          "WHERE i.item_key = ? AND i.payload_hash = ?", item_key, payload_hash)
+                if stored is not None:
+                    return stored
+                # Тот же арт под новым ключом (или новое содержимое ключа, уже присланное кем-то)
+                stored = self._select(db, "JOIN payloads p ON p.sha256 = b.sha256 WHERE p.payload_hash = ?",
+                                      payload_hash)
+                if stored is not None:
+                    self._link(db, item_key, stored.sha256, payload_hash, user_id)
+                return stored
+
+    def _put(self, item_key: str, payload_hash: str, result: ArtResult, user_id: Optional[int]) -> StoredArt:
+        path, thumb_path = self._paths(result.sha256, result.format)
+        with self._db_lock:
+            db = self._connect()
+            exists = db.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (result.sha256,)).fetchone()
+            # Если файл есть, это тот же арт в другом base64 (например, с другими метаданными)
+            if exists is None:
+                self._write_atomic(path, result.image)
+                self._write_atomic(thumb_path, result.thumbnail)
+            size = len(result.image) + len(result.thumbnail)
+            now = time.time()
+            with db:
+                db.execute(
+                    "INSERT INTO blobs VALUES (?, ?, ?, ?, ?, NULL, ?) "
+                    "ON CONFLICT(sha256) DO UPDATE SET last_access = excluded.last_access",
+                    (result.sha256, result.format, result.width, result.height, size, now)
+                )
+                db.execute("INSERT OR REPLACE INTO payloads VALUES (?, ?)", (payload_hash, result.sha256))
+                self._link(db, item_key, result.sha256, payload_hash, user_id)
+                stored = self._select(db, "WHERE b.sha256 = ?", result.sha256)
+            self._evict(db, keep=result.sha256)
+            self.usage = self._query_usage(db)
+        if exists is not None:
+            self.dedup_hits += 1
+        return stored
+
+    def _set_file_id(self, sha256: str, file_id: str) -> None:
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                db.execute("UPDATE blobs SET file_id = ? WHERE sha256 = ?", (file_id, sha256))
+
+    def _evict(self, db: sqlite3.Connection, keep: Optional[str] = None) -> None:
+        """Удаляет давно не использованные арты, пока хранилище больше бюджета."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.budget:
+            return
+        victims = []
+        for sha256, fmt, size in db.execute("SELECT sha256, format, size FROM blobs ORDER BY last_access"):
+            if total <= self.budget:
+                break
+            if sha256 == keep:
+                continue
+            victims.append((sha256, fmt))
+            total -= size
+        with db:
+            for sha256, _ in victims:
+                db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                db.execute("DELETE FROM payloads WHERE sha256 = ?", (sha256,))
+                db.execute("DELETE FROM item_keys WHERE sha256 = ?", (sha256,))
+        for sha256, fmt in victims:
+            for path in self._paths(sha256, fmt):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+        self.evictions += len(victims)
+
+    @staticmethod
+    def _query_usage(db: sqlite3.Connection) -> Dict[str, float]:
+        blobs, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        items = db.execute("SELECT COUNT(*) FROM item_keys").fetchone()[0]
+        return {'blobs': blobs, 'items': items, 'bytes': size}
+
+    # --- async API ---
+
+    async def find(self, item_key: str, payload: str, user_id: Optional[int] = None) -> Optional[StoredArt]:
+        """
+        Уже обработанный арт по full_item_key или по тому же base64 (тогда ключ
+        привязывается к нему) или None.
+        """
+        if not self.enabled:
+            return None
+        try:
+            stored = await asyncio.to_thread(self._find, item_key, payload_hash(payload), user_id)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения хранилища артов: {e}")
+            return None
+        if stored is not None and not os.path.exists(stored.path):
+            stored = None  # файл удалили вручную — обработаем заново
+        if stored is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stored
+
+    async def put(self, item_key: str, payload: str, result: ArtResult,
+                  user_id: Optional[int] = None) -> Optional[StoredArt]:
+        if not self.enabled:
+            return None
+        try:
+            return await asyncio.to_thread(self._put, item_key, payload_hash(payload), result, user_id)
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Ошибка записи в хранилище артов: {e}")
+            return None
+
+    async def set_file_id(self, stored: StoredArt, file_id: str) -> None:
+        try:
+            await asyncio.to_thread(self._set_file_id, stored.sha256, file_id)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи в хранилище артов: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        # Занятое место обновляется при записи, чтобы /metrics не ходил в SQLite
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'dedup_hits': self.dedup_hits,
+            'evictions': self.evictions,
+            'blobs': self.usage.get('blobs', 0),
+            'items': self.usage.get('items', 0),
+            'bytes': self.usage.get('bytes', 0),
+        }
+
+
+art_store = ArtStore()
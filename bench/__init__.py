@@ -0,0 +1,6 @@
+# bench/__init__.py
+"""
+Локальные заглушки внешних API и бенчмарки бота.
+
+Запуск из корня проекта, например: python -m bench.fake_safe_browsing --check
+"""
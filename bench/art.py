@@ -0,0 +1,97 @@
+# bench/art.py
+"""
+Пропускная способность art.process_art при одновременной отправке артов:
+пул процессов против обработки прямо в цикле событий, вместе с задержкой
+цикла событий (насколько обработка мешает остальным обработчикам).
+
+    python -m bench.art [--count 64] [--size 512] [--workers 2]
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import art
+
+
+def make_payload(size: int, seed: int) -> str:
+    """Арт, похожий на рисунок из Web App: градиент с шумом, PNG в base64."""
+    gradient = Image.linear_gradient('L').resize((size, size))
+    noise = Image.effect_noise((size, size), 40 + seed % 20)
+    image = Image.merge('RGB', (gradient, noise, gradient.rotate(90)))
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return base64.b64encode(output.getvalue()).decode()
+
+
+async def _measure_lag(stop: asyncio.Event, samples: list, interval: float = 0.005) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def _run(payloads, process) -> dict:
+    stop = asyncio.Event()
+    lag = []
+    ticker = asyncio.create_task(_measure_lag(stop, lag))
+    latencies = []
+
+    # Все арты отправлены одновременно — задержка считается от общего старта
+    started = time.perf_counter()
+
+    async def one(payload):
+        await process(payload)
+        latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(p) for p in payloads))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    latencies.sort()
+    return {
+        'throughput': len(payloads) / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(len(latencies) * 0.95) - 1],
+        'lag_max': max(lag, default=0.0),
+    }
+
+
+async def main_async(args) -> None:
+    payloads = [make_payload(args.size, i) for i in range(args.count)]
+    print(f"{args.count} артов {args.size}×{args.size}, {len(payloads[0]) / 1024:.0f} КБ base64 каждый")
+
+    async def inline(payload):
+        return art.process_art(payload)
+
+    executor = ProcessPoolExecutor(max_workers=args.workers)
+    # Прогрев: процессы пула стартуют при первой задаче
+    await asyncio.gather(*(art.process_art_async(payloads[0], executor) for _ in range(args.workers)))
+
+    async def pooled(payload):
+        return await art.process_art_async(payload, executor)
+
+    for title, process in (("в цикле событий", inline), (f"пул из {args.workers} процессов", pooled)):
+        result = await _run(payloads, process)
+        print(f"{title}: {result['throughput']:.1f} арт/с, p50 {result['p50'] * 1000:.0f} мс, "
+              f"p95 {result['p95'] * 1000:.0f} мс, макс. задержка цикла {result['lag_max'] * 1000:.0f} мс")
+    executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=64)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--workers", type=int, default=art.ART_WORKERS)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# bench/fake_bot_api.py
+"""
+Локальная заглушка Telegram Bot API.
+
+Отвечает на getMe, getUpdates (отдает обновления из очереди, как long polling),
+getChatMember (все — участники), send*/edit* (сообщение с новым message_id),
+а на остальные методы — успехом. Задержку каждого ответа задает latency.
+Все вызовы записываются в calls. Бот подключается к ней через TELEGRAM_API_URL:
+
+    python -m bench.fake_bot_api --port 8081
+    TELEGRAM_BOT_TOKEN=123:fake TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 123, "is_bot": True, "first_name": "MORSTRIXBOT", "username": "MORSTRIXBOT",
+    "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": True,
+}
+
+
+def group_message(text: str, chat_id: int = -1001, user_id: int = 1, message_id: int = 1) -> dict:
+    """Обновление с текстовым сообщением в группе."""
+    return {
+        "message": {
+            "message_id": message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+    }
+
+
+class FakeBotApi:
+    """Очередь обновлений для getUpdates и журнал вызовов (метод, время, параметры)."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[Tuple[str, float, dict]] = []
+        self.updates_served: List[Tuple[int, float]] = []  # (update_id, время отдачи)
+        self._update_ids = itertools.count(1)
+        self._updates: List[dict] = []
+        self._has_updates = asyncio.Event()
+        self._message_ids = itertools.count(1000)
+
+    def push(self, update: dict) -> int:
+        update = dict(update, update_id=next(self._update_ids))
+        self._updates.append(update)
+        self._has_updates.set()
+        return update["update_id"]
+
+    def count(self, method: str) -> int:
+        return sum(1 for name, _, _ in self.calls if name == method)
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                return []
+        limit = int(params.get("limit") or 100)
+        served = self._updates[:limit]
+        now = time.perf_counter()
+        self.updates_served += [(u["update_id"], now) for u in served]
+        return served
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()), "text": params.get("text", ""),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls.append((method, time.perf_counter(), params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result: object = True
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id") or 0), "is_bot": False,
+                                                   "first_name": "member"}}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        elif method == "sendDocument":
+            result = dict(self._message(params), document={
+                "file_id": f"doc{len(self.calls)}", "file_unique_id": f"u{len(self.calls)}"
+            })
+        return web.json_response({"ok": True, "result": result}, dumps=json.dumps)
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, port: int = 0, host: str = "127.0.0.1") -> Tuple[web.AppRunner, int]:
+        """Запускает сервер; port=0 — свободный порт. Возвращает runner и фактический порт."""
+        runner = web.AppRunner(self.build_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+
+async def _serve(port: int, messages: Optional[List[str]]) -> None:
+    api = FakeBotApi()
+    for text in messages or ():
+        api.push(group_message(text))
+    runner, port = await api.start(port)
+    logger.info(f"Заглушка Bot API: TELEGRAM_API_URL=http://127.0.0.1:{port}")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--message", action="append", help="текст сообщения в группе для getUpdates")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_serve(args.port, args.message))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
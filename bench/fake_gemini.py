@@ -0,0 +1,67 @@
+# bench/fake_gemini.py
+"""
+Заглушка модели Gemini для бенчмарков.
+
+Асинхронный клиент google-generativeai работает только по gRPC, поэтому
+заглушка подменяет не HTTP сервер, а саму модель, которую возвращает
+ai._get_model(): generate_content_async с заданной задержкой, а при
+stream=True — ответ из нескольких фрагментов, как у настоящего API.
+С generation_config.max_output_tokens (короткий ответ) задержка вдвое меньше.
+Очередь, лимиты, стриминг в чат и память разговоров работают без изменений.
+"""
+
+import asyncio
+from typing import Any, List, Optional
+
+
+class _Chunk:
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Stream:
+    def __init__(self, pieces: List[str], delay: float):
+        self._pieces = pieces
+        self._delay = delay
+
+    async def __aiter__(self):
+        for piece in self._pieces:
+            await asyncio.sleep(self._delay)
+            yield _Chunk(piece)
+
+
+class FakeGeminiModel:
+    """latency — время всего ответа, сек; при стриминге делится между chunks фрагментами."""
+
+    def __init__(self, latency: float = 0.5, chunks: int = 4, answer: str = "це відповідь заглушки Gemini 🤖"):
+        self.latency = latency
+        self.chunks = max(1, chunks)
+        self.answer = answer
+        self.calls = 0
+        self.short_calls = 0
+        self.model_name = 'models/fake-gemini'
+
+    async def generate_content_async(self, contents: Any, stream: bool = False,
+                                     request_options: Optional[dict] = None,
+                                     generation_config: Optional[dict] = None) -> Any:
+        self.calls += 1
+        latency = self.latency
+        if generation_config and generation_config.get('max_output_tokens'):
+            self.short_calls += 1
+            latency /= 2
+        if not stream:
+            await asyncio.sleep(latency)
+            return _Chunk(self.answer)
+        step = max(1, len(self.answer) // self.chunks)
+        pieces = [self.answer[i:i + step] for i in range(0, len(self.answer), step)]
+        return _Stream(pieces, latency / len(pieces))
+
+
+def install(latency: float = 0.5, chunks: int = 4) -> FakeGeminiModel:
+    """Подставляет заглушку в ai (вызывать после импорта ai, с GEMINI_API_KEY в окружении)."""
+    import ai
+    model = FakeGeminiModel(latency, chunks)
+    ai._model = model
+    return model
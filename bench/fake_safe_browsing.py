@@ -0,0 +1,219 @@
+# bench/fake_safe_browsing.py
+"""
+Локальная заглушка Google Safe Browsing v4.
+
+Отдает threatListUpdates:fetch (полные и частичные обновления с checksum),
+fullHashes:find и threatMatches:find для заданного набора опасных выражений
+("хост/путь", как в url_expressions). Подходит для проверки режима
+SAFE_BROWSING_MODE=update без ключа и сети:
+
+    python -m bench.fake_safe_browsing --port 8089
+    GOOGLE_SAFE_BROWSING_API_ROOT=http://127.0.0.1:8089/v4 python main.py
+
+    python -m bench.fake_safe_browsing --check   # самопроверка локальной базы
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from aiohttp import web
+
+from safe import THREAT_TYPES, canonicalize_url, url_expressions
+
+logger = logging.getLogger(__name__)
+
+PREFIX_SIZE = 4
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class FakeSafeBrowsing:
+    """
+    Состояние заглушки: опасные выражения попадают в список MALWARE,
+    остальные списки пустые. Каждое изменение увеличивает версию списка,
+    а снимки версий позволяют отдавать частичные обновления.
+    """
+
+    def __init__(self, expressions: Iterable[str] = (), latency: float = 0.0,
+                 cache_duration: str = "300s", minimum_wait: str = "1s"):
+        self.latency = latency
+        self.cache_duration = cache_duration
+        self.minimum_wait = minimum_wait
+        self.full_hashes: Dict[bytes, str] = {}
+        self.version = 0
+        self._snapshots: Dict[int, List[bytes]] = {}
+        self.requests: Dict[str, int] = {}
+        for expression in expressions:
+            self.full_hashes[hashlib.sha256(expression.encode()).digest()] = expression
+        self._snapshot()
+
+    def _snapshot(self) -> None:
+        self.version += 1
+        self._snapshots[self.version] = sorted({h[:PREFIX_SIZE] for h in self.full_hashes})
+
+    def add(self, expression: str) -> None:
+        self.full_hashes[hashlib.sha256(expression.encode()).digest()] = expression
+        self._snapshot()
+
+    def remove(self, expression: str) -> None:
+        self.full_hashes.pop(hashlib.sha256(expression.encode()).digest(), None)
+        self._snapshot()
+
+    def _list_update(self, request: dict) -> dict:
+        response = {
+            "threatType": request["threatType"],
+            "platformType": request["platformType"],
+            "threatEntryType": request["threatEntryType"],
+            "newClientState": str(self.version),
+        }
+        current = self._snapshots[self.version] if request["threatType"] == "MALWARE" else []
+        state = request.get("state") or ""
+        old = None
+        if state.isdigit() and int(state) in self._snapshots:
+            old = self._snapshots[int(state)] if request["threatType"] == "MALWARE" else []
+
+        if old is None:
+            response["responseType"] = "FULL_UPDATE"
+            additions, removals = current, []
+        else:
+            response["responseType"] = "PARTIAL_UPDATE"
+            current_set, old_set = set(current), set(old)
+            removals = [i for i, prefix in enumerate(old) if prefix not in current_set]
+            additions = [prefix for prefix in current if prefix not in old_set]
+
+        if additions:
+            response["additions"] = [{
+                "compressionType": "RAW",
+                "rawHashes": {"prefixSize": PREFIX_SIZE, "rawHashes": _b64(b"".join(additions))}
+            }]
+        if removals:
+            response["removals"] = [{"compressionType": "RAW", "rawIndices": {"indices": removals}}]
+        response["checksum"] = {"sha256": _b64(hashlib.sha256(b"".join(current)).digest())}
+        return response
+
+    async def _delay(self, name: str) -> None:
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def handle_updates(self, request: web.Request) -> web.Response:
+        await self._delay("threatListUpdates:fetch")
+        body = await request.json()
+        return web.json_response({
+            "listUpdateResponses": [self._list_update(r) for r in body.get("listUpdateRequests", [])],
+            "minimumWaitDuration": self.minimum_wait,
+        })
+
+    async def handle_full_hashes(self, request: web.Request) -> web.Response:
+        await self._delay("fullHashes:find")
+        body = await request.json()
+        prefixes = [base64.b64decode(e["hash"]) for e in body["threatInfo"]["threatEntries"]]
+        matches = [
+            {
+                "threatType": "MALWARE",
+                "platformType": "ANY_PLATFORM",
+                "threatEntryType": "URL",
+                "threat": {"hash": _b64(full_hash)},
+                "cacheDuration": self.cache_duration,
+            }
+            for full_hash in self.full_hashes
+            if any(full_hash.startswith(prefix) for prefix in prefixes)
+        ]
+        return web.json_response({"matches": matches, "negativeCacheDuration": self.cache_duration})
+
+    async def handle_find(self, request: web.Request) -> web.Response:
+        await self._delay("threatMatches:find")
+        body = await request.json()
+        matches = []
+        for entry in body["threatInfo"]["threatEntries"]:
+            expressions = url_expressions(canonicalize_url(entry["url"]))
+            if any(hashlib.sha256(e.encode()).digest() in self.full_hashes for e in expressions):
+                matches.append({
+                    "threatType": "MALWARE",
+                    "platformType": "ANY_PLATFORM",
+                    "threatEntryType": "URL",
+                    "threat": {"url": entry["url"]},
+                    "cacheDuration": self.cache_duration,
+                })
+        return web.json_response({"matches": matches} if matches else {})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v4/threatListUpdates:fetch", self.handle_updates)
+        app.router.add_post("/v4/fullHashes:find", self.handle_full_hashes)
+        app.router.add_post("/v4/threatMatches:find", self.handle_find)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        """Запускает сервер в текущем цикле событий; адрес — в self.api_root."""
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        self.api_root = f"http://{host}:{port}/v4"
+        return runner
+
+
+async def _self_check() -> None:
+    from safe import LocalThreatDatabase, SafeBrowsingClient
+
+    fake = FakeSafeBrowsing(["evil.example/", "bad.example/malware/", "also.bad/x.html"])
+    runner = await fake.start()
+    client = SafeBrowsingClient("fake-key", api_root=fake.api_root)
+    database = LocalThreatDatabase(THREAT_TYPES)
+    try:
+        await database.update(client)
+        assert len(database) == 3, len(database)
+
+        urls = [canonicalize_url(u) for u in (
+            "http://evil.example/login", "https://www.evil.example/", "http://bad.example/malware/a.exe",
+            "http://bad.example/ok", "http://good.example/", "https://t.me/+7Xmj6pPB0mEyMDky",
+        )]
+        threats = await database.find_threats(urls, client)
+        assert set(threats) == set(urls[:3]), threats
+        assert fake.requests["fullHashes:find"] == 1
+
+        # Инкрементальное обновление: одно выражение удалено, одно добавлено
+        fake.remove("evil.example/")
+        fake.add("good.example/")
+        await database.update(client)
+        threats = await database.find_threats(urls, client)
+        assert set(threats) == {urls[2], urls[4]}, threats
+
+        started = time.perf_counter()
+        for _ in range(1000):
+            database.match_prefixes(urls[5])
+        per_url = (time.perf_counter() - started) / 1000 * 1e6
+        print(f"OK: {len(database)} префиксов, локальная проверка ссылки ~{per_url:.1f} мкс")
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка каждого ответа, сек")
+    parser.add_argument("--bad", action="append", default=["evil.example/"], help="опасное выражение хост/путь")
+    parser.add_argument("--check", action="store_true", help="самопроверка локальной базы и выход")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        asyncio.run(_self_check())
+        return
+
+    fake = FakeSafeBrowsing(args.bad, latency=args.latency)
+    web.run_app(fake.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# bench/metrics_overhead.py
+"""
+Накладные расходы metrics.py: стоимость instrument() на вызов обработчика,
+Timer для внешних вызовов, Histogram.observe и сборки /metrics.
+
+    python -m bench.metrics_overhead [--calls 200000]
+"""
+
+import argparse
+import asyncio
+import time
+
+import metrics
+
+
+async def _handler(update, context):
+    return None
+
+
+async def _per_call_ns(callback, calls: int) -> float:
+    started = time.perf_counter_ns()
+    for _ in range(calls):
+        await callback(None, None)
+    return (time.perf_counter_ns() - started) / calls
+
+
+def _timer_ns(calls: int) -> float:
+    started = time.perf_counter_ns()
+    for _ in range(calls):
+        with metrics.upstream('bench', 'noop'):
+            pass
+    return (time.perf_counter_ns() - started) / calls
+
+
+def _observe_ns(calls: int) -> float:
+    histogram = metrics.Histogram('bench_observe_seconds', 'bench', ('handler',))
+    metrics.registry.remove(histogram)
+    started = time.perf_counter_ns()
+    for i in range(calls):
+        histogram.observe(i * 1e-6, 'bench')
+    return (time.perf_counter_ns() - started) / calls
+
+
+async def main_async(calls: int) -> None:
+    bare = await _per_call_ns(_handler, calls)
+    wrapped = await _per_call_ns(metrics.instrument('bench')(_handler), calls)
+    print(f"вызов обработчика без метрик:     {bare:7.0f} нс")
+    print(f"вызов через instrument():          {wrapped:7.0f} нс (+{wrapped - bare:.0f} нс)")
+    print(f"with metrics.upstream(...):        {_timer_ns(calls):7.0f} нс")
+    print(f"Histogram.observe:                 {_observe_ns(calls):7.0f} нс")
+
+    # Типичный /metrics: ~20 обработчиков и ~20 методов внешних API
+    for i in range(20):
+        metrics.handler_latency.observe(0.01, f"handler_{i}")
+        metrics.upstream_latency.observe(0.1, 'telegram', f"method_{i}")
+    started = time.perf_counter()
+    text = metrics.render()
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"render(): {elapsed:.2f} мс, {len(text.splitlines())} строк, {len(text) / 1024:.0f} КБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.calls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# bench/ratelimit.py
+"""
+Микро-бенчмарк ratelimit.RateLimiter против прежнего списочного ограничителя
+из handlers.py: стоимость одной проверки и память на 100 тыс. ключей.
+
+    python -m bench.ratelimit [--keys 100000]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from ratelimit import RateLimiter
+
+
+class ListRateLimiter:
+    """Прежняя реализация handlers.RateLimiter — для сравнения."""
+
+    def __init__(self, max_requests=3, period=300):
+        self.requests = {}
+        self.max_requests = max_requests
+        self.period = period
+
+    def is_allowed(self, user_id):
+        now = datetime.now()
+        if user_id not in self.requests:
+            self.requests[user_id] = []
+
+        self.requests[user_id] = [
+            req_time for req_time in self.requests[user_id]
+            if now - req_time < timedelta(seconds=self.period)
+        ]
+
+        if len(self.requests[user_id]) >= self.max_requests:
+            return False
+
+        self.requests[user_id].append(now)
+        return True
+
+
+def _per_check_ns(limiter, keys):
+    check = limiter.is_allowed
+    started = time.perf_counter_ns()
+    for key in keys:
+        check(key)
+    return (time.perf_counter_ns() - started) / len(keys)
+
+
+def _memory_bytes(factory, keys):
+    gc.collect()
+    tracemalloc.start()
+    limiter = factory()
+    for key in keys:
+        limiter.is_allowed(key)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=100_000)
+    args = parser.parse_args()
+
+    # Ключи как у Telegram: user_id за пределами кеша малых int
+    keys = [10_000_000 + i for i in range(args.keys)]
+    hot = [keys[0]] * args.keys
+
+    for title, factory in (
+        ("GCRA (ratelimit.RateLimiter)", lambda: RateLimiter(3, 300, name="bench")),
+        ("список datetime (старый)", ListRateLimiter),
+    ):
+        distinct = _per_check_ns(factory(), keys)
+        repeated = _per_check_ns(factory(), hot)
+        memory = _memory_bytes(factory, keys)
+        print(f"{title}:")
+        print(f"  проверка, новые ключи:   {distinct:8.0f} нс")
+        print(f"  проверка, один ключ:     {repeated:8.0f} нс")
+        print(f"  память на {args.keys} ключей: {memory / 1024 / 1024:6.1f} МБ ({memory / args.keys:.0f} Б/ключ)")
+
+    limiter = RateLimiter(3, 300, name="bench")
+    for key in keys:
+        limiter.is_allowed(key)
+    started = time.perf_counter()
+    removed = limiter.sweep(time.monotonic() + 301)
+    print(f"очистка {removed} неактивных ключей: {(time.perf_counter() - started) * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
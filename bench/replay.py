@@ -0,0 +1,471 @@
+# bench/replay.py
+"""
+Офлайн-бенчмарк бота под нагрузкой.
+
+Настоящий Application из main.build_application() получает поток обновлений
+через update_queue (как в режиме webhook), а Telegram Bot API, Gemini и
+Safe Browsing заменены локальными заглушками (bench.fake_bot_api,
+bench.fake_gemini, bench.fake_safe_browsing) с настраиваемой задержкой.
+Каждый сценарий выполняется в отдельном процессе с чистым состоянием.
+
+Сценарии: private_ai (личные запросы к ИИ), group_alo (всплеск "ало" в
+группах), link_flood (поток ссылок), join_raid (волна заявок), font
+(диалог /font), web_app_art (арты из Web App), mixed (все вместе) или
+записанный поток — JSONL с объектами Update (--replay файл).
+
+Отчет: пропускная способность, p50/p99 по обработчикам, задержки цикла
+событий и число вызовов Bot API; --check сравнивает с эталоном.
+
+    python -m bench.replay                                   # все сценарии
+    python -m bench.replay --scenario group_alo --updates 500 --gemini-latency 1
+    python -m bench.replay --replay updates.jsonl
+    python -m bench.replay --dump mixed > updates.jsonl      # поток для правки и повтора
+    python -m bench.replay --check | --update-baseline       # bench/baselines/replay.json
+
+Лимиты Telegram и Gemini по умолчанию сняты — меряется сам бот, а не квоты;
+--real-limits оставляет рабочие значения.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'bench', 'baselines', 'replay.json')
+
+CLUB_CHAT_ID = -1009999  # TELEGRAM_CHAT_ID: членство проверяется в этом чате
+GROUP_IDS = [-1002001, -1002002, -1002003, -1002004]
+EVIL_HOST = 'evil.example'
+
+_message_ids = itertools.count(1)
+
+# Лимиты, которые снимаются без --real-limits
+NO_LIMITS = {name: '1000000000' for name in (
+    'GEMINI_RPM', 'GEMINI_BURST', 'GEMINI_RPD', 'GEMINI_CHAT_RPM', 'GEMINI_CHAT_BURST',
+    'GEMINI_USER_RPM', 'GEMINI_USER_BURST', 'AI_QUEUE_SIZE', 'AI_QUEUE_PER_USER',
+    'OUTBOUND_GLOBAL_RPS', 'OUTBOUND_GLOBAL_BURST', 'OUTBOUND_GROUP_RPM', 'OUTBOUND_GROUP_BURST',
+    'OUTBOUND_PRIVATE_RPM', 'OUTBOUND_PRIVATE_BURST',
+)}
+
+
+# ========================================
+# СЦЕНАРИИ
+# ========================================
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _private(user_id: int) -> dict:
+    return {"id": user_id, "type": "private", "first_name": f"user{user_id}"}
+
+
+def _group(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "supergroup", "title": f"group{chat_id}"}
+
+
+def _message(chat: dict, user_id: int, text: str = None, **extra) -> dict:
+    message = {"message_id": next(_message_ids), "date": int(time.time()), "chat": chat,
+               "from": _user(user_id)}
+    if text is not None:
+        message["text"] = text
+    message.update(extra)
+    return {"message": message}
+
+
+def private_ai(count: int, rng: random.Random) -> List[dict]:
+    return [_message(_private(10_000 + i % 50), 10_000 + i % 50, f"питання {i}: що таке {rng.random():.6f}?")
+            for i in range(count)]
+
+
+def group_alo(count: int, rng: random.Random) -> List[dict]:
+    updates = []
+    for i in range(count):
+        # Как в живой группе: среди сообщений с "ало" — обычная болтовня
+        text = f"ало, скажи {i} {rng.random():.6f}" if i % 2 == 0 else f"просто повідомлення {i}"
+        updates.append(_message(_group(rng.choice(GROUP_IDS)), 20_000 + rng.randrange(200), text))
+    return updates
+
+
+def link_flood(count: int, rng: random.Random) -> List[dict]:
+    updates = []
+    for i in range(count):
+        url = f"http://{EVIL_HOST}/x{i}" if i % 10 == 0 else f"https://site{rng.randrange(100)}.example/p{i}"
+        text = f"глянь {url}"
+        entities = [{"type": "url", "offset": text.index(url), "length": len(url)}]
+        updates.append(_message(_group(rng.choice(GROUP_IDS)), 30_000 + rng.randrange(500), text,
+                                entities=entities))
+    return updates
+
+
+def join_raid(count: int, rng: random.Random) -> List[dict]:
+    return [{"chat_join_request": {"chat": _group(GROUP_IDS[0]), "from": _user(40_000 + i),
+                                   "user_chat_id": 40_000 + i, "date": int(time.time())}}
+            for i in range(count)]
+
+
+def font(count: int, rng: random.Random) -> List[dict]:
+    updates = []
+    for i in range(max(1, count // 2)):
+        user_id = 50_000 + i
+        updates.append(_message(_private(user_id), user_id, "/font",
+                                entities=[{"type": "bot_command", "offset": 0, "length": 5}]))
+        updates.append(_message(_private(user_id), user_id, f"hello world {i}"))
+    return updates
+
+
+def _art_payloads(variants: int, rng: random.Random) -> List[str]:
+    from PIL import Image
+    payloads = []
+    for _ in range(variants):
+        image = Image.new('RGBA', (256, 256))
+        image.putdata([(rng.randrange(256), x % 256, y % 256, 255) for y in range(256) for x in range(256)])
+        output = io.BytesIO()
+        image.save(output, 'PNG')
+        payloads.append(base64.b64encode(output.getvalue()).decode())
+    return payloads
+
+
+def web_app_art(count: int, rng: random.Random) -> List[dict]:
+    # Половина артов — повторы: проверяет и пул процессов, и дедупликацию хранилища
+    payloads = _art_payloads(max(1, count // 2), rng)
+    updates = []
+    for i in range(count):
+        user_id = 60_000 + i % 20
+        data = f"ART|art{i}|{payloads[i % len(payloads)]}"
+        updates.append(_message(_private(user_id), user_id, web_app_data={"data": data, "button_text": "paint"}))
+    return updates
+
+
+def mixed(count: int, rng: random.Random) -> List[dict]:
+    parts = [private_ai, group_alo, link_flood, join_raid, font, web_app_art]
+    updates = [u for part in parts for u in part(max(2, count // len(parts)), rng)]
+    rng.shuffle(updates)
+    return updates
+
+
+SCENARIOS: Dict[str, Callable[[int, random.Random], List[dict]]] = {
+    'private_ai': private_ai,
+    'group_alo': group_alo,
+    'link_flood': link_flood,
+    'join_raid': join_raid,
+    'font': font,
+    'web_app_art': web_app_art,
+    'mixed': mixed,
+}
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# ========================================
+# ЗАПУСК СЦЕНАРИЯ (в дочернем процессе)
+# ========================================
+class StallMonitor:
+    """Просыпается каждые interval секунд; опоздание больше threshold считается задержкой цикла."""
+
+    def __init__(self, interval: float = 0.005, threshold: float = 0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_stall = 0.0
+        self.total_stall = 0.0
+        self.stalls = 0
+        self.task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.max_stall = max(self.max_stall, lag)
+            if lag > self.threshold:
+                self.total_stall += lag
+                self.stalls += 1
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _configure_env(args, bot_port: int, safe_port: int, workdir: str) -> None:
+    # Модули бота читают настройки при импорте — окружение задается до него
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123:bench',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{bot_port}',
+        'TELEGRAM_CHAT_ID': str(CLUB_CHAT_ID),
+        'GEMINI_API_KEY': 'bench',
+        'GOOGLE_SAFE_BROWSING_API_KEY': 'bench',
+        'GOOGLE_SAFE_BROWSING_API_ROOT': f'http://127.0.0.1:{safe_port}/v4',
+        'SAFE_BROWSING_MODE': 'lookup',
+        'PERSISTENCE_PATH': '',
+        'ART_STORE_PATH': os.path.join(workdir, 'art_store'),
+        'TRIGGERS_PATH': os.path.join(workdir, 'triggers.json'),
+        'AI_CONTEXT_CACHE_MIN_TOKENS': '0',
+        'WELCOME_DEBOUNCE': '0.2',
+        'WELCOME_MAX_DELAY': '1',
+    })
+    for name in ('WEBHOOK_URL', 'AI_CACHE_PATH'):
+        os.environ.pop(name, None)
+    if not args.real_limits:
+        os.environ.update(NO_LIMITS)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _is_stub_task(task: asyncio.Task) -> bool:
+    # Соединения заглушек (aiohttp держит keep-alive) — не работа бота
+    return getattr(task.get_coro(), '__qualname__', '').startswith('RequestHandler.')
+
+
+async def _wait_idle(application, total: int, background: Callable[[], set], timeout: float) -> None:
+    """Ждет, пока все обновления обработаны и не осталось фоновой работы (ИИ, отправки, приветствия)."""
+    import handlers
+    baseline = set(asyncio.all_tasks())
+    deadline = time.perf_counter() + timeout
+    quiet = 0
+    busy = set()
+    while quiet < 2:
+        if time.perf_counter() > deadline:
+            # Иначе application.stop() будет вечно ждать зависший обработчик
+            for task in busy:
+                task.cancel()
+            raise TimeoutError(f"за {timeout} сек. обработано {application.update_processor.processed} из {total}, "
+                               f"не завершены: {sorted(task.get_coro().__qualname__ for task in busy)}")
+        await asyncio.sleep(0.01)
+        busy = {t for t in asyncio.all_tasks() - baseline - background() - {asyncio.current_task()}
+                if not _is_stub_task(t)}
+        idle = (application.update_processor.processed >= total and application.update_queue.empty()
+                and not busy and not handlers.welcome_batcher._pending)
+        quiet = quiet + 1 if idle else 0
+
+
+async def run_scenario(args, updates: List[dict], name: str) -> dict:
+    workdir = tempfile.mkdtemp(prefix='morstrix-bench-')
+    bot_port, safe_port = _free_port(), _free_port()
+    _configure_env(args, bot_port, safe_port, workdir)
+
+    import logging
+    from bench.fake_bot_api import FakeBotApi
+    from bench.fake_safe_browsing import FakeSafeBrowsing
+    from bench.fake_gemini import install as install_gemini
+
+    api = FakeBotApi(latency=args.bot_api_latency)
+    api_runner, _ = await api.start(bot_port)
+    safe_browsing = FakeSafeBrowsing([f"{EVIL_HOST}/"], latency=args.safe_browsing_latency)
+    safe_runner = await safe_browsing.start(port=safe_port)
+
+    import main
+    import ai
+    import metrics
+    import outbound
+    import ratelimit
+    from telegram import Update
+    logging.getLogger().setLevel(args.log_level)
+
+    application = main.build_application(os.environ['TELEGRAM_BOT_TOKEN'])
+    gemini = install_gemini(args.gemini_latency)
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    observe = metrics.handler_latency.observe
+
+    def record(value, *labels):
+        samples[labels[0] if labels else ''].append(value)
+        observe(value, *labels)
+
+    metrics.handler_latency.observe = record
+
+    monitor = StallMonitor()
+    try:
+        await application.initialize()
+        await application.start()
+        monitor.start()
+
+        def background():
+            return {t for t in (ai.scheduler._worker, outbound.scheduler._worker, ratelimit._sweeper, monitor.task)
+                    if t is not None}
+
+        started = time.perf_counter()
+        for number, data in enumerate(updates, 1):
+            await application.update_queue.put(Update.de_json(dict(data, update_id=number), application.bot))
+            if args.rate:
+                await asyncio.sleep(max(0.0, started + number / args.rate - time.perf_counter()))
+        await _wait_idle(application, len(updates), background, args.timeout)
+        elapsed = time.perf_counter() - started
+    finally:
+        await monitor.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await api_runner.cleanup()
+        await safe_runner.cleanup()
+
+    return {
+        'scenario': name,
+        'updates': len(updates),
+        'seconds': elapsed,
+        'throughput': len(updates) / elapsed,
+        'handlers': {
+            handler: {'count': len(values), 'p50_ms': _percentile(values, 0.5) * 1000,
+                      'p99_ms': _percentile(values, 0.99) * 1000}
+            for handler, values in sorted(samples.items())
+        },
+        'loop': {'max_stall_ms': monitor.max_stall * 1000, 'stall_ms': monitor.total_stall * 1000,
+                 'stalls': monitor.stalls},
+        'api_calls': dict(Counter(method for method, _, _ in api.calls)),
+        'gemini_calls': gemini.calls,
+    }
+
+
+# ========================================
+# ОТЧЕТ И СРАВНЕНИЕ С ЭТАЛОНОМ
+# ========================================
+def _print_report(result: dict) -> None:
+    loop = result['loop']
+    print(f"\n{result['scenario']}: {result['updates']} обновлений за {result['seconds']:.2f} сек. — "
+          f"{result['throughput']:.1f} обн./сек; цикл событий: max {loop['max_stall_ms']:.1f} мс, "
+          f"задержки {loop['stall_ms']:.0f} мс ({loop['stalls']} раз)")
+    for handler, stats in result['handlers'].items():
+        print(f"  {handler:<16} {stats['count']:6d}  p50 {stats['p50_ms']:8.1f} мс  p99 {stats['p99_ms']:8.1f} мс")
+    calls = ', '.join(f"{method} {count}" for method, count in sorted(result['api_calls'].items()))
+    print(f"  Bot API: {calls}; Gemini: {result['gemini_calls']}")
+
+
+def _summary(result: dict) -> dict:
+    return {
+        'throughput': round(result['throughput'], 2),
+        'p99_ms': round(max((s['p99_ms'] for s in result['handlers'].values()), default=0.0), 1),
+        'max_stall_ms': round(result['loop']['max_stall_ms'], 1),
+    }
+
+
+def _check(results: List[dict], baseline: dict, tolerance: float) -> bool:
+    ok = True
+    print(f"\nсравнение с эталоном (допуск {tolerance:.0%}):")
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None:
+            print(f"  {result['scenario']}: нет в эталоне")
+            continue
+        current = _summary(result)
+        problems = []
+        if current['throughput'] < base['throughput'] * (1 - tolerance):
+            problems.append(f"пропускная способность {current['throughput']} < {base['throughput']}")
+        # Небольшой абсолютный запас: на миллисекундах шум больше допуска
+        if current['p99_ms'] > base['p99_ms'] * (1 + tolerance) + 5:
+            problems.append(f"p99 {current['p99_ms']} мс > {base['p99_ms']} мс")
+        if current['max_stall_ms'] > base['max_stall_ms'] * (1 + tolerance) + 20:
+            problems.append(f"задержка цикла {current['max_stall_ms']} мс > {base['max_stall_ms']} мс")
+        ok = ok and not problems
+        print(f"  {result['scenario']}: {'; '.join(problems) if problems else 'OK'}")
+    return ok
+
+
+def _child_args(args) -> List[str]:
+    return ['--updates', str(args.updates), '--seed', str(args.seed), '--rate', str(args.rate),
+            '--bot-api-latency', str(args.bot_api_latency), '--gemini-latency', str(args.gemini_latency),
+            '--safe-browsing-latency', str(args.safe_browsing_latency), '--timeout', str(args.timeout),
+            '--log-level', args.log_level] + (['--real-limits'] if args.real_limits else [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="по умолчанию — все")
+    parser.add_argument("--replay", help="JSONL с объектами Update вместо сценария")
+    parser.add_argument("--updates", type=int, default=200, help="обновлений в сценарии")
+    parser.add_argument("--rate", type=float, default=0, help="обновлений в секунду (0 — все сразу)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bot-api-latency", type=float, default=0.02, help="задержка Bot API, сек")
+    parser.add_argument("--gemini-latency", type=float, default=0.3, help="время ответа Gemini, сек")
+    parser.add_argument("--safe-browsing-latency", type=float, default=0.05, help="задержка Safe Browsing, сек")
+    parser.add_argument("--real-limits", action="store_true", help="не снимать лимиты Telegram и Gemini")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="печатать результаты в JSON")
+    parser.add_argument("--check", action="store_true", help="код выхода 1 при регрессии")
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--dump", choices=sorted(SCENARIOS), help="напечатать поток сценария в JSONL и выйти")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.dump:
+        for update in SCENARIOS[args.dump](args.updates, random.Random(args.seed)):
+            print(json.dumps(update, ensure_ascii=False))
+        return
+
+    if args.child:
+        if args.child == 'replay':
+            updates = load_updates(args.replay)
+        else:
+            updates = SCENARIOS[args.child](args.updates, random.Random(args.seed))
+        result = asyncio.run(run_scenario(args, updates, args.child))
+        print(json.dumps(result))
+        return
+
+    names = ['replay'] if args.replay else (args.scenario or list(SCENARIOS))
+    results = []
+    for name in names:
+        command = [sys.executable, '-m', 'bench.replay', '--child', name] + _child_args(args)
+        if args.replay:
+            command += ['--replay', os.path.abspath(args.replay)]
+        completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"{name}: ошибка\n{completed.stderr[-3000:]}", file=sys.stderr)
+            sys.exit(2)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results.append(result)
+        if not args.json:
+            _print_report(result)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as file:
+                baseline = json.load(file)
+        baseline.update({result['scenario']: _summary(result) for result in results})
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f"\nэталон записан в {args.baseline}")
+    elif args.check:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        if not _check(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# bench/shard.py
+"""
+Шардирование (shard.py): равномерность консистентного хеша, доля чатов,
+переезжающих на другой воркер при добавлении воркера, и стоимость операции
+общего ограничителя (shared_state) против локального.
+
+    python -m bench.shard [--chats 100000] [--workers 2,4,8]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+
+from ratelimit import RateLimiter
+from shard import HashRing
+from shared_state import SharedState
+
+
+def _ring(count):
+    return HashRing([f"worker-{i}" for i in range(count)])
+
+
+def _per_op_us(limiter, operations):
+    started = time.perf_counter()
+    for i in range(operations):
+        limiter.try_acquire(i % 1000)
+    return (time.perf_counter() - started) / operations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--workers", default="2,4,8")
+    parser.add_argument("--operations", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    # Группы — отрицательные id, личные чаты — положительные
+    chats = [rng.choice((-1, 1)) * rng.randrange(10 ** 6, 10 ** 13) for _ in range(args.chats)]
+
+    for count in (int(n) for n in args.workers.split(',')):
+        ring, grown = _ring(count), _ring(count + 1)
+        load = Counter(ring.node_for(chat) for chat in chats)
+        moved = sum(1 for chat in chats if ring.node_for(chat) != grown.node_for(chat))
+        spread = max(load.values()) / (len(chats) / count)
+        print(f"{count} воркеров: самый загруженный — {spread:.2f}× среднего; "
+              f"при {count + 1}-м переезжает {moved / len(chats):.1%} чатов (идеал {1 / (count + 1):.1%})")
+
+    local = RateLimiter(1000, 1.0, name='bench_local')
+    shared = RateLimiter(1000, 1.0, name='bench_shared')
+    with tempfile.TemporaryDirectory() as directory:
+        shared.shared = SharedState(os.path.join(directory, 'shared.sqlite3'))
+        local_us = _per_op_us(local, args.operations)
+        shared_us = _per_op_us(shared, args.operations)
+        shared.shared.close()
+    print(f"try_acquire: локальный {local_us:.2f} мкс, общий (SQLite) {shared_us:.1f} мкс")
+
+
+if __name__ == "__main__":
+    main()
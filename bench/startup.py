@@ -0,0 +1,131 @@
+# bench/startup.py
+"""
+Регрессионный бенчмарк холодного старта: запускает main.py в отдельном
+процессе против заглушки Bot API (bench.fake_bot_api) и измеряет время от
+запуска процесса до обработки первого обновления, а также фазы из
+профиля запуска (startup.py).
+
+    python -m bench.startup [--runs 5]
+    python -m bench.startup --check            # сравнить с bench/baselines/startup.json
+    python -m bench.startup --update-baseline  # записать новый эталон
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict
+
+from bench.fake_bot_api import FakeBotApi, group_message
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'bench', 'baselines', 'startup.json')
+FIRST_UPDATE = re.compile(r'Первое обновление обработано через ([\d.]+) сек')
+PHASE = re.compile(r'^  (\S.*?)\s+([\d.]+) мс$')
+READY = 'готов принимать обновления'  # последняя строка профиля запуска
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _run_once(timeout: float) -> Dict[str, float]:
+    api = FakeBotApi()
+    api.push(group_message("привіт"))
+    runner, port = await api.start()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(
+            os.environ,
+            TELEGRAM_BOT_TOKEN='123:bench',
+            TELEGRAM_API_URL=f'http://127.0.0.1:{port}',
+            PORT=str(_free_port()),
+            PYTHONPATH=ROOT,
+            PERSISTENCE_PATH='',
+            ART_STORE_PATH=os.path.join(workdir, 'art_store'),
+        )
+        for name in ('WEBHOOK_URL', 'BOT_MODE', 'GEMINI_API_KEY', 'SAFE_BROWSING_MODE'):
+            env.pop(name, None)
+        # Рабочий каталог — пустой, чтобы не подхватить .env разработчика
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, 'main.py'), cwd=workdir, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        )
+        result: Dict[str, float] = {}
+        try:
+            deadline = started + timeout
+            while 'first_update' not in result or READY not in result:
+                line = await asyncio.wait_for(process.stdout.readline(), timeout=max(0.1, deadline - time.perf_counter()))
+                if not line:
+                    raise RuntimeError("main.py завершился до первого обновления")
+                text = line.decode(errors='replace').rstrip()
+                phase = PHASE.match(text)
+                if phase:
+                    result[phase.group(1)] = float(phase.group(2)) / 1000
+                match = FIRST_UPDATE.search(text)
+                if match:
+                    result['first_update'] = time.perf_counter() - started
+                    result['first_update_in_process'] = float(match.group(1))
+            if api.updates_served:
+                result['first_getUpdates'] = api.updates_served[0][1] - started
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+            await runner.cleanup()
+    return result
+
+
+def _median(runs, key):
+    values = [run[key] for run in runs if key in run]
+    return statistics.median(values) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--check", action="store_true", help="код выхода 1, если медленнее эталона")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимое замедление (доля)")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args()
+
+    runs = [asyncio.run(_run_once(args.timeout)) for _ in range(args.runs)]
+    keys = list(dict.fromkeys(key for run in runs for key in run))
+    summary = {key: _median(runs, key) for key in keys}
+    print(f"медиана по {args.runs} запускам:")
+    for key, value in summary.items():
+        print(f"  {key:<28} {value * 1000:8.1f} мс")
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump({'first_update': round(summary['first_update'], 3)}, file, indent=2)
+            file.write('\n')
+        print(f"эталон записан в {args.baseline}")
+    elif args.check:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)['first_update']
+        limit = baseline * (1 + args.tolerance)
+        verdict = "OK" if summary['first_update'] <= limit else "РЕГРЕССИЯ"
+        print(f"первое обновление: {summary['first_update'] * 1000:.0f} мс, эталон {baseline * 1000:.0f} мс "
+              f"(+{args.tolerance:.0%} = {limit * 1000:.0f} мс): {verdict}")
+        if verdict != "OK":
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# bench/triggers.py
+"""
+Микро-бенчмарк triggers.TriggerEngine (str.find или автомат — по числу фраз)
+против отдельного filters.Regex на каждый триггер (как раньше был устроен
+триггер "ало"): стоимость проверки одного сообщения в зависимости от числа
+настроенных триггеров.
+
+    python -m bench.triggers [--messages 2000] [--triggers 10,100,500]
+"""
+
+import argparse
+import random
+import re
+import time
+
+from triggers import AhoCorasick, Trigger, TriggerEngine
+
+ALPHABET = 'абвгдежзийклмнопрстуфхцчшщыьэюяabcdefghijklmnopqrstuvwxyz'
+
+
+def _word(rng, length):
+    return ''.join(rng.choice(ALPHABET) for _ in range(length))
+
+
+def _messages(rng, count):
+    # Обычные сообщения группы: 5–40 слов, изредка "ало"
+    messages = []
+    for _ in range(count):
+        words = [_word(rng, rng.randint(2, 9)) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.05:
+            words.insert(rng.randrange(len(words)), 'Ало')
+        messages.append(' '.join(words))
+    return messages
+
+
+def _per_message_us(check, messages):
+    started = time.perf_counter()
+    for text in messages:
+        check(text)
+    return (time.perf_counter() - started) / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--triggers", default="1,10,100,500")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    messages = _messages(rng, args.messages)
+
+    for count in (int(n) for n in args.triggers.split(',')):
+        phrases = ['ало'] + [_word(rng, rng.randint(4, 10)) for _ in range(count - 1)]
+        regexes = [re.compile(f"(?i){re.escape(p)}") for p in phrases]
+        engine = TriggerEngine([Trigger(p, 'ai') for p in phrases])
+        engine.match('')  # сборка автомата не входит в замер
+
+        def regex_check(text):
+            return [r for r in regexes if r.search(text)]
+
+        regex_us = _per_message_us(regex_check, messages)
+        engine_us = _per_message_us(engine.match, messages)
+        kind = 'Ахо — Корасик' if isinstance(engine._automaton, AhoCorasick) else 'str.find'
+        print(f"{count:4d} триггеров: regex на каждый {regex_us:8.1f} мкс, "
+              f"TriggerEngine ({kind}) {engine_us:8.1f} мкс на сообщение")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+# config.py
+"""
+Общие настройки из окружения и .env.
+
+.env загружается один раз — при первом импорте этого модуля; main.py
+импортирует его раньше всех остальных, поэтому os.getenv в модулях бота
+уже видит значения из .env. Здесь — только настройки, нужные нескольким
+модулям; остальные по-прежнему читаются рядом с кодом, который их использует.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка из bench), например http://127.0.0.1:8081
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес сервиса, например https://bot.koyeb.app
+# webhook — обновления приходят на HTTP сервер, polling — бот сам опрашивает Telegram
+BOT_MODE = os.getenv('BOT_MODE', 'webhook' if WEBHOOK_URL else 'polling').lower()
+
+# Шардирование (shard.py): фронт раздает обновления воркерам по хешу чата.
+# SHARD_WORKERS — сколько воркеров запустить на этой машине, SHARD_WORKER_URLS — адреса
+# воркеров на других машинах; SHARD_ROLE=worker фронт задает запущенным им процессам
+SHARD_ROLE = os.getenv('SHARD_ROLE', '').lower()
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 0))
+SHARD_WORKER_URLS = [url.strip().rstrip('/') for url in os.getenv('SHARD_WORKER_URLS', '').split(',') if url.strip()]
@@ -1,4 +1,15 @@
 # font_utils.py
+"""
+Стильний текст: каталог шрифтів на попередньо скомпільованих таблицях str.translate.
+
+Кожен стиль — одна таблиця {код символу: заміна}, тож перетворення — це один
+виклик text.translate(table) без циклу по символах у Python.
+Стилі з cyrillic=True покривають усю кирилицю (укр./рос./біл.), решта
+змінюють лише латиницю й цифри — кириличні літери в них лишаються як є.
+"""
+
+from typing import Dict, List, NamedTuple, Optional
+
 
 # Словник для заміни кириличних та латинських символів на Small Caps або схожі символи
 FONT_MAP = {
@@ -47,19 +58,117 @@ FONT_MAP = {
 }
 
 
-def convert_text_to_font(text: str) -> str:
+# Кирилиця, яку мають покривати стилі з cyrillic=True
+CYRILLIC_UPPER = "АБВГҐДЕЁЄЖЗИІЇЙКЛМНОПРСТУЎФХЦЧШЩЪЫЬЭЮЯ"
+CYRILLIC_LOWER = "абвгґдеёєжзиіїйклмнопрстуўфхцчшщъыьэюя"
+LATIN_UPPER = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+LATIN_LOWER = "abcdefghijklmnopqrstuvwxyz"
+DIGITS = "0123456789"
+
+
+class FontStyle(NamedTuple):
+    key: str
+    title: str
+    table: Dict[int, str]
+    cyrillic: bool  # покриває всю кирилицю
+
+    def apply(self, text: str) -> str:
+        return text.translate(self.table)
+
+
+def _small_caps_table() -> Dict[int, str]:
+    mapping = dict(FONT_MAP)
+    # Решта кирилиці: великі літери — малими (малі кириличні й так виглядають як капітель)
+    for upper, lower in zip(CYRILLIC_UPPER, CYRILLIC_LOWER):
+        mapping.setdefault(upper, lower)
+    return str.maketrans(mapping)
+
+
+def _alphabet_table(upper: int, lower: Optional[int] = None, digits: Optional[int] = None,
+                    exceptions: Optional[Dict[str, str]] = None) -> Dict[int, str]:
+    """Таблиця для блоку Mathematical Alphanumeric Symbols (літери йдуть підряд від upper/lower)."""
+    mapping = {c: chr(upper + i) for i, c in enumerate(LATIN_UPPER)}
+    if lower is not None:
+        mapping.update({c: chr(lower + i) for i, c in enumerate(LATIN_LOWER)})
+    if digits is not None:
+        mapping.update({c: chr(digits + i) for i, c in enumerate(DIGITS)})
+    # "Дірки" в блоці: ці літери були в Unicode раніше (Letterlike Symbols)
+    mapping.update(exceptions or {})
+    return str.maketrans(mapping)
+
+
+def _combining_table(mark: str) -> Dict[int, str]:
+    """Додає комбінований знак (закреслення, підкреслення) до кожної літери й цифри."""
+    chars = LATIN_UPPER + LATIN_LOWER + DIGITS + CYRILLIC_UPPER + CYRILLIC_LOWER
+    chars += "".join(chr(c) for c in range(0x0400, 0x0500) if chr(c).isalpha())
+    return str.maketrans({c: c + mark for c in set(chars)})
+
+
+def _fullwidth_table() -> Dict[int, str]:
+    mapping = {chr(c): chr(c - 0x21 + 0xFF01) for c in range(0x21, 0x7F)}
+    mapping[' '] = '\u3000'
+    return str.maketrans(mapping)
+
+
+def _circled_table() -> Dict[int, str]:
+    mapping = {c: chr(0x24B6 + i) for i, c in enumerate(LATIN_UPPER)}
+    mapping.update({c: chr(0x24D0 + i) for i, c in enumerate(LATIN_LOWER)})
+    mapping.update({c: chr(0x2460 + i) for i, c in enumerate(DIGITS[1:])})
+    mapping['0'] = '\u24EA'
+    return str.maketrans(mapping)
+
+
+FONT_STYLES: Dict[str, FontStyle] = {style.key: style for style in (
+    FontStyle('smallcaps', 'ᴍᴏʀꜱᴛʀɪx', _small_caps_table(), True),
+    FontStyle('bold', 'Bold', _alphabet_table(0x1D400, 0x1D41A, 0x1D7CE), False),
+    FontStyle('italic', 'Italic', _alphabet_table(0x1D434, 0x1D44E, exceptions={'h': 'ℎ'}), False),
+    FontStyle('bold_italic', 'Bold Italic', _alphabet_table(0x1D468, 0x1D482), False),
+    FontStyle('sans_bold', 'Sans Bold', _alphabet_table(0x1D5D4, 0x1D5EE, 0x1D7EC), False),
+    FontStyle('script', 'Script', _alphabet_table(0x1D49C, 0x1D4B6, exceptions={
+        'B': 'ℬ', 'E': 'ℰ', 'F': 'ℱ', 'H': 'ℋ', 'I': 'ℐ', 'L': 'ℒ', 'M': 'ℳ', 'R': 'ℛ',
+        'e': 'ℯ', 'g': 'ℊ', 'o': 'ℴ',
+    }), False),
+    FontStyle('fraktur', 'Fraktur', _alphabet_table(0x1D504, 0x1D51E, exceptions={
+        'C': 'ℭ', 'H': 'ℌ', 'I': 'ℑ', 'R': 'ℜ', 'Z': 'ℨ',
+    }), False),
+    FontStyle('double', 'Double-struck', _alphabet_table(0x1D538, 0x1D552, 0x1D7D8, exceptions={
+        'C': 'ℂ', 'H': 'ℍ', 'N': 'ℕ', 'P': 'ℙ', 'Q': 'ℚ', 'R': 'ℝ', 'Z': 'ℤ',
+    }), False),
+    FontStyle('monospace', 'Monospace', _alphabet_table(0x1D670, 0x1D68A, 0x1D7F6), False),
+    FontStyle('fullwidth', 'Ｆｕｌｌｗｉｄｔｈ', _fullwidth_table(), False),
+    FontStyle('circled', 'Ⓒⓘⓡⓒⓛⓔⓓ', _circled_table(), False),
+    FontStyle('strike', 'З̶а̶к̶р̶е̶с̶л̶е̶н̶н̶я̶', _combining_table('\u0336'), True),
+    FontStyle('underline', 'П̲і̲д̲к̲р̲е̲с̲л̲е̲н̲н̲я̲', _combining_table('\u0332'), True),
+)}
+
+DEFAULT_STYLE = 'smallcaps'
+
+
+def has_cyrillic(text: str) -> bool:
+    return any('\u0400' <= char <= '\u04FF' for char in text)
+
+
+def styles_for(text: str) -> List[FontStyle]:
+    """Стилі в порядку показу: для кириличного тексту спершу ті, що покривають кирилицю."""
+    styles = list(FONT_STYLES.values())
+    if has_cyrillic(text):
+        styles.sort(key=lambda style: not style.cyrillic)
+    return styles
+
+
+def stylize(text: str, style: str = DEFAULT_STYLE) -> str:
+    """Перетворює текст стилем style (ключ FONT_STYLES)."""
+    return text.translate(FONT_STYLES[style].table)
+
+
+def convert_text_to_font(text: str, style: str = DEFAULT_STYLE) -> str:
     """
-    Перетворює текст за FONT_MAP і повертає готовий моноширинний блок,
-    який у Telegram має кнопку «Копіювати».
+    Перетворює текст стилем style і повертає готовий моноширинний блок
+    (MarkdownV2), який у Telegram має кнопку «Копіювати».
     """
-    converted = ""
-    for char in text:
-        if char in FONT_MAP:
-            converted += FONT_MAP[char]
-        elif char.upper() in FONT_MAP:
-            converted += FONT_MAP[char.upper()]
-        else:
-            converted += char
+    converted = stylize(text, style)
+    # Усередині блоку коду MarkdownV2 треба екранувати лише ` і \\
+    converted = converted.replace('\\', '\\\\').replace('`', '\\`')
 
     # Готовий блок коду
-    return f"```\n{converted}\n```"
\ No newline at end of file
+    return f"```\n{converted}\n```"
@@ -1,51 +1,56 @@
 import os
 import json
-import base64
+import time
+import asyncio
 import logging
 import re
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from collections import OrderedDict
+from contextlib import ExitStack
+from telegram import (
+    Update, InlineKeyboardMarkup, InlineKeyboardButton,
+    InlineQueryResultArticle, InputTextMessageContent, InputFile
+)
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
 from telegram.error import Forbidden, BadRequest, NetworkError
-from dotenv import load_dotenv
 
-from font_utils import convert_text_to_font
+import config  # .env загружен до чтения настроек ниже
+from font_utils import convert_text_to_font, styles_for
+import outbound
+from art import ArtError, process_art_async, safe_filename
+from art_store import art_store
+from ai import note_club_member
+from ratelimit import RateLimiter
 
 # ========================================
 # RATE LIMITER
 # ========================================
-class RateLimiter:
-    def __init__(self, max_requests=3, period=300):  # 3 запроса за 5 минут
-        self.requests = {}
-        self.max_requests = max_requests
-        self.period = period
-    
-    def is_allowed(self, user_id):
-        now = datetime.now()
-        if user_id not in self.requests:
-            self.requests[user_id] = []
-        
-        self.requests[user_id] = [
-            req_time for req_time in self.requests[user_id]
-            if now - req_time < timedelta(seconds=self.period)
-        ]
-        
-        if len(self.requests[user_id]) >= self.max_requests:
-            return False
-        
-        self.requests[user_id].append(now)
-        return True
-
-join_request_limiter = RateLimiter()
+join_request_limiter = RateLimiter(max_requests=3, period=300, name='join_requests')  # 3 запроса за 5 минут
+font_limiter = RateLimiter(max_requests=5, period=60, name='font')  # 5 /font в минуту
 
 # ========================================
 # КОНСТАНТЫ
 # ========================================
 FONT_TEXT = 0
 
-if os.getenv("RENDER") != "true":
-    load_dotenv()
+# Пакетные приветствия: новички чата за окно собираются в одно сообщение
+WELCOME_DEBOUNCE = float(os.getenv('WELCOME_DEBOUNCE', 3))  # тишина после последнего новичка, сек
+WELCOME_MAX_DELAY = float(os.getenv('WELCOME_MAX_DELAY', 10))  # не дольше этого с первого новичка, сек
+WELCOME_MAX_NAMES = int(os.getenv('WELCOME_MAX_NAMES', 30))  # имен в одном приветствии
+WELCOME_DEDUP_TTL = float(os.getenv('WELCOME_DEDUP_TTL', 300))  # не приветствовать повторно, сек
+# Сколько новичков в минуту чат приветствует сразу; сверх этого — рейд, приветствия собираются
+WELCOME_INSTANT_PER_MINUTE = float(os.getenv('WELCOME_INSTANT_PER_MINUTE', 3))
+
+# Inline-режим шрифтов: @бот текст в любом чате
+FONT_INLINE_CACHE_SIZE = int(os.getenv('FONT_INLINE_CACHE_SIZE', 512))  # запросов в кеше бота
+FONT_INLINE_CACHE_TIME = int(os.getenv('FONT_INLINE_CACHE_TIME', 3600))  # кеш на стороне Telegram, сек
+
+ONBOARDING_TEXT = (
+    "{name}! зᴀпит схвᴀʌᴇно.\n\n"
+    "шᴏ я ᴍᴏжу?\n\n➞ ᴀʙᴛᴏᴘᴘийᴏᴍ зᴀяʙᴏᴋ\n➞ ʙᴇʌᴋᴀᴍ з пᴘᴀʙиʌᴀᴍи\n➞ пᴇᴘᴇʙіᴘᴋᴀ пᴏᴄиʌᴀнь\n"
+    "➞ /font - ᴛᴇᴋᴄᴛ ᴄᴛᴀйʌᴇᴘ\n➞ ШІ — дʌя чʌᴇніʙ ᴋʌубу\n(ʙ чᴀᴛᴀх: ᴛᴘигᴇᴘ ᴀʌᴏ)\n\n"
+    "➞ ᴘᴀɪɴᴛ ᴀᴘᴘ (ᴘʀᴏᴛᴏᴛʏᴘᴇ)\nt.me/MORSTRIXBOT/paint"
+)
 
 logger = logging.getLogger(__name__)
 
@@ -61,24 +66,193 @@ async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE
     parts = data_string.split('|', 2)
 
     if len(parts) < 3:
-        await update.effective_message.reply_text("Помилка: Невірний формат даних.")
+        await outbound.reply_text(update.effective_message, "Помилка: Невірний формат даних.")
         return
 
     draft_type, full_item_key, base64_payload = parts
 
     if draft_type == 'ART':
+        user_id = update.effective_user.id if update.effective_user else None
+        # Этот ключ или тот же арт уже присылали — не декодируем и не пишем на диск повторно
+        stored = await art_store.find(full_item_key, base64_payload, user_id)
+        if stored is not None:
+            await _send_art(update.effective_message, full_item_key, stored)
+            return
+
+        # Декодирование и перекодирование — в пуле процессов, вне цикла событий
         try:
-            base64.b64decode(base64_payload, validate=True)
-            await update.effective_message.reply_text(
-                f"Арт (Ключ: `{full_item_key}`) прийнято!\n*Надіслано для обробки.*",
-                parse_mode=ParseMode.MARKDOWN
-            )
+            result = await process_art_async(base64_payload)
+        except ArtError as e:
+            await outbound.reply_text(update.effective_message, f"Помилка: {e}")
+            return
         except Exception as e:
-            await update.effective_message.reply_text("Помилка при обробці арту.")
+            await outbound.reply_text(update.effective_message, "Помилка при обробці арту.")
             logger.error(f"ART error: {e}")
+            return
+
+        stored = await art_store.put(full_item_key, base64_payload, result, user_id)
+        if stored is not None:
+            await _send_art(update.effective_message, full_item_key, stored)
+            return
+
+        # Хранилище выключено или недоступно — отправляем из памяти
+        await outbound.reply_document(
+            update.effective_message,
+            InputFile(result.image, filename=safe_filename(full_item_key, result.format)),
+            thumbnail=InputFile(result.thumbnail, filename='thumb.jpg'),
+            caption=_art_caption(full_item_key, result.width, result.height),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+
+def _art_caption(full_item_key, width, height):
+    return f"Арт (Ключ: `{full_item_key}`) оброблено ✅\n{width}×{height}"
+
+
+async def _send_art(message, full_item_key, stored):
+    """
+    Отправляет сохраненный арт: по file_id без загрузки, иначе передает открытый
+    файл HTTP-клиенту, который читает его по частям при отправке.
+    """
+    caption = _art_caption(full_item_key, stored.width, stored.height)
+    if stored.file_id:
+        try:
+            await outbound.reply_document(message, stored.file_id, caption=caption, parse_mode=ParseMode.MARKDOWN)
+            return
+        except BadRequest as e:
+            logger.warning(f"file_id арта {stored.sha256[:12]} недействителен: {e}")
+
+    with ExitStack() as files:
+        try:
+            image = files.enter_context(open(stored.path, 'rb'))
+            thumbnail = files.enter_context(open(stored.thumb_path, 'rb'))
+        except FileNotFoundError:
+            # Арт вытеснен из хранилища между поиском и отправкой
+            await outbound.reply_text(message, "Арт недоступний, надішли його ще раз.")
+            return
+        # Открытые файлы остаются доступны, даже если арт вытеснят во время отправки
+        sent = await outbound.reply_document(
+            message,
+            InputFile(image, filename=safe_filename(full_item_key, stored.format), read_file_handle=False),
+            thumbnail=InputFile(thumbnail, filename='thumb.jpg', read_file_handle=False),
+            caption=caption,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    if sent is not None and sent.document is not None:
+        await art_store.set_file_id(stored, sent.document.file_id)
 
 # ========================================
-# 2. Join Request Handler
+# 2. Пакетные приветствия
+# ========================================
+class _PendingWelcome:
+    __slots__ = ('bot', 'names', 'thread_id', 'first_at', 'timer')
+
+    def __init__(self, bot, thread_id, now):
+        self.bot = bot
+        self.names = []
+        self.thread_id = thread_id
+        self.first_at = now
+        self.timer = None
+
+
+class WelcomeBatcher:
+    """
+    Приветствует новичков чата (одобренные заявки и new_chat_members). В тихом
+    чате — сразу; если новички идут чаще instant_per_minute (рейд), собирает их
+    и через debounce секунд тишины — но не позже max_delay с первого —
+    отправляет одно приветствие со всеми именами и одной кнопкой правил.
+
+    Один и тот же пользователь в чате приветствуется не чаще раза в dedup_ttl:
+    одобрение заявки и следующее за ним new_chat_members дают одно приветствие.
+    """
+
+    def __init__(self, debounce=WELCOME_DEBOUNCE, max_delay=WELCOME_MAX_DELAY,
+                 max_names=WELCOME_MAX_NAMES, dedup_ttl=WELCOME_DEDUP_TTL,
+                 instant_per_minute=WELCOME_INSTANT_PER_MINUTE):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_names = max(1, max_names)
+        self.dedup_ttl = dedup_ttl
+        self._pending = {}
+        self._recent = OrderedDict()  # (chat_id, user_id) -> когда можно приветствовать снова
+        self._instant = None
+        if instant_per_minute > 0:
+            self._instant = RateLimiter.per_minute(instant_per_minute, instant_per_minute, name='welcome_instant')
+        self._tasks = set()
+        self.members = 0
+        self.messages = 0
+
+    def add(self, bot, chat_id, user_id, full_name, thread_id=None):
+        """Добавляет новичка в приветствие чата. Возвращает False, если он уже поприветствован."""
+        now = time.monotonic()
+        while self._recent and next(iter(self._recent.values())) <= now:
+            self._recent.popitem(last=False)
+        if (chat_id, user_id) in self._recent:
+            return False
+        self._recent[(chat_id, user_id)] = now + self.dedup_ttl
+
+        pending = self._pending.get(chat_id)
+        if pending is None and self._instant is not None and self._instant.try_acquire(chat_id, now):
+            # Обычный одиночный вход — без ожидания
+            pending = self._pending[chat_id] = _PendingWelcome(bot, thread_id, now)
+            pending.names.append(full_name)
+            self.members += 1
+            self._flush(chat_id)
+            return True
+        if pending is None:
+            pending = self._pending[chat_id] = _PendingWelcome(bot, thread_id, now)
+        elif pending.thread_id is None:
+            pending.thread_id = thread_id
+        pending.names.append(full_name)
+        self.members += 1
+
+        if pending.timer is not None:
+            pending.timer.cancel()
+        delay = min(self.debounce, pending.first_at + self.max_delay - now)
+        if len(pending.names) >= self.max_names or delay <= 0:
+            self._flush(chat_id)
+        else:
+            pending.timer = asyncio.get_running_loop().call_later(delay, self._flush, chat_id)
+        return True
+
+    def _flush(self, chat_id):
+        pending = self._pending.pop(chat_id, None)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+        task = asyncio.create_task(self._send(chat_id, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, chat_id, pending):
+        keyboard = [[InlineKeyboardButton("пᴘᴀʙиʌᴀ", callback_data="show_rules")]]
+        try:
+            await outbound.send_message(
+                pending.bot,
+                chat_id,
+                f"ᴀйо {', '.join(pending.names)}!\nᴏзнᴀйᴏᴍᴛᴇᴄя з пᴘᴀʙиʌᴀᴍи.",
+                priority=outbound.PRIORITY_BULK,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                message_thread_id=pending.thread_id
+            )
+            self.messages += 1
+        except Exception as e:
+            logger.error(f"Ошибка приветствия в чате {chat_id}: {e}")
+
+    def stats(self):
+        return {
+            'pending_chats': len(self._pending),
+            'members': self.members,
+            'messages': self.messages,
+            'members_per_message': self.members / self.messages if self.messages else 0.0,
+        }
+
+
+welcome_batcher = WelcomeBatcher()
+
+# ========================================
+# 2a. Join Request Handler
 # ========================================
 async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     join_req = update.chat_join_request
@@ -103,38 +277,23 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Одобряем запрос
         await context.bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
         logger.info(f"✅ Заявка одобрена: {user_id}")
+        note_club_member(join_req.chat, user_id)
+        
+        # Приветствие в группе — общее для всех, кто вступил за окно
+        welcome_batcher.add(context.bot, chat_id, user_id, full_name)
         
-        # Отправляем ЛС
+        # Отправляем ЛС — одним сообщением
         ls_chat_id = user_chat_id or user_id
         try:
-            await context.bot.send_message(
-                ls_chat_id,
-                f"{full_name}! зᴀпит схвᴀʌᴇно.",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            await context.bot.send_message(
+            await outbound.send_message(
+                context.bot,
                 ls_chat_id,
-                "шᴏ я ᴍᴏжу?\n\n➞ ᴀʙᴛᴏᴘᴘийᴏᴍ зᴀяʙᴏᴋ\n➞ ʙᴇʌᴋᴀᴍ з пᴘᴀʙиʌᴀᴍи\n➞ пᴇᴘᴇʙіᴘᴋᴀ пᴏᴄиʌᴀнь\n➞ /font - ᴛᴇᴋᴄᴛ ᴄᴛᴀйʌᴇᴘ\n➞ ШІ — дʌя чʌᴇніʙ ᴋʌубу\n(ʙ чᴀᴛᴀх: ᴛᴘигᴇᴘ ᴀʌᴏ)",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            await context.bot.send_message(
-                ls_chat_id,
-                "➞ ᴘᴀɪɴᴛ ᴀᴘᴘ (ᴘʀᴏᴛᴏᴛʏᴘᴇ)\nt.me/MORSTRIXBOT/paint",
-                parse_mode=ParseMode.MARKDOWN
+                ONBOARDING_TEXT.format(name=full_name),
+                priority=outbound.PRIORITY_BULK
             )
         except Forbidden:
             logger.warning(f"ЛС заблоковано для {user_id}")
         
-        # Приветствие в группе
-        keyboard = [[InlineKeyboardButton("пᴘᴀʙиʌᴀ", callback_data="show_rules")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"ᴀйо {full_name}!\nᴏзнᴀйᴏᴍᴛᴇᴄя з пᴘᴀʙиʌᴀᴍи.",
-            reply_markup=reply_markup
-        )
-        
     except Exception as e:
         logger.error(f"Ошибка обработки заявки: {e}")
 
@@ -142,15 +301,12 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
 # 3. New Members Handler
 # ========================================
 async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    thread_id = update.message.message_thread_id if update.message.is_topic_message else None
     for member in update.message.new_chat_members:
         if not member.is_bot:
-            keyboard = [[InlineKeyboardButton("пᴘᴀʙиʌᴀ", callback_data="show_rules")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            welcome = f"ᴀйо {member.full_name}!\nᴏзнᴀйᴏᴍᴛᴇᴄя з пᴘᴀʙиʌᴀᴍи."
-
-            thread_id = update.message.message_thread_id if update.message.is_topic_message else None
-            await update.message.reply_text(welcome, reply_markup=reply_markup, message_thread_id=thread_id)
+            note_club_member(update.effective_chat, member.id)
+            # Одобренные заявкой уже в очереди приветствия — повторно не добавятся
+            welcome_batcher.add(context.bot, update.effective_chat.id, member.id, member.full_name, thread_id)
 
 # ========================================
 # 4. Callback Query Handler
@@ -164,16 +320,21 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         try:
             await query.edit_message_text(rules, parse_mode=ParseMode.MARKDOWN)
         except:
-            await query.message.reply_text(rules, parse_mode=ParseMode.MARKDOWN)
+            await outbound.reply_text(query.message, rules, parse_mode=ParseMode.MARKDOWN)
 
 # ========================================
 # 5. Font Command Handlers
 # ========================================
 async def font_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not font_limiter.try_acquire(update.effective_user.id):
+        wait = int(font_limiter.retry_after(update.effective_user.id)) + 1
+        await outbound.reply_text(update.message, f"Забагато запитів. Спробуй через {wait} сек.")
+        return ConversationHandler.END
+
     context.user_data['font_chat_id'] = update.effective_chat.id
     context.user_data['font_command_id'] = update.message.message_id
 
-    msg = await update.message.reply_text("ᴋᴀᴛᴀй ᴛᴇᴋᴄᴛ.\n\n/cancel — скасувати.")
+    msg = await outbound.reply_text(update.message, "ᴋᴀᴛᴀй ᴛᴇᴋᴄᴛ.\n\n/cancel — скасувати.")
     context.user_data['font_bot_request_id'] = msg.message_id
     return FONT_TEXT
 
@@ -182,12 +343,12 @@ async def font_get_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     chat_id = update.effective_chat.id
 
     if not user_text:
-        await update.message.reply_text("Порожньо. Введіть текст або /cancel.")
+        await outbound.reply_text(update.message, "Порожньо. Введіть текст або /cancel.")
         return FONT_TEXT
 
     # Ограничение длины
     if len(user_text) > 500:
-        await update.message.reply_text("Текст занадто довгий (макс. 500 символів).")
+        await outbound.reply_text(update.message, "Текст занадто довгий (макс. 500 символів).")
         return FONT_TEXT
 
     converted_block = convert_text_to_font(user_text)
@@ -205,9 +366,10 @@ async def font_get_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         pass
 
     # Отправляем результат
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=converted_block,
+    await outbound.send_message(
+        context.bot,
+        chat_id,
+        converted_block,
         parse_mode=ParseMode.MARKDOWN_V2,
         message_thread_id=update.message.message_thread_id
     )
@@ -222,5 +384,43 @@ async def font_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         except:
             pass
 
-    await update.message.reply_text("Скасовано.", message_thread_id=update.message.message_thread_id)
-    return ConversationHandler.END
\ No newline at end of file
+    await outbound.reply_text(update.message, "Скасовано.", message_thread_id=update.message.message_thread_id)
+    return ConversationHandler.END
+
+# ========================================
+# 6. Font Inline Query
+# ========================================
+_inline_results = OrderedDict()  # текст запроса -> готовые результаты
+
+
+def _font_inline_results(text):
+    results = _inline_results.get(text)
+    if results is not None:
+        _inline_results.move_to_end(text)
+        return results
+
+    results = []
+    for style in styles_for(text):
+        styled = style.apply(text)
+        results.append(InlineQueryResultArticle(
+            id=style.key,
+            title=style.title,
+            description=styled,
+            input_message_content=InputTextMessageContent(styled)
+        ))
+    _inline_results[text] = results
+    while len(_inline_results) > FONT_INLINE_CACHE_SIZE:
+        _inline_results.popitem(last=False)
+    return results
+
+
+async def handle_font_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Все стили сразу: пользователь выбирает нужный и отправляет в любой чат."""
+    query = update.inline_query
+    text = query.query.strip()
+    if not text:
+        await query.answer([], cache_time=FONT_INLINE_CACHE_TIME)
+        return
+
+    # Результаты не зависят от пользователя, поэтому Telegram может отдавать их из своего кеша
+    await query.answer(_font_inline_results(text), cache_time=FONT_INLINE_CACHE_TIME, is_personal=False)
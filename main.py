@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 import os
 import sys
+import signal
 import asyncio
 import logging
-import threading
-from flask import Flask, Response
+import importlib
+
+import startup
+
+with startup.phase('config'):
+    import config
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,220 +20,514 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ========================================
-# WEB SERVER FOR KOYEB HEALTH CHECKS
+# МЕТРИКИ
 # ========================================
-def run_flask_server():
-    """Запускает Flask сервер для health checks"""
-    app = Flask(__name__)
-    
-    @app.route('/')
-    @app.route('/health')
-    def health():
-        return "✅ Бот работает", 200
+def register_metrics(application):
+    """Датчики очередей, кешей и ограничителей, которые считаются при запросе /metrics"""
+    import metrics
+    import ratelimit
+    from ai import scheduler, response_cache, conversation_memory, membership_cache
+    from safe import verdict_cache, lookup_batcher, local_database
+    import outbound
+    from handlers import welcome_batcher
+    from art_store import art_store
+    from triggers import trigger_engine
     
-    port = int(os.getenv('PORT', 8080))
-    app.run(host='0.0.0.0', port=port, debug=False, threaded=True, use_reloader=False)
+    if hasattr(application.persistence, 'stats'):
+        metrics.StatsGauges('morstrix_persistence', 'Сохранение состояния в SQLite', application.persistence.stats)
+    metrics.GaugeFunction(
+        'morstrix_update_queue_depth', 'Обновления в очереди Application.update_queue',
+        application.update_queue.qsize
+    )
+    if hasattr(application.update_processor, 'stats'):
+        metrics.StatsGauges(
+            'morstrix_update_processor', 'Параллельная обработка обновлений',
+            application.update_processor.stats
+        )
+    metrics.GaugeFunction('morstrix_startup_seconds', 'Фазы холодного старта, сек', startup.stats, 'phase')
+    metrics.GaugeFunction('morstrix_ai_queue_depth', 'Запросы к Gemini в очереди', scheduler.queue_depth)
+    metrics.GaugeFunction(
+        'morstrix_ratelimit_keys', 'Активные ключи ограничителей частоты',
+        lambda: {name: len(limiter) for name, limiter in ratelimit.limiters.items()}, 'limiter'
+    )
+    metrics.StatsGauges('morstrix_triggers', 'Триггеры групповых сообщений', trigger_engine.stats)
+    metrics.StatsGauges('morstrix_art_store', 'Хранилище артов', art_store.stats)
+    metrics.StatsGauges('morstrix_welcome', 'Пакетные приветствия', welcome_batcher.stats)
+    metrics.StatsGauges('morstrix_outbound', 'Очередь исходящих сообщений', outbound.scheduler.stats)
+    metrics.StatsGauges('morstrix_ai_scheduler', 'Очередь запросов к Gemini', scheduler.stats)
+    metrics.StatsGauges('morstrix_ai_response_cache', 'Кеш ответов ИИ', response_cache.stats)
+    metrics.StatsGauges('morstrix_ai_memory', 'Память разговоров ИИ', conversation_memory.stats)
+    metrics.StatsGauges('morstrix_ai_membership_cache', 'Кеш членства в клубе', membership_cache.stats)
+    metrics.StatsGauges('morstrix_safe_verdict_cache', 'Кеш вердиктов Safe Browsing', verdict_cache.stats)
+    metrics.StatsGauges('morstrix_safe_batcher', 'Объединение запросов Safe Browsing', lookup_batcher.stats)
+    metrics.StatsGauges('morstrix_safe_local_db', 'Локальная база Safe Browsing', local_database.stats)
 
 # ========================================
 # TELEGRAM BOT - ПОЛНЫЙ ФУНКЦИОНАЛ
 # ========================================
-async def run_telegram_bot():
-    """Запускает Telegram бота со ВСЕМ функционалом"""
-    try:
-        # Импортируем ВСЕ модули
+def build_application(token: str):
+    """Собирает Application со всеми обработчиками (без обращений к сети)"""
+    # Импортируем ВСЕ модули; каждый крупный импорт — отдельная фаза профиля запуска
+    with startup.phase('import telegram'):
         from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
         from telegram.ext import (
             Application, CommandHandler, MessageHandler, filters,
-            ChatJoinRequestHandler, CallbackQueryHandler,
+            ChatJoinRequestHandler, CallbackQueryHandler, ChatMemberHandler,
+            InlineQueryHandler, TypeHandler,
             ContextTypes
         )
         from telegram.constants import ParseMode
-        import google.generativeai as genai
-        
-        # Импортируем твои модули
-        from ai import handle_gemini_message_private, handle_gemini_message_group
-        from safe import check_links
+    
+    # Импортируем твои модули (Gemini SDK, Pillow и aiohttp подгружаются при первом использовании)
+    with startup.phase('import ai'):
+        from ai import (
+            handle_gemini_message_private, handle_gemini_message_group,
+            handle_ai_cancel, handle_ai_chat_member, handle_ai_cache_command
+        )
+    with startup.phase('import safe'):
+        from safe import (
+            check_links, close_client as close_safe_browsing_client,
+            stop_local_database
+        )
+    with startup.phase('import handlers'):
         from handlers import (
             handle_web_app_data, handle_join_request, 
             handle_new_members, handle_callback_query,
-            font_start, font_get_text, font_cancel
+            font_start, font_get_text, font_cancel, handle_font_inline_query
         )
         from font_utils import convert_text_to_font
-        
-        TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-        
-        if not TOKEN:
-            logger.error("❌ TELEGRAM_BOT_TOKEN не найден!")
-            return
-        
-        logger.info("🚀 Инициализация Telegram бота...")
-        
-        if GEMINI_API_KEY:
-            genai.configure(api_key=GEMINI_API_KEY)
-        
-        # ========================================
-        # ВСЕ КОМАНДЫ БОТА
-        # ========================================
-        async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            """Обработчик команды /start"""
-            keyboard = [[InlineKeyboardButton("ПРАВИЛА", callback_data="show_rules")]]
-            await update.message.reply_text(
-                "ᴡᴇʟᴄᴏᴍᴇ \n\n"
-                "➞ ᴀʙᴛᴏᴘᴘийᴏᴍ зᴀяʙᴏᴋ\n"
-                "➞ пᴇᴘᴇʙіᴘᴋᴀ пᴏᴄиʌᴀнь\n"
-                "➞ /font - ᴛᴇᴋᴄᴛ ᴄᴛᴀйʌᴇᴘ\n\n"
-                "➞ ШІ — дʌя чʌᴇніʙ ᴋʌубу (ᴀʌᴏ)\n"
-                "➞ ᴘᴀɪɴᴛ ᴀᴘᴘ (ᴘʀᴏᴛᴏᴛʏᴘᴇ)\n"
-                "➞ /tetris - играть в тетрис",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.MARKDOWN
-            )
-        
-        async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await update.message.reply_text(
-                "Доступные команды:\n"
-                "/start - начало работы\n"
-                "/font - стильный текст\n"
-                "/tetris - играть в тетрис\n"
-                "/help - эта справка\n\n"
-                "Бот также:\n"
-                "• Отвечает на 'ало' в группах\n"
-                "• Проверяет ссылки на безопасность\n"
-                "• Обрабатывает заявки в группы"
-            )
-        
-        async def tetris_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            """Команда /tetris"""
-            await update.message.reply_text(
-                "🎮 TETRIS Game\n\n"
-                "Игра доступна по ссылке:\n"
-                "https://grimexframe.github.io/MORSTRXBOT/tetris.html\n\n"
-                "Или используй Web App если настроено.",
-                parse_mode=ParseMode.MARKDOWN
+        from art import shutdown_executor as shutdown_art_executor
+    with startup.phase('import core'):
+        import metrics
+        from processor import ChatUpdateProcessor
+        from persistence import create_persistence
+        from triggers import TriggerFilter, trigger_engine, register_action, handle_triggers
+    
+    # ========================================
+    # ВСЕ КОМАНДЫ БОТА
+    # ========================================
+    @metrics.instrument('start')
+    async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /start"""
+        keyboard = [[InlineKeyboardButton("ПРАВИЛА", callback_data="show_rules")]]
+        await update.message.reply_text(
+            "ᴡᴇʟᴄᴏᴍᴇ \n\n"
+            "➞ ᴀʙᴛᴏᴘᴘийᴏᴍ зᴀяʙᴏᴋ\n"
+            "➞ пᴇᴘᴇʙіᴘᴋᴀ пᴏᴄиʌᴀнь\n"
+            "➞ /font - ᴛᴇᴋᴄᴛ ᴄᴛᴀйʌᴇᴘ\n\n"
+            "➞ ШІ — дʌя чʌᴇніʙ ᴋʌубу (ᴀʌᴏ)\n"
+            "➞ ᴘᴀɪɴᴛ ᴀᴘᴘ (ᴘʀᴏᴛᴏᴛʏᴘᴇ)\n"
+            "➞ /tetris - играть в тетрис",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    @metrics.instrument('help')
+    async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text(
+            "Доступные команды:\n"
+            "/start - начало работы\n"
+            "/font - стильный текст\n"
+            "@MORSTRIXBOT текст - все стили в любом чате\n"
+            "/tetris - играть в тетрис\n"
+            "/aicache on|off - кеш ответов ИИ в чате\n"
+            "/help - эта справка\n\n"
+            "Бот также:\n"
+            "• Отвечает на 'ало' в группах\n"
+            "• Проверяет ссылки на безопасность\n"
+            "• Обрабатывает заявки в группы"
+        )
+    
+    @metrics.instrument('tetris')
+    async def tetris_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Команда /tetris"""
+        await update.message.reply_text(
+            "🎮 TETRIS Game\n\n"
+            "Игра доступна по ссылке:\n"
+            "https://grimexframe.github.io/MORSTRXBOT/tetris.html\n\n"
+            "Или используй Web App если настроено.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    # ========================================
+    # ОБРАБОТЧИКИ ИЗ ТВОИХ МОДУЛЕЙ
+    # ========================================
+    
+    # AI обработчики
+    @metrics.instrument('ai_private')
+    async def handle_ai_private_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_gemini_message_private(update, context)
+    
+    @metrics.instrument('ai_group')
+    async def handle_ai_group_action(update: Update, context: ContextTypes.DEFAULT_TYPE, trigger):
+        await handle_gemini_message_group(update, context)
+    
+    # Триггеры в группах: один проход по тексту на все ключевые слова
+    @metrics.instrument('triggers')
+    async def handle_triggers_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_triggers(update, context)
+    
+    @metrics.instrument('ai_cancel')
+    async def handle_ai_cancel_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_ai_cancel(update, context)
+    
+    @metrics.instrument('ai_chat_member')
+    async def handle_ai_chat_member_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_ai_chat_member(update, context)
+    
+    # Safe links проверка
+    @metrics.instrument('check_links')
+    async def check_links_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await check_links(update, context)
+    
+    # Web app данные
+    @metrics.instrument('web_app_data')
+    async def handle_web_app_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_web_app_data(update, context)
+    
+    # Join request
+    @metrics.instrument('join_request')
+    async def handle_join_request_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_join_request(update, context)
+    
+    # New members
+    @metrics.instrument('new_members')
+    async def handle_new_members_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_new_members(update, context)
+    
+    # Callback queries
+    @metrics.instrument('callback_query')
+    async def handle_callback_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handle_callback_query(update, context)
+    
+    # ========================================
+    # НАСТРОЙКА И ЗАПУСК БОТА
+    # ========================================
+    async def on_shutdown(app: Application):
+        await metrics.stop_loop_lag_monitor()
+        await stop_local_database()
+        await close_safe_browsing_client()
+        shutdown_art_executor()
+    
+    with startup.phase('build application'):
+        # Запросы к Bot API идут через InstrumentedRequest, чтобы мерить их задержку;
+        # обновления разных чатов обрабатываются параллельно, одного чата — по порядку
+        builder = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(ChatUpdateProcessor())
+            .request(metrics.InstrumentedRequest())
+            .get_updates_request(metrics.InstrumentedRequest(connection_pool_size=1))
+            .post_shutdown(on_shutdown)
+        )
+        if config.TELEGRAM_API_URL:
+            builder = builder.base_url(f"{config.TELEGRAM_API_URL}/bot").base_file_url(
+                f"{config.TELEGRAM_API_URL}/file/bot"
             )
-        
-        # ========================================
-        # ОБРАБОТЧИКИ ИЗ ТВОИХ МОДУЛЕЙ
-        # ========================================
-        
-        # AI обработчики
-        async def handle_ai_private_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_gemini_message_private(update, context)
-        
-        async def handle_ai_group_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_gemini_message_group(update, context)
-        
-        # Safe links проверка
-        async def check_links_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await check_links(update, context)
-        
-        # Web app данные
-        async def handle_web_app_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_web_app_data(update, context)
-        
-        # Join request
-        async def handle_join_request_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_join_request(update, context)
-        
-        # New members
-        async def handle_new_members_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_new_members(update, context)
-        
-        # Callback queries
-        async def handle_callback_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-            await handle_callback_query(update, context)
-        
-        # ========================================
-        # НАСТРОЙКА И ЗАПУСК БОТА
-        # ========================================
-        application = Application.builder().token(TOKEN).build()
-        
+        # user_data, chat_data, диалог /font и ограничители переживают перезапуск
+        persistence = create_persistence()
+        if persistence is not None:
+            builder = builder.persistence(persistence)
+        application = builder.build()
+        register_metrics(application)
+    
+        trigger_engine.load()
+        register_action('ai', handle_ai_group_action)
+    
         # Добавляем обработчики команд
         application.add_handler(CommandHandler("start", start_command))
         application.add_handler(CommandHandler("help", help_command))
         application.add_handler(CommandHandler("tetris", tetris_command))
-        
+        application.add_handler(CommandHandler("aicache", metrics.instrument('aicache')(handle_ai_cache_command)))
+    
         # FONT команда (если есть ConversationHandler)
         try:
             from handlers import FONT_TEXT
             from telegram.ext import ConversationHandler
-            
+        
             font_conv_handler = ConversationHandler(
-                entry_points=[CommandHandler("font", font_start)],
+                entry_points=[CommandHandler("font", metrics.instrument('font_start')(font_start))],
                 states={
-                    FONT_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, font_get_text)]
+                    FONT_TEXT: [MessageHandler(
+                        filters.TEXT & ~filters.COMMAND,
+                        metrics.instrument('font_get_text')(font_get_text)
+                    )]
                 },
-                fallbacks=[CommandHandler("cancel", font_cancel)]
+                fallbacks=[CommandHandler("cancel", metrics.instrument('font_cancel')(font_cancel))],
+                name="font",
+                persistent=persistence is not None
             )
             application.add_handler(font_conv_handler)
         except:
             # Упрощенная версия font команды
+            @metrics.instrument('font')
             async def simple_font_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if not context.args:
                     await update.message.reply_text("Использование: /font <текст>")
                     return
-                
+            
                 text = ' '.join(context.args)
                 if len(text) > 500:
                     await update.message.reply_text("Текст слишком длинный (макс 500 символов)")
                     return
-                
+            
                 converted = convert_text_to_font(text)
                 await update.message.reply_text(converted, parse_mode=ParseMode.MARKDOWN_V2)
-            
-            application.add_handler(CommandHandler("font", simple_font_command))
         
+            application.add_handler(CommandHandler("font", simple_font_command))
+    
         # Добавляем остальные обработчики
         application.add_handler(CallbackQueryHandler(handle_callback_wrapper))
         application.add_handler(ChatJoinRequestHandler(handle_join_request_wrapper))
-        
+        application.add_handler(InlineQueryHandler(metrics.instrument('font_inline')(handle_font_inline_query)))
+    
         # Обработчики сообщений
+        # ИИ отвечает долго (очередь + генерация), поэтому его обработчики не блокируют
+        # очередь чата (block=False) — иначе /cancel и проверка ссылок ждали бы ответа
         application.add_handler(MessageHandler(
             filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE,
-            handle_ai_private_wrapper
+            handle_ai_private_wrapper,
+            block=False
         ))
-        
+    
         application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS & filters.Regex(r'(?i)ало'),
-            handle_ai_group_wrapper
+            filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS & TriggerFilter(),
+            handle_triggers_wrapper,
+            block=False
         ))
-        
+    
         application.add_handler(MessageHandler(
             filters.StatusUpdate.NEW_CHAT_MEMBERS,
             handle_new_members_wrapper
         ))
-        
+    
         # Проверка ссылок (для всех сообщений с ссылками)
         application.add_handler(MessageHandler(
             filters.TEXT & filters.Entity("url"),
             check_links_wrapper
         ))
-        
+    
         # Web app данные
         application.add_handler(MessageHandler(
             filters.StatusUpdate.WEB_APP_DATA,
             handle_web_app_wrapper
         ))
-        
-        # ========================================
-        # ЗАПУСК БОТА
-        # ========================================
+    
+        # Отмена запросов к ИИ: отдельная группа, чтобы /cancel работал и внутри /font
+        application.add_handler(CommandHandler("cancel", handle_ai_cancel_wrapper), group=1)
+        application.add_handler(ChatMemberHandler(
+            handle_ai_chat_member_wrapper,
+            ChatMemberHandler.ANY_CHAT_MEMBER
+        ), group=1)
+    
+    # Первое обновление — в профиль запуска (группа -1 проверяется раньше всех)
+    async def first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        startup.mark_first_update()
+    
+    application.add_handler(TypeHandler(Update, first_update), group=-1)
+    return application
+
+def build_front_application(token: str, router):
+    """Application фронта при шардировании: только прием обновлений и пересылка воркерам (shard.py)"""
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler, ContextTypes
+    import metrics
+    
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        router.route(update)
+    
+    with startup.phase('build application'):
+        # Обновления обрабатываются по одному: так пересылка сохраняет их порядок
+        builder = (
+            Application.builder()
+            .token(token)
+            .request(metrics.InstrumentedRequest())
+            .get_updates_request(metrics.InstrumentedRequest(connection_pool_size=1))
+        )
+        if config.TELEGRAM_API_URL:
+            builder = builder.base_url(f"{config.TELEGRAM_API_URL}/bot").base_file_url(
+                f"{config.TELEGRAM_API_URL}/file/bot"
+            )
+        application = builder.build()
+        application.add_handler(TypeHandler(Update, forward))
+        metrics.StatsGauges('morstrix_shard', 'Пересылка обновлений воркерам', router.stats)
+        metrics.GaugeFunction(
+            'morstrix_shard_queue_depth', 'Обновления, ждущие отправки воркеру', router.queue_depths, 'worker'
+        )
+    return application
+
+async def start_receiving(application):
+    """Запускает прием обновлений от Telegram (webhook или polling) и HTTP сервер; возвращает его runner"""
+    from telegram import Update
+    
+    # HTTP сервер (health checks и webhook) в том же цикле событий
+    if config.BOT_MODE == 'webhook':
+        with startup.phase('web server'):
+            from webserver import start_web_server, set_webhook
+            runner = await start_web_server(application, webhook=True)
+        with startup.phase('set webhook'):
+            await set_webhook(application)
+        logger.info("✅ Telegram бот запущен в режиме webhook...")
+        return runner
+    else:
+        # Polling стартует раньше HTTP сервера: health check подождет, а заявки — нет
+        with startup.phase('start polling'):
+            await application.updater.start_polling(
+                poll_interval=0.5,
+                timeout=30,
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES
+            )
         logger.info("✅ Telegram бот запущен в режиме polling...")
+        with startup.phase('web server'):
+            # aiohttp импортируется в потоке, чтобы не задерживать уже пришедшие обновления
+            webserver = await asyncio.to_thread(importlib.import_module, 'webserver')
+            return await webserver.start_web_server(application, webhook=False)
+
+async def wait_for_shutdown():
+    """Ждет SIGTERM (Koyeb при редеплое) или SIGINT, чтобы остановить бота штатно"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+async def run_shard_front():
+    """Фронт: принимает обновления и раздает их воркерам по хешу чата"""
+    import shard
+    
+    workers = shard.local_workers(config.SHARD_WORKERS)
+    nodes = {f"worker-{worker.index}": worker.url for worker in workers}
+    nodes.update({url: url for url in config.SHARD_WORKER_URLS})
+    router = shard.ShardRouter(nodes)
+    application = build_front_application(config.TELEGRAM_BOT_TOKEN, router)
+    
+    supervisors = [asyncio.create_task(worker.run()) for worker in workers]
+    runner = None
+    try:
+        # Пока воркеры стартуют, обновления копятся в очередях ShardRouter
+        await router.start()
+        with startup.phase('initialize'):
+            await application.initialize()
+        with startup.phase('start'):
+            await application.start()
+        runner = await start_receiving(application)
+        startup.mark_ready()
+        logger.info(f"✅ Фронт раздает обновления воркерам: {', '.join(nodes)}")
         
-        # Запускаем бота (без signal handlers)
+        await wait_for_shutdown()
+        logger.info("⏹ Получен сигнал остановки")
+    finally:
+        # Сначала перестаем принимать обновления; stop() пересылает уже полученные
+        # в очереди ShardRouter, и их досылаем воркерам, пока те еще работают
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if runner is not None:
+            await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await router.drain()
+        await router.stop()
+        await application.shutdown()
+        # Воркеры по SIGTERM сохраняют состояние; не успевшие за таймаут убиваем
+        for worker in workers:
+            worker.stop()
+        if supervisors:
+            await asyncio.wait(supervisors, timeout=shard.SHARD_DRAIN_TIMEOUT)
+        for worker, task in zip(workers, supervisors):
+            if not task.done():
+                worker.kill()
+                task.cancel()
+        logger.info("⏹ Фронт остановлен")
+
+async def run_shard_worker():
+    """Воркер: полный бот, обновления приходят от фронта, общие лимиты — в shared_state"""
+    import shard
+    import metrics
+    import shared_state
+    from ai import preload_gemini
+    from safe import start_local_database
+    
+    application = build_application(config.TELEGRAM_BOT_TOKEN)
+    state = shared_state.enable()
+    metrics.StatsGauges('morstrix_shared_state', 'Общее состояние воркеров', state.stats)
+    
+    with startup.phase('initialize'):
         await application.initialize()
+    with startup.phase('start'):
         await application.start()
-        await application.updater.start_polling(
-            poll_interval=0.5,
-            timeout=30,
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
-        )
+    with startup.phase('web server'):
+        from webserver import start_web_server
+        runner = await start_web_server(application, webhook=False, shard_worker=True)
+    startup.mark_ready()
+    logger.info(f"✅ Воркер {shard.SHARD_INDEX} принимает обновления от фронта")
+    
+    start_local_database()
+    metrics.start_loop_lag_monitor()
+    preload_gemini()
+    
+    await shard.wait_for_stop()
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+    state.close()
+    logger.info(f"⏹ Воркер {shard.SHARD_INDEX} остановлен")
+
+async def run_telegram_bot():
+    """Запускает Telegram бота со ВСЕМ функционалом"""
+    try:
+        if not config.TELEGRAM_BOT_TOKEN:
+            logger.error("❌ TELEGRAM_BOT_TOKEN не найден!")
+            return
+        
+        # Шардирование: воркер, запущенный фронтом, или сам фронт
+        if config.SHARD_ROLE == 'worker':
+            await run_shard_worker()
+            return
+        if config.SHARD_WORKERS > 0 or config.SHARD_WORKER_URLS:
+            await run_shard_front()
+            return
+        
+        logger.info("🚀 Инициализация Telegram бота...")
+        application = build_application(config.TELEGRAM_BOT_TOKEN)
+        
+        import metrics
+        from ai import preload_gemini
+        from safe import start_local_database
         
-        # Бесконечный цикл
-        while True:
-            await asyncio.sleep(3600)
+        # ========================================
+        # ЗАПУСК БОТА
+        # ========================================
+        # Сигналы обрабатывает wait_for_shutdown, а не run_polling
+        runner = None
+        try:
+            with startup.phase('initialize'):
+                await application.initialize()
+            with startup.phase('start'):
+                await application.start()
+            
+            runner = await start_receiving(application)
+            startup.mark_ready()
+            
+            # Локальная база Safe Browsing (если SAFE_BROWSING_MODE=update)
+            start_local_database()
+            metrics.start_loop_lag_monitor()
+            # Gemini SDK импортируется в фоне, пока бот уже отвечает
+            preload_gemini()
+            
+            await wait_for_shutdown()
+            logger.info("⏹ Получен сигнал остановки")
+        finally:
+            # stop() дожидается обработчиков и сохраняет состояние, shutdown() — сбрасывает
+            # persistence на диск и вызывает on_shutdown (клиенты, пулы, локальная база)
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            if runner is not None:
+                await runner.cleanup()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            logger.info("⏹ Бот остановлен")
             
     except Exception as e:
         logger.error(f"❌ Ошибка в Telegram боте: {e}")
@@ -239,14 +538,9 @@ async def run_telegram_bot():
 # ГЛАВНАЯ ФУНКЦИЯ ЗАПУСКА
 # ========================================
 def main():
-    """Запускает Flask и Telegram бота"""
+    """Запускает Telegram бота (HTTP сервер поднимается внутри, в том же цикле)"""
     logger.info("🚀 MORSTRIXBOT запускается на Koyeb...")
     
-    # Запускаем Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask_server, daemon=True)
-    flask_thread.start()
-    logger.info("✅ Flask сервер запущен на порту 8080")
-    
     # Запускаем Telegram бота
     try:
         asyncio.run(run_telegram_bot())
@@ -0,0 +1,318 @@
+# metrics.py
+"""
+Метрики бота в текстовом формате Prometheus (отдаются на /metrics).
+
+Без внешних зависимостей: счетчики, гистограммы и датчики хранят значения
+в словарях по кортежу меток, а render() собирает текст при каждом запросе.
+Все обновления синхронны и выполняются в цикле событий, поэтому блокировки
+не нужны. Накладные расходы: python -m bench.metrics_overhead
+"""
+
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм задержек, сек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Labels, Labels, float]  # суффикс имени, имена меток, значения меток, значение
+
+registry: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames: Labels = tuple(labelnames)
+        registry.append(self)
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            if names:
+                labels = ','.join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+                lines.append(f"{self.name}{suffix}{{{labels}}} {_format_value(value)}")
+            else:
+                lines.append(f"{self.name}{suffix} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Монотонный счетчик: inc(*значения_меток, amount=1)."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self._values.items():
+            yield '', self.labelnames, labels, value
+
+
+class Gauge(_Metric):
+    """Текущее значение: set(value, *значения_меток)."""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self._values.items():
+            yield '', self.labelnames, labels, value
+
+
+class GaugeFunction(_Metric):
+    """
+    Датчик, значение которого вычисляется при каждом запросе /metrics.
+
+    function возвращает число, а если задан labelname — словарь {значение метки: число}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], object],
+                 labelname: Optional[str] = None):
+        super().__init__(name, documentation, (labelname,) if labelname else ())
+        self._function = function
+
+    def samples(self) -> Iterable[Sample]:
+        try:
+            result = self._function()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрики {self.name}: {e}")
+            return
+        if self.labelnames:
+            for label, value in result.items():
+                yield '', self.labelnames, (label,), value
+        else:
+            yield '', (), (), result
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам: observe(value, *значения_меток)."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: [счетчики корзин (последняя — +Inf), сумма]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> Iterable[Sample]:
+        bucket_names = self.labelnames + ('le',)
+        bounds = self.buckets + (float('inf'),)
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '_bucket', bucket_names, labels + (_format_value(bound),), cumulative
+            yield '_sum', self.labelnames, labels, total
+            yield '_count', self.labelnames, labels, cumulative
+
+
+class StatsGauges(_Metric):
+    """
+    Отдает каждый ключ словаря stats() (VerdictCache.stats и т.п.) отдельным
+    датчиком <name>_<ключ>; stats() вызывается один раз на запрос /metrics.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, stats: Callable[[], Dict[str, float]]):
+        super().__init__(name, documentation)
+        self._stats = stats
+
+    def render(self) -> str:
+        try:
+            stats = self._stats()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрик {self.name}: {e}")
+            return f"# {self.name}: ошибка сбора"
+        lines = []
+        for key, value in stats.items():
+            name = f"{self.name}_{key}"
+            lines += [f"# HELP {name} {self.documentation}: {key}", f"# TYPE {name} gauge",
+                      f"{name} {_format_value(value)}"]
+        return '\n'.join(lines)
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# ========================================
+# МЕТРИКИ БОТА
+# ========================================
+handler_latency = Histogram(
+    'morstrix_handler_duration_seconds', 'Время выполнения обработчика обновления', ('handler',)
+)
+handler_errors = Counter(
+    'morstrix_handler_errors_total', 'Исключения в обработчиках обновлений', ('handler',)
+)
+upstream_latency = Histogram(
+    'morstrix_upstream_request_duration_seconds', 'Время запроса к внешнему API', ('service', 'method')
+)
+upstream_errors = Counter(
+    'morstrix_upstream_errors_total', 'Ошибки запросов к внешнему API', ('service', 'method')
+)
+ai_queue_wait = Histogram(
+    'morstrix_ai_queue_wait_seconds', 'Ожидание запроса к Gemini в очереди', ('kind',)
+)
+ai_shed = Counter(
+    'morstrix_ai_shed_total', 'Запросы к Gemini, отброшенные до отправки', ('kind', 'reason')
+)
+loop_lag = Histogram(
+    'morstrix_event_loop_lag_seconds', 'Задержка пробуждения задачи в цикле событий',
+    buckets=LOOP_LAG_BUCKETS
+)
+
+
+class Timer:
+    """
+    Контекстный менеджер: пишет длительность блока в гистограмму,
+    а исключение (кроме отмены) — в счетчик ошибок.
+    """
+
+    __slots__ = ('histogram', 'errors', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, errors: Optional[Counter], *labels: str):
+        self.histogram = histogram
+        self.errors = errors
+        self.labels = labels
+
+    def __enter__(self) -> 'Timer':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        if exc_type is not None and self.errors is not None and issubclass(exc_type, Exception):
+            self.errors.inc(*self.labels)
+
+
+def upstream(service: str, method: str) -> Timer:
+    """with metrics.upstream('gemini', 'generate'): ... — задержка и ошибки внешнего вызова."""
+    return Timer(upstream_latency, upstream_errors, service, method)
+
+
+def instrument(name: str):
+    """Декоратор обработчика PTB: задержка и исключения с меткой handler=name."""
+    def decorator(callback):
+        @wraps(callback)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(name)
+                raise
+            finally:
+                handler_latency.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который измеряет каждый вызов Bot API (метка method — имя метода API)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        # Скачивание файлов (/file/bot<token>/<путь>) — одна метка, а не путь каждого файла
+        api_method = 'file' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            upstream_errors.inc('telegram', api_method)
+            raise
+        finally:
+            upstream_latency.observe(time.perf_counter() - started, 'telegram', api_method)
+        if code >= 400:
+            upstream_errors.inc('telegram', api_method)
+        return code, payload
+
+
+# ========================================
+# ЗАДЕРЖКА ЦИКЛА СОБЫТИЙ
+# ========================================
+_lag_task: Optional[asyncio.Task] = None
+
+
+async def _lag_loop(interval: float) -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+def start_loop_lag_monitor(interval: float = 0.5) -> asyncio.Task:
+    """Раз в interval секунд измеряет, насколько позже задача просыпается из sleep."""
+    global _lag_task
+    if _lag_task is None or _lag_task.done():
+        _lag_task = asyncio.create_task(_lag_loop(interval))
+    return _lag_task
+
+
+async def stop_loop_lag_monitor() -> None:
+    global _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        try:
+            await _lag_task
+        except asyncio.CancelledError:
+            pass
+        _lag_task = None
@@ -0,0 +1,239 @@
+# outbound.py
+"""
+Очередь исходящих сообщений с учетом flood control Telegram.
+
+Все отправки (send_message, reply_text, правки стрима ИИ) идут через один
+планировщик: общий лимит бота (~30 сообщений/с), лимит на чат (в группе
+~20 сообщений/мин, в личке ~1/с) и приоритеты — ответы пользователям
+уходят раньше приветствий при волне вступлений. При RetryAfter чат
+откладывается на указанное время, а сообщение отправляется повторно.
+"""
+
+import os
+import time
+import asyncio
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+PRIORITY_REPLY = 0  # ответы в личке
+PRIORITY_NORMAL = 1  # ответы в группах
+PRIORITY_BULK = 2  # приветствия и рассылка после одобрения заявок
+
+# Лимиты подобраны так, чтобы даже со всплеском не превышать ограничения Telegram
+OUTBOUND_GLOBAL_RPS = float(os.getenv('OUTBOUND_GLOBAL_RPS', 25))
+OUTBOUND_GLOBAL_BURST = float(os.getenv('OUTBOUND_GLOBAL_BURST', 5))
+OUTBOUND_GROUP_RPM = float(os.getenv('OUTBOUND_GROUP_RPM', 17))
+OUTBOUND_GROUP_BURST = float(os.getenv('OUTBOUND_GROUP_BURST', 3))
+OUTBOUND_PRIVATE_RPM = float(os.getenv('OUTBOUND_PRIVATE_RPM', 60))
+OUTBOUND_PRIVATE_BURST = float(os.getenv('OUTBOUND_PRIVATE_BURST', 3))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 3))  # повторов после RetryAfter
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    # В зависимости от PTB_TIMEDELTA retry_after — число секунд или timedelta
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class _Outgoing:
+    __slots__ = ('chat_id', 'call', 'priority', 'seq', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, chat_id, call, priority, seq, future):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def key(self):
+        return (self.priority, self.seq)
+
+
+class OutboundScheduler:
+    """
+    Отправляет вызовы Bot API по приоритету, не превышая общий лимит и лимит чата.
+
+    Сообщение в чат, исчерпавший свой лимит, не задерживает сообщения в другие
+    чаты; среди готовых к отправке выбирается самое приоритетное (а при равном
+    приоритете — самое раннее). Вызовы в разные чаты выполняются параллельно,
+    а в один чат — по одному, чтобы сообщения не менялись местами.
+    """
+
+    def __init__(self, max_retries: int = OUTBOUND_MAX_RETRIES):
+        self._global = RateLimiter(OUTBOUND_GLOBAL_RPS, 1.0, burst=OUTBOUND_GLOBAL_BURST, name='outbound_global')
+        self._private = RateLimiter.per_minute(OUTBOUND_PRIVATE_RPM, OUTBOUND_PRIVATE_BURST, name='outbound_private')
+        self._group = RateLimiter.per_minute(OUTBOUND_GROUP_RPM, OUTBOUND_GROUP_BURST, name='outbound_group')
+        self.max_retries = max_retries
+        self._pending: List[_Outgoing] = []
+        self._inflight: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _chat_limiter(self, chat_id: int) -> RateLimiter:
+        # У личных чатов id положительный, у групп и каналов — отрицательный
+        return self._private if chat_id > 0 else self._group
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]],
+                     priority: int = PRIORITY_NORMAL) -> Any:
+        """Ставит вызов call() в очередь и возвращает его результат."""
+        loop = asyncio.get_running_loop()
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        request = _Outgoing(chat_id, call, priority, next(self._seq), loop.create_future())
+        self._pending.append(request)
+        self._wakeup.set()
+        return await request.future
+
+    def queue_depth(self) -> int:
+        return sum(1 for r in self._pending if not r.future.done())
+
+    async def _sleep(self, seconds: float) -> None:
+        """Ждет seconds секунд или нового сообщения в очереди."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            # Отмененные ожидающими вызовы не отправляем
+            self._pending = [r for r in self._pending if not r.future.done()]
+            if not self._pending:
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            ready, wait = None, None
+            for request in self._pending:
+                if request.chat_id in self._inflight:
+                    continue
+                delay = self._chat_limiter(request.chat_id).retry_after(request.chat_id, now)
+                if delay == 0:
+                    if ready is None or request.key < ready.key:
+                        ready = request
+                elif wait is None or delay < wait:
+                    wait = delay
+            if ready is None:
+                # wait is None — все чаты заняты отправкой, ждем ее завершения
+                await self._sleep(wait)
+                continue
+
+            delay = self._global.retry_after(None, now)
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            # Между воркерами retry_after и try_acquire — разные транзакции:
+            # слот мог забрать другой воркер, тогда сообщение ждет в очереди
+            if not self._global.try_acquire(None, now):
+                await self._sleep(max(self._global.retry_after(None, now), 0.01))
+                continue
+            if not self._chat_limiter(ready.chat_id).try_acquire(ready.chat_id, now):
+                self._global.refund(None, now)
+                continue
+            self._pending.remove(ready)
+            self._inflight.add(ready.chat_id)
+            waited = now - ready.enqueued_at
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            task = asyncio.create_task(self._execute(ready))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, request: _Outgoing) -> None:
+        try:
+            await self._send(request)
+        finally:
+            self._inflight.discard(request.chat_id)
+            self._wakeup.set()
+
+    async def _send(self, request: _Outgoing) -> None:
+        try:
+            result = await request.call()
+        except RetryAfter as e:
+            self.retry_after += 1
+            seconds = _retry_after_seconds(e)
+            logger.warning(f"RetryAfter {seconds} сек. для чата {request.chat_id}")
+            self._chat_limiter(request.chat_id).defer(request.chat_id, seconds)
+            request.attempts += 1
+            if request.attempts > self.max_retries:
+                self.failed += 1
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            self._pending.append(request)
+        except Exception as e:
+            self.failed += 1
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queued': self.queue_depth(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retry_after,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+scheduler = OutboundScheduler()
+
+
+def _default_priority(chat_id: int) -> int:
+    return PRIORITY_REPLY if chat_id > 0 else PRIORITY_NORMAL
+
+
+async def send_message(bot: Bot, chat_id: int, text: str, priority: Optional[int] = None, **kwargs) -> Message:
+    """bot.send_message через очередь; по умолчанию личка — PRIORITY_REPLY, группы — PRIORITY_NORMAL."""
+    if priority is None:
+        priority = _default_priority(chat_id)
+    return await scheduler.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+
+async def reply_text(message: Message, text: str, priority: Optional[int] = None, **kwargs) -> Message:
+    """message.reply_text через очередь (тема форума подставляется PTB, как и раньше)."""
+    if priority is None:
+        priority = _default_priority(message.chat_id)
+    return await scheduler.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+
+
+async def edit_text(message: Message, text: str, priority: Optional[int] = None, **kwargs) -> Any:
+    """message.edit_text через очередь — правки тоже считаются в лимит чата."""
+    if priority is None:
+        priority = _default_priority(message.chat_id)
+    return await scheduler.submit(message.chat_id, lambda: message.edit_text(text, **kwargs), priority)
+
+
+async def reply_document(message: Message, document: Any, priority: Optional[int] = None, **kwargs) -> Message:
+    """message.reply_document через очередь."""
+    if priority is None:
+        priority = _default_priority(message.chat_id)
+    return await scheduler.submit(message.chat_id, lambda: message.reply_document(document, **kwargs), priority)
@@ -0,0 +1,290 @@
+# persistence.py
+"""
+Сохранение состояния бота между перезапусками в SQLite (WAL).
+
+Хранятся context.user_data, context.chat_data, состояния ConversationHandler
+(/font) и состояние ограничителей частоты (заявки на вступление, /font,
+лимиты Gemini) — после редеплоя пользователь не получает новый лимит и не
+теряет начатый диалог.
+
+PTB сам копит измененные записи и раз в PERSISTENCE_INTERVAL секунд вызывает
+update_*; здесь эти вызовы только складываются в буфер, а на диск все
+изменения одного прохода пишутся одной транзакцией в отдельном потоке.
+user_data и chat_data при старте не читаются: запись пользователя или чата
+подгружается при первом его обновлении (refresh_user_data/refresh_chat_data).
+"""
+
+import os
+import json
+import time
+import pickle
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import ratelimit
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3')  # пусто — без сохранения
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', 30))  # как часто PTB сбрасывает изменения, сек
+
+_DELETED = object()  # пометка в буфере: строку нужно удалить
+_LIMITER_PREFIX = 'limiter:'
+
+
+def _dumps(value: Any) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _conversation_key(key: Tuple) -> str:
+    # Ключ разговора — кортеж id чата/пользователя; в JSON он короче pickle
+    return json.dumps(key, separators=(',', ':'))
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    BasePersistence для Application поверх одного файла SQLite.
+
+    Таблицы user_data, chat_data (id -> pickle), conversations
+    (имя, ключ -> pickle состояния) и kv (bot_data и ограничители).
+    Пустые user_data/chat_data не хранятся вовсе: PTB помечает измененным
+    каждого пользователя, приславшего обновление, а у большинства данных нет.
+    """
+
+    def __init__(self, path: str = PERSISTENCE_PATH, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # Буфер изменений: таблица -> {ключ: значение или _DELETED}
+        self._dirty: Dict[str, Dict[Any, Any]] = {'user_data': {}, 'chat_data': {}, 'conversations': {}, 'kv': {}}
+        self._loaded: Dict[str, Set[int]] = {'user_data': set(), 'chat_data': set()}
+        self._loading: Dict[Tuple[str, int], asyncio.Future] = {}
+        # id, для которых в базе есть строка: пустые данные остальных не пишем даже удалением
+        self._stored: Dict[str, Set[int]] = {'user_data': set(), 'chat_data': set()}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.lazy_loads = 0
+        self.last_flush_seconds = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(
+                "CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL,"
+                " PRIMARY KEY (name, key)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS kv (name TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID;"
+            )
+        return self._db
+
+    # --- синхронная часть (в потоке) ---
+
+    def _read_one(self, table: str, key: int) -> Optional[Any]:
+        with self._db_lock:
+            row = self._connect().execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _read_kv(self) -> Dict[str, Any]:
+        with self._db_lock:
+            rows = self._connect().execute("SELECT name, data FROM kv").fetchall()
+        return {name: pickle.loads(data) for name, data in rows}
+
+    def _read_conversations(self, name: str) -> Dict[Tuple, Any]:
+        with self._db_lock:
+            rows = self._connect().execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def _write(self, batch: Dict[str, Dict[Any, Any]]) -> int:
+        written = 0
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                for table in ('user_data', 'chat_data'):
+                    for key, value in batch[table].items():
+                        if value is _DELETED:
+                            db.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+                        else:
+                            db.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", (key, value))
+                        written += 1
+                for (name, key), value in batch['conversations'].items():
+                    if value is _DELETED:
+                        db.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                    else:
+                        db.execute("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, key, value))
+                    written += 1
+                for name, value in batch['kv'].items():
+                    db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)", (name, value))
+                    written += 1
+        return written
+
+    def _close(self) -> None:
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # --- буфер и запись ---
+
+    def _stage(self, table: str, key: Any, value: Any) -> None:
+        self._dirty[table][key] = value
+        if self._flush_task is None or self._flush_task.done():
+            # Задача запускается после всех update_* текущего прохода PTB
+            # (они уже стоят в очереди цикла событий) и пишет их одной транзакцией
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    def _stage_data(self, table: str, key: int, data: Dict) -> None:
+        self._loaded[table].add(key)
+        stored = self._stored[table]
+        if data:
+            stored.add(key)
+            self._stage(table, key, _dumps(data))
+        elif key in stored:
+            stored.discard(key)
+            self._stage(table, key, _DELETED)
+
+    def _stage_limiters(self) -> None:
+        for name, limiter in ratelimit.limiters.items():
+            self._dirty['kv'][_LIMITER_PREFIX + name] = _dumps(limiter.export_state())
+
+    async def _flush_loop(self) -> None:
+        while any(self._dirty.values()):
+            batch = self._dirty
+            self._dirty = {table: {} for table in batch}
+            started = time.perf_counter()
+            try:
+                self.rows_written += await asyncio.to_thread(self._write, batch)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка сохранения состояния: {e}")
+                # Вернем несохраненное в буфер, не затирая более свежие изменения
+                for table, entries in batch.items():
+                    for key, value in entries.items():
+                        self._dirty[table].setdefault(key, value)
+                return
+            self.flushes += 1
+            self.last_flush_seconds = time.perf_counter() - started
+
+    # --- BasePersistence: чтение ---
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}  # загружаются по одному в refresh_user_data
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}  # загружаются по одному в refresh_chat_data
+
+    async def get_bot_data(self) -> Dict:
+        # Вызывается один раз в Application.initialize — тогда же восстанавливаем ограничители
+        stored = await asyncio.to_thread(self._read_kv)
+        restored = 0
+        for name, state in stored.items():
+            limiter = ratelimit.limiters.get(name[len(_LIMITER_PREFIX):]) if name.startswith(_LIMITER_PREFIX) else None
+            if limiter is not None:
+                limiter.import_state(state)
+                restored += 1
+        logger.info(f"✅ Состояние восстановлено из {self.path} (ограничителей: {restored})")
+        return stored.get('bot_data', {})
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        return await asyncio.to_thread(self._read_conversations, name)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        await self._refresh('user_data', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        await self._refresh('chat_data', chat_id, chat_data)
+
+    async def _refresh(self, table: str, key: int, data: Dict) -> None:
+        if key in self._loaded[table]:
+            return
+        # Два обновления одного нового пользователя из разных чатов ждут одно чтение
+        loading = self._loading.get((table, key))
+        if loading is None:
+            loading = asyncio.ensure_future(asyncio.to_thread(self._read_one, table, key))
+            self._loading[(table, key)] = loading
+            try:
+                stored = await loading
+            finally:
+                del self._loading[(table, key)]
+            self._loaded[table].add(key)
+            if stored:
+                self._stored[table].add(key)
+                self.lazy_loads += 1
+        else:
+            stored = await loading
+        for name, value in (stored or {}).items():
+            data.setdefault(name, value)
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    # --- BasePersistence: запись ---
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._stage_data('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._stage_data('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data: Dict) -> None:
+        # PTB вызывает это на каждом проходе — заодно сохраняем ограничители
+        self._stage_limiters()
+        self._stage('kv', 'bot_data', _dumps(data))
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        value = _DELETED if new_state is None else _dumps(new_state)
+        self._stage('conversations', (name, _conversation_key(key)), value)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded['user_data'].add(user_id)
+        self._stored['user_data'].discard(user_id)
+        self._stage('user_data', user_id, _DELETED)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded['chat_data'].add(chat_id)
+        self._stored['chat_data'].discard(chat_id)
+        self._stage('chat_data', chat_id, _DELETED)
+
+    async def flush(self) -> None:
+        """Вызывается PTB при остановке: дописывает буфер и закрывает базу."""
+        self._stage_limiters()
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._flush_loop()
+        await asyncio.to_thread(self._close)
+        logger.info(f"💾 Состояние сохранено в {self.path}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'lazy_loads': self.lazy_loads,
+            'pending': sum(len(entries) for entries in self._dirty.values()),
+            'last_flush_seconds': self.last_flush_seconds,
+        }
+
+
+def create_persistence() -> Optional[SQLitePersistence]:
+    """SQLitePersistence по PERSISTENCE_PATH или None, если сохранение выключено."""
+    return SQLitePersistence() if PERSISTENCE_PATH else None
@@ -0,0 +1,130 @@
+# processor.py
+"""
+Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+Обновления разных чатов (в личке — разных пользователей) обрабатываются
+одновременно, не больше UPDATE_CONCURRENCY сразу, а обновления одного чата —
+строго по очереди, как при последовательной обработке. Поэтому состояния
+ConversationHandler (/font) и порядок сообщений в чате сохраняются, а
+медленный ответ Gemini или проверка ссылок не задерживают остальные чаты.
+"""
+
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 32))  # одновременно выполняемых обновлений
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', 1024))  # принятых в обработку (выполняются + ждут)
+
+
+class _KeyQueue:
+    """Очередь обновлений одного чата: замок (FIFO) и число ожидающих вместе с выполняющимся."""
+
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Процессор обновлений для Application.builder().concurrent_updates(...).
+
+    Сначала берется замок ключа (чата), и только потом общий слот, поэтому
+    обновления, ждущие своей очереди в занятом чате, не занимают слоты других
+    чатов. Семафор базового класса ограничивает число принятых обновлений
+    (UPDATE_MAX_PENDING) — это верхняя граница памяти при всплеске.
+    """
+
+    __slots__ = ('_limit', '_slots', '_keys', 'processed')
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY,
+                 max_pending_updates: int = UPDATE_MAX_PENDING):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должен быть положительным")
+        self._limit = max_concurrent_updates
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._keys: Dict[Hashable, _KeyQueue] = {}
+        self.processed = 0
+
+    @property
+    def concurrency(self) -> int:
+        """Сколько обновлений выполняется одновременно (max_concurrent_updates — сколько принято)."""
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._limit - self._slots._value
+
+    @staticmethod
+    def update_key(update: object) -> Optional[Hashable]:
+        """
+        Ключ упорядочивания: id чата, а для обновлений без чата — id пользователя
+        (в личке они совпадают). None — порядок не важен.
+
+        Заявки на вступление упорядочиваются по пользователю: они приходят в один
+        чат, но друг от друга не зависят.
+        """
+        if not isinstance(update, Update):
+            return None
+        if update.chat_join_request:
+            return update.chat_join_request.from_user.id
+        chat = update.effective_chat
+        if chat is not None:
+            return chat.id
+        user = update.effective_user
+        return user.id if user is not None else None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.update_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            self.processed += 1
+            return
+
+        queue = self._keys.get(key)
+        if queue is None:
+            queue = self._keys[key] = _KeyQueue()
+        queue.depth += 1
+        try:
+            async with queue.lock:
+                async with self._slots:
+                    await coroutine
+            self.processed += 1
+        finally:
+            queue.depth -= 1
+            if queue.depth == 0:
+                del self._keys[key]
+
+    def depth(self, key: Hashable) -> int:
+        """Сколько обновлений чата ждут или выполняются."""
+        queue = self._keys.get(key)
+        return queue.depth if queue else 0
+
+    def depths(self) -> Dict[Hashable, int]:
+        return {key: queue.depth for key, queue in self._keys.items()}
+
+    def stats(self) -> Dict[str, float]:
+        depths = [queue.depth for queue in self._keys.values()]
+        return {
+            'running': self.current_concurrent_updates,
+            'pending': sum(depths),
+            'busy_keys': len(depths),
+            'max_key_depth': max(depths, default=0),
+            'processed': self.processed,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,193 @@
+# ratelimit.py
+"""
+Общий ограничитель частоты запросов (GCRA — Generic Cell Rate Algorithm).
+
+На каждый ключ хранится одно число — "теоретическое время прибытия" (TAT),
+проверка и обновление выполняются за O(1) без выделения памяти под историю
+запросов. Ключ, у которого TAT уже в прошлом, ничем не отличается от нового,
+поэтому фоновая очистка удаляет такие ключи без потери состояния.
+
+Используется для заявок на вступление, команды /font и очереди запросов к Gemini.
+Бенчмарк: python -m bench.ratelimit
+"""
+
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+from typing import Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+RATELIMIT_SWEEP_INTERVAL = float(os.getenv('RATELIMIT_SWEEP_INTERVAL', 60))  # как часто чистить, сек
+
+# Все созданные ограничители по имени (для фоновой очистки, метрик и сохранения состояния)
+limiters: Dict[str, 'RateLimiter'] = {}
+_sweeper: Optional[asyncio.Task] = None
+
+
+class RateLimiter:
+    """
+    Не больше max_requests запросов за period секунд на ключ,
+    из них подряд (всплеском) — не больше burst (по умолчанию max_requests).
+
+    Все методы синхронны и не содержат await, поэтому атомарны внутри цикла событий.
+    Если задан shared (shared_state.SharedState), состояние общее для всех
+    воркеров и хранится там, а не в _tat. Если общее состояние занято дольше
+    SHARED_STATE_BUSY_MS, операция выполняется по _tat, как без shared.
+    """
+
+    __slots__ = ('name', 'emission', 'tolerance', '_tat', 'shared')
+
+    def __init__(self, max_requests: float = 3, period: float = 300, burst: Optional[float] = None,
+                 name: Optional[str] = None):  # 3 запроса за 5 минут
+        if max_requests <= 0 or period <= 0:
+            raise ValueError("max_requests и period должны быть положительными")
+        self.emission = period / max_requests
+        self.tolerance = (max(1.0, burst if burst is not None else max_requests) - 1) * self.emission
+        self._tat: Dict[Hashable, float] = {}
+        self.shared = None
+        self.name = name or f"limiter_{len(limiters)}"
+        limiters[self.name] = self
+
+    @classmethod
+    def per_minute(cls, requests_per_minute: float, burst: float = 1, name: Optional[str] = None) -> 'RateLimiter':
+        return cls(requests_per_minute, 60.0, burst=burst, name=name)
+
+    def retry_after(self, key: Hashable = None, now: Optional[float] = None) -> float:
+        """Через сколько секунд ключ сможет сделать запрос (0 — прямо сейчас)."""
+        if now is None:
+            now = time.monotonic()
+        if self.shared is not None:
+            try:
+                return self.shared.retry_after(self, key, now)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        tat = self._tat.get(key, now)
+        return max(0.0, tat - self.tolerance - now)
+
+    def try_acquire(self, key: Hashable = None, now: Optional[float] = None) -> bool:
+        """Учитывает запрос, если он разрешен. Возвращает, разрешен ли он."""
+        if now is None:
+            now = time.monotonic()
+        if self.shared is not None:
+            _ensure_sweeper()
+            try:
+                return self.shared.try_acquire(self, key, now)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        tat = self._tat.get(key)
+        if tat is None:
+            # Новый ключ — только тогда может понадобиться фоновая очистка
+            _ensure_sweeper()
+            tat = now
+        elif tat < now:
+            tat = now
+        if tat - now > self.tolerance:
+            return False
+        self._tat[key] = tat + self.emission
+        return True
+
+    # Совместимость с прежним handlers.RateLimiter
+    is_allowed = try_acquire
+
+    async def acquire(self, key: Hashable = None, timeout: Optional[float] = None) -> bool:
+        """Ждет, пока запрос станет разрешен (не дольше timeout). Возвращает, дождались ли."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire(key):
+            wait = self.retry_after(key)
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    def defer(self, key: Hashable, seconds: float, now: Optional[float] = None) -> None:
+        """Запрещает запросы ключа еще на seconds секунд (например, по RetryAfter от Telegram)."""
+        if now is None:
+            now = time.monotonic()
+        if self.shared is not None:
+            try:
+                self.shared.defer(self, key, seconds, now)
+                return
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        if key not in self._tat:
+            _ensure_sweeper()
+        self._tat[key] = max(self._tat.get(key, now), now + seconds + self.tolerance)
+
+    def refund(self, key: Hashable = None, now: Optional[float] = None) -> None:
+        """
+        Возвращает слот, занятый try_acquire, если запрос так и не был отправлен
+        (например, другой ограничитель того же запроса отказал).
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.shared is not None:
+            try:
+                self.shared.refund(self, key, now)
+                return
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        tat = self._tat.get(key)
+        if tat is not None:
+            self._tat[key] = tat - self.emission
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Удаляет простаивающие ключи (TAT в прошлом). Возвращает число удаленных."""
+        if now is None:
+            now = time.monotonic()
+        removed = 0
+        if self.shared is not None:
+            try:
+                removed = self.shared.sweep(self, now)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        # В режиме shared здесь только ключи операций, выполненных локально
+        idle = [key for key, tat in self._tat.items() if tat <= now]
+        for key in idle:
+            del self._tat[key]
+        return removed + len(idle)
+
+    def __len__(self) -> int:
+        if self.shared is not None:
+            try:
+                return self.shared.count(self)
+            except sqlite3.OperationalError as e:
+                self.shared.fallback(e)
+        return len(self._tat)
+
+    def export_state(self) -> Dict[Hashable, float]:
+        """Состояние в виде {ключ: TAT по time.time()}, которое переживает перезапуск."""
+        if self.shared is not None:
+            return {}  # общее состояние и так хранится на диске
+        offset = time.time() - time.monotonic()
+        now = time.monotonic()
+        return {key: tat + offset for key, tat in self._tat.items() if tat > now}
+
+    def import_state(self, state: Dict[Hashable, float]) -> None:
+        if self.shared is not None:
+            return
+        offset = time.time() - time.monotonic()
+        for key, wall_tat in state.items():
+            self._tat[key] = max(self._tat.get(key, 0.0), wall_tat - offset)
+
+
+async def _sweep_loop(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        removed = sum(limiter.sweep(now) for limiter in list(limiters.values()))
+        if removed:
+            logger.debug(f"Очищено {removed} неактивных ключей ограничителей")
+
+
+def _ensure_sweeper() -> None:
+    global _sweeper
+    if _sweeper is not None and not _sweeper.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # вне цикла событий очистка не нужна
+    _sweeper = loop.create_task(_sweep_loop(RATELIMIT_SWEEP_INTERVAL))
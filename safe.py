@@ -3,25 +3,845 @@
 Модуль для проверки безопасности ссылок через Google Safe Browsing API.
 Упрощенная версия без использования реакций Telegram, чтобы избежать
 конфликтов версий библиотеки python-telegram-bot.
+
+Все обращения к API идут через асинхронный SafeBrowsingClient с общим
+keep-alive пулом соединений, поэтому проверка ссылок не блокирует цикл
+событий бота.
 """
 
 import os
+import re
+import sys
+import time
+import base64
+import bisect
+import heapq
+import hashlib
 import logging
 import asyncio
-import requests
+import posixpath
+from array import array
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote_to_bytes, urlsplit
+
 from telegram import Update
 from telegram.ext import ContextTypes
-from dotenv import load_dotenv
+import config  # .env загружен до чтения настроек ниже
+import metrics
 
-# Загружаем переменные окружения
-load_dotenv()
+if TYPE_CHECKING:
+    import aiohttp  # сам клиент импортируется при первом запросе
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
 # Конфигурация Google Safe Browsing
 GOOGLE_SAFE_BROWSING_API_KEY = os.getenv('GOOGLE_SAFE_BROWSING_API_KEY')
-GOOGLE_SAFE_BROWSING_URL = 'https://safebrowsing.googleapis.com/v4/threatMatches:find'
+GOOGLE_SAFE_BROWSING_API_ROOT = os.getenv('GOOGLE_SAFE_BROWSING_API_ROOT', 'https://safebrowsing.googleapis.com/v4')
+GOOGLE_SAFE_BROWSING_URL = f'{GOOGLE_SAFE_BROWSING_API_ROOT}/threatMatches:find'
+
+# Режим проверки: "lookup" — каждый промах кеша идет в threatMatches:find,
+# "update" — локальная база префиксов хешей (threatListUpdates:fetch + fullHashes:find)
+SAFE_BROWSING_MODE = os.getenv('SAFE_BROWSING_MODE', 'lookup').lower()
+SAFE_BROWSING_UPDATE_INTERVAL = float(os.getenv('SAFE_BROWSING_UPDATE_INTERVAL', 1800))  # если API не задал паузу
+
+# Настройки HTTP клиента
+SAFE_BROWSING_TIMEOUT = float(os.getenv('SAFE_BROWSING_TIMEOUT', 5))  # общий таймаут запроса, сек
+SAFE_BROWSING_CONNECT_TIMEOUT = float(os.getenv('SAFE_BROWSING_CONNECT_TIMEOUT', 2))
+SAFE_BROWSING_MAX_CONCURRENCY = int(os.getenv('SAFE_BROWSING_MAX_CONCURRENCY', 8))  # одновременных запросов
+SAFE_BROWSING_KEEPALIVE = float(os.getenv('SAFE_BROWSING_KEEPALIVE', 60))  # сколько держать соединение
+
+# Настройки кеша вердиктов
+SAFE_BROWSING_CACHE_SIZE = int(os.getenv('SAFE_BROWSING_CACHE_SIZE', 10000))  # максимум ссылок в кеше
+SAFE_BROWSING_SAFE_TTL = float(os.getenv('SAFE_BROWSING_SAFE_TTL', 1800))  # сколько помнить безопасные, сек
+SAFE_BROWSING_UNSAFE_TTL = float(os.getenv('SAFE_BROWSING_UNSAFE_TTL', 3600))  # если API не прислал cacheDuration
+
+# Объединение ссылок из разных сообщений в один запрос
+SAFE_BROWSING_BATCH_WINDOW_MS = float(os.getenv('SAFE_BROWSING_BATCH_WINDOW_MS', 50))  # 0 — без объединения
+SAFE_BROWSING_BATCH_SIZE = int(os.getenv('SAFE_BROWSING_BATCH_SIZE', 500))  # лимит threatEntries в API
+
+CLIENT_INFO = {
+    "clientId": "telegram-bot-safety-check",
+    "clientVersion": "1.0.0"
+}
+THREAT_TYPES = [
+    "MALWARE",
+    "SOCIAL_ENGINEERING",
+    "UNWANTED_SOFTWARE",
+    "POTENTIALLY_HARMFUL_APPLICATION"
+]
+
+
+class SafeBrowsingError(Exception):
+    """Ошибка обращения к Google Safe Browsing API."""
+
+
+# ========================================
+# АСИНХРОННЫЙ КЛИЕНТ
+# ========================================
+class SafeBrowsingClient:
+    """
+    Асинхронный клиент Google Safe Browsing с одним общим пулом соединений.
+
+    Сессия (и сам aiohttp) создается лениво при первом запросе внутри работающего
+    цикла событий, число одновременных запросов ограничено семафором.
+    """
+
+    def __init__(self, api_key: Optional[str], *, timeout: float = SAFE_BROWSING_TIMEOUT,
+                 connect_timeout: float = SAFE_BROWSING_CONNECT_TIMEOUT,
+                 max_concurrency: int = SAFE_BROWSING_MAX_CONCURRENCY,
+                 keepalive: float = SAFE_BROWSING_KEEPALIVE,
+                 api_root: str = GOOGLE_SAFE_BROWSING_API_ROOT):
+        self.api_key = api_key
+        self.api_root = api_root.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self._timeout = (timeout, connect_timeout)
+        self._keepalive = keepalive
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        if self._session is None or self._session.closed:
+            import aiohttp
+            total, connect = self._timeout
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=self._keepalive,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=total, connect=connect)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _post(self, url: str, payload: dict) -> dict:
+        import aiohttp
+        session = self._get_session()
+        async with self._semaphore:
+            try:
+                with metrics.upstream('safe_browsing', url.rsplit('/', 1)[-1]):
+                    async with session.post(url, params={'key': self.api_key}, json=payload) as response:
+                        response.raise_for_status()
+                        return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise SafeBrowsingError(str(e) or type(e).__name__) from e
+
+    async def find_threats(self, urls: Iterable[str]) -> Dict[str, Optional[float]]:
+        """
+        Проверяет ссылки через threatMatches:find.
+
+        Returns:
+            Опасные ссылки (в том виде, в каком они были переданы) и для каждой
+            cacheDuration из ответа API в секундах (None, если API его не прислал)
+
+        Raises:
+            SafeBrowsingError: при сетевой ошибке, таймауте или ответе с ошибкой
+        """
+        urls = list(dict.fromkeys(urls))
+        if not urls:
+            return {}
+
+        payload = {
+            "client": CLIENT_INFO,
+            "threatInfo": {
+                "threatTypes": THREAT_TYPES,
+                "platformTypes": ["ANY_PLATFORM"],
+                "threatEntryTypes": ["URL"],
+                "threatEntries": [{"url": url} for url in urls]
+            }
+        }
+        data = await self._post(f'{self.api_root}/threatMatches:find', payload)
+
+        threats: Dict[str, Optional[float]] = {}
+        for match in data.get('matches') or []:
+            url = match['threat']['url']
+            duration = _parse_duration(match.get('cacheDuration'))
+            # Одна ссылка может совпасть с несколькими списками — берем самый короткий срок
+            if url in threats and threats[url] is not None and duration is not None:
+                duration = min(threats[url], duration)
+            threats[url] = duration
+        return threats
+
+    async def fetch_list_updates(self, list_states: Dict[Tuple[str, str, str], str]) -> dict:
+        """Запрашивает threatListUpdates:fetch для списков с указанными состояниями."""
+        payload = {
+            "client": CLIENT_INFO,
+            "listUpdateRequests": [
+                {
+                    "threatType": threat_type,
+                    "platformType": platform_type,
+                    "threatEntryType": entry_type,
+                    "state": state,
+                    "constraints": {"supportedCompressions": ["RAW"]}
+                }
+                for (threat_type, platform_type, entry_type), state in list_states.items()
+            ]
+        }
+        return await self._post(f'{self.api_root}/threatListUpdates:fetch', payload)
+
+    async def find_full_hashes(self, prefixes: Iterable[bytes], client_states: Iterable[str]) -> dict:
+        """Запрашивает полные хеши для префиксов через fullHashes:find."""
+        payload = {
+            "client": CLIENT_INFO,
+            "clientStates": list(client_states),
+            "threatInfo": {
+                "threatTypes": THREAT_TYPES,
+                "platformTypes": ["ANY_PLATFORM"],
+                "threatEntryTypes": ["URL"],
+                "threatEntries": [{"hash": base64.b64encode(p).decode()} for p in prefixes]
+            }
+        }
+        return await self._post(f'{self.api_root}/fullHashes:find', payload)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_client: Optional[SafeBrowsingClient] = None
+
+
+def get_client() -> SafeBrowsingClient:
+    """Возвращает общий для всего бота клиент Safe Browsing."""
+    global _client
+    if _client is None:
+        _client = SafeBrowsingClient(GOOGLE_SAFE_BROWSING_API_KEY)
+    return _client
+
+
+async def close_client() -> None:
+    """Закрывает пул соединений общего клиента (вызывается при остановке бота)."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Разбирает длительность protobuf Duration вида "300s" или "1.5s"."""
+    if not value:
+        return None
+    try:
+        return float(value.rstrip('s'))
+    except ValueError:
+        return None
+
+
+# ========================================
+# КАНОНИЗАЦИЯ ССЫЛОК
+# ========================================
+_STRIP_CHARS = str.maketrans('', '', '\t\r\n')
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _full_unquote(value: str) -> bytes:
+    """Повторно раскодирует %XX, пока строка не перестанет меняться."""
+    data = value.encode('utf-8', 'surrogateescape')
+    while True:
+        decoded = unquote_to_bytes(data)
+        if decoded == data:
+            return data
+        data = decoded
+
+
+def _quote(data: bytes) -> str:
+    # Экранируем управляющие символы, пробел, не-ASCII, '#' и '%', остальное как есть
+    return quote(data, safe=bytes(c for c in range(33, 127) if c not in b'#%'))
+
+
+def _normalize_ip(host: str) -> Optional[str]:
+    """Приводит IPv4 в любой записи (десятичной, восьмеричной, hex) к a.b.c.d."""
+    parts = host.split('.')
+    if not 1 <= len(parts) <= 4:
+        return None
+    numbers = []
+    for part in parts:
+        try:
+            if part.lower().startswith('0x'):
+                numbers.append(int(part[2:] or '0', 16))
+            elif len(part) > 1 and part.startswith('0'):
+                numbers.append(int(part, 8))
+            else:
+                numbers.append(int(part, 10))
+        except ValueError:
+            return None
+    # Последняя часть занимает все оставшиеся байты (как в inet_aton)
+    value = 0
+    for number in numbers[:-1]:
+        if number > 255:
+            return None
+        value = value << 8 | number
+    tail_bits = 8 * (5 - len(numbers))
+    if numbers[-1] >= 1 << tail_bits:
+        return None
+    value = value << tail_bits | numbers[-1]
+    return '.'.join(str(value >> shift & 0xFF) for shift in (24, 16, 8, 0))
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Канонизирует ссылку по правилам Safe Browsing v4 (раздел "URLs and Hashing"):
+    убирает фрагмент и учетные данные, раскодирует %XX, нормализует хост, IP и путь.
+
+    Одинаковые по смыслу ссылки дают одну и ту же строку, поэтому она
+    используется как ключ кеша вердиктов.
+    """
+    url = url.strip().translate(_STRIP_CHARS)
+    url = url.split('#', 1)[0]
+    if '://' not in url:
+        url = 'http://' + url
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower() or 'http'
+
+    host = _full_unquote(parts.hostname or '').decode('utf-8', 'replace')
+    host = re.sub(r'\.{2,}', '.', host.strip('.')).lower()
+    host = _normalize_ip(host) or host
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and port != _DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+
+    path = _full_unquote(parts.path or '/').decode('utf-8', 'surrogateescape')
+    trailing_slash = path.endswith('/') or path.endswith('/.') or path.endswith('/..')
+    path = posixpath.normpath('/' + path.lstrip('/'))
+    path = re.sub(r'/{2,}', '/', path)
+    if trailing_slash and not path.endswith('/'):
+        path += '/'
+
+    canonical = f"{scheme}://{_quote(host.encode('utf-8'))}{_quote(path.encode('utf-8', 'surrogateescape'))}"
+    if parts.query or url.endswith('?'):
+        canonical += '?' + _quote(_full_unquote(parts.query))
+    return canonical
+
+
+def url_expressions(canonical_url: str) -> List[str]:
+    """
+    Возвращает выражения "хост/путь" для хеширования (до 5 хостов x 6 путей),
+    как описано в разделе "Suffix/Prefix Expressions" Safe Browsing v4.
+    """
+    rest = canonical_url.split('://', 1)[-1]
+    host, _, path_query = rest.partition('/')
+    host = host.rsplit(':', 1)[0] if ':' in host else host
+    path, has_query, query = ('/' + path_query).partition('?')
+
+    hosts = [host]
+    if not _normalize_ip(host):
+        labels = host.split('.')
+        # Последние 5 компонентов, затем по одному слева, но не один только TLD
+        start = max(1, len(labels) - 5)
+        hosts += ['.'.join(labels[i:]) for i in range(start, len(labels) - 1)]
+
+    paths = []
+    if has_query:
+        paths.append(f'{path}?{query}')
+    paths.append(path)
+    if path != '/':
+        paths.append('/')
+        components = path.strip('/').split('/')
+        prefix = '/'
+        for component in components[:-1][:3]:
+            prefix += component + '/'
+            paths.append(prefix)
+
+    return list(dict.fromkeys(h + p for h in hosts for p in paths))
+
+
+# ========================================
+# ЛОКАЛЬНАЯ БАЗА ПРЕФИКСОВ (UPDATE API)
+# ========================================
+class HashPrefixSet:
+    """
+    Компактное неизменяемое множество префиксов SHA256 (от 4 до 32 байт).
+
+    Префиксы каждой длины лежат одной отсортированной таблицей: 4-байтовые
+    (почти все записи) — в array('I') как big-endian числа, остальные —
+    одним bytes-блоком. Поиск — бинарный, без Python-объекта на каждый префикс.
+    """
+
+    __slots__ = ('_ints', '_blobs', '_count')
+
+    def __init__(self, prefixes: Iterable[bytes] = ()):
+        by_length: Dict[int, List[bytes]] = {}
+        for prefix in prefixes:
+            by_length.setdefault(len(prefix), []).append(prefix)
+
+        self._ints = array('I')
+        self._blobs: Dict[int, bytes] = {}
+        self._count = 0
+        for length, items in by_length.items():
+            items = sorted(set(items))
+            self._count += len(items)
+            blob = b''.join(items)
+            if length == 4 and self._ints.itemsize == 4:
+                self._ints.frombytes(blob)
+                if sys.byteorder == 'little':
+                    self._ints.byteswap()
+            else:
+                self._blobs[length] = blob
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._ints) * self._ints.itemsize + sum(len(b) for b in self._blobs.values())
+
+    def match(self, full_hash: bytes) -> Optional[bytes]:
+        """Возвращает префикс, которым начинается full_hash, или None."""
+        if self._ints:
+            value = int.from_bytes(full_hash[:4], 'big')
+            i = bisect.bisect_left(self._ints, value)
+            if i < len(self._ints) and self._ints[i] == value:
+                return full_hash[:4]
+        for length, blob in self._blobs.items():
+            target = full_hash[:length]
+            lo, hi = 0, len(blob) // length
+            while lo < hi:
+                mid = (lo + hi) // 2
+                item = blob[mid * length:(mid + 1) * length]
+                if item < target:
+                    lo = mid + 1
+                elif item > target:
+                    hi = mid
+                else:
+                    return target
+        return None
+
+    def sorted_prefixes(self) -> Iterable[bytes]:
+        """Все префиксы в лексикографическом порядке (как их индексирует API)."""
+        iterators = [(value.to_bytes(4, 'big') for value in self._ints)]
+        for length, blob in self._blobs.items():
+            iterators.append(blob[i:i + length] for i in range(0, len(blob), length))
+        return heapq.merge(*iterators)
+
+    def apply_update(self, additions: Iterable[bytes], removal_indices: Iterable[int]) -> Tuple['HashPrefixSet', bytes]:
+        """
+        Применяет частичное обновление: сначала удаляет записи по индексам
+        в текущем отсортированном списке, затем добавляет новые префиксы.
+
+        Returns:
+            Новое множество и SHA256 его отсортированного содержимого для сверки с checksum
+        """
+        removed = set(removal_indices)
+        merged = [p for i, p in enumerate(self.sorted_prefixes()) if i not in removed]
+        merged.extend(additions)
+        merged.sort()
+        return HashPrefixSet(merged), hashlib.sha256(b''.join(merged)).digest()
+
+
+def _decode_raw_hashes(additions: List[dict]) -> List[bytes]:
+    prefixes = []
+    for addition in additions:
+        if addition.get('compressionType', 'RAW') != 'RAW':
+            raise SafeBrowsingError(f"Неподдерживаемое сжатие: {addition.get('compressionType')}")
+        raw = addition.get('rawHashes') or {}
+        size = int(raw.get('prefixSize', 4))
+        data = base64.b64decode(raw.get('rawHashes', ''))
+        prefixes.extend(data[i:i + size] for i in range(0, len(data), size))
+    return prefixes
+
+
+def _decode_raw_indices(removals: List[dict]) -> List[int]:
+    indices = []
+    for removal in removals:
+        indices.extend((removal.get('rawIndices') or {}).get('indices', []))
+    return indices
+
+
+class LocalThreatDatabase:
+    """
+    Локальная копия списков угроз Safe Browsing v4.
+
+    Ссылка проверяется локально по префиксам хешей её выражений; в сеть
+    (fullHashes:find) уходят только совпавшие префиксы.
+    """
+
+    def __init__(self, threat_types: Iterable[str] = THREAT_TYPES):
+        self._lists: Dict[Tuple[str, str, str], Tuple[str, HashPrefixSet]] = {
+            (threat_type, "ANY_PLATFORM", "URL"): ('', HashPrefixSet())
+            for threat_type in threat_types
+        }
+        self.next_update_at = 0.0
+        self.updated_at: Optional[float] = None
+        self.local_hits = 0
+        self.local_clears = 0
+        self.full_hash_requests = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.updated_at is not None
+
+    async def update(self, client: SafeBrowsingClient) -> float:
+        """
+        Синхронизирует списки (полные или инкрементальные обновления).
+
+        Returns:
+            Сколько секунд ждать до следующего обновления (minimumWaitDuration)
+        """
+        states = {key: state for key, (state, _) in self._lists.items()}
+        data = await client.fetch_list_updates(states)
+
+        for response in data.get('listUpdateResponses') or []:
+            key = (response['threatType'], response['platformType'], response['threatEntryType'])
+            if key not in self._lists:
+                continue
+            state, prefixes = self._lists[key]
+            if response.get('responseType') == 'FULL_UPDATE':
+                prefixes = HashPrefixSet()
+
+            additions = _decode_raw_hashes(response.get('additions') or [])
+            removals = _decode_raw_indices(response.get('removals') or [])
+            # Обновление в отдельном потоке: сортировка больших списков не должна держать цикл событий
+            new_prefixes, digest = await asyncio.to_thread(prefixes.apply_update, additions, removals)
+
+            expected = base64.b64decode((response.get('checksum') or {}).get('sha256', ''))
+            if expected and digest != expected:
+                # Локальная копия разошлась с сервером — при следующем запросе берем список целиком
+                logger.error(f"Safe Browsing: контрольная сумма {key[0]} не совпала, сбрасываем список")
+                self._lists[key] = ('', HashPrefixSet())
+                continue
+
+            self._lists[key] = (response.get('newClientState', state), new_prefixes)
+
+        self.updated_at = time.monotonic()
+        wait = _parse_duration(data.get('minimumWaitDuration')) or SAFE_BROWSING_UPDATE_INTERVAL
+        self.next_update_at = self.updated_at + wait
+        logger.info(f"Safe Browsing: база обновлена, {len(self)} префиксов ({self.nbytes} байт)")
+        return wait
+
+    def __len__(self) -> int:
+        return sum(len(prefixes) for _, prefixes in self._lists.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(prefixes.nbytes for _, prefixes in self._lists.values())
+
+    def match_prefixes(self, canonical_url: str) -> Tuple[Set[bytes], Set[bytes]]:
+        """Возвращает (полные хеши выражений ссылки, совпавшие локально префиксы)."""
+        hashes = {hashlib.sha256(expr.encode('utf-8', 'surrogateescape')).digest()
+                  for expr in url_expressions(canonical_url)}
+        hits = set()
+        for full_hash in hashes:
+            for _, prefixes in self._lists.values():
+                prefix = prefixes.match(full_hash)
+                if prefix is not None:
+                    hits.add(prefix)
+        return hashes, hits
+
+    async def find_threats(self, canonical_urls: Iterable[str], client: SafeBrowsingClient) -> Dict[str, Optional[float]]:
+        """То же, что SafeBrowsingClient.find_threats, но через локальную базу."""
+        candidates: Dict[str, Set[bytes]] = {}
+        all_hits: Set[bytes] = set()
+        for url in canonical_urls:
+            hashes, hits = self.match_prefixes(url)
+            if hits:
+                candidates[url] = hashes
+                all_hits |= hits
+                self.local_hits += 1
+            else:
+                self.local_clears += 1
+
+        if not candidates:
+            return {}
+
+        self.full_hash_requests += 1
+        data = await client.find_full_hashes(all_hits, (state for state, _ in self._lists.values()))
+        full_hashes: Dict[bytes, Optional[float]] = {}
+        for match in data.get('matches') or []:
+            full_hash = base64.b64decode(match['threat']['hash'])
+            full_hashes[full_hash] = _parse_duration(match.get('cacheDuration'))
+
+        threats: Dict[str, Optional[float]] = {}
+        for url, hashes in candidates.items():
+            matched = hashes & full_hashes.keys()
+            if matched:
+                durations = [full_hashes[h] for h in matched if full_hashes[h] is not None]
+                threats[url] = min(durations) if durations else None
+        return threats
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'prefixes': len(self),
+            'bytes': self.nbytes,
+            'local_hits': self.local_hits,
+            'local_clears': self.local_clears,
+            'full_hash_requests': self.full_hash_requests,
+        }
+
+
+local_database = LocalThreatDatabase()
+_update_task: Optional[asyncio.Task] = None
+
+
+async def _update_loop(client: SafeBrowsingClient) -> None:
+    backoff = 60.0
+    while True:
+        try:
+            wait = await local_database.update(client)
+            backoff = 60.0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка обновления базы Safe Browsing: {e}")
+            wait, backoff = backoff, min(backoff * 2, 3600.0)
+        await asyncio.sleep(wait)
+
+
+def start_local_database() -> Optional[asyncio.Task]:
+    """Запускает фоновую синхронизацию локальной базы (только в режиме "update")."""
+    global _update_task
+    if SAFE_BROWSING_MODE != 'update' or not GOOGLE_SAFE_BROWSING_API_KEY:
+        return None
+    if _update_task is None or _update_task.done():
+        _update_task = asyncio.create_task(_update_loop(get_client()))
+        logger.info("Safe Browsing: включен режим локальной базы (Update API)")
+    return _update_task
+
+
+async def stop_local_database() -> None:
+    global _update_task
+    if _update_task is not None:
+        _update_task.cancel()
+        try:
+            await _update_task
+        except asyncio.CancelledError:
+            pass
+        _update_task = None
+
+
+# ========================================
+# КЕШ ВЕРДИКТОВ
+# ========================================
+class VerdictCache:
+    """
+    Ограниченный по размеру LRU-кеш вердиктов с отдельными TTL
+    для безопасных и опасных ссылок.
+
+    Ключ — канонизированная ссылка, значение — (срок годности, опасна ли).
+    """
+
+    def __init__(self, max_size: int = SAFE_BROWSING_CACHE_SIZE,
+                 safe_ttl: float = SAFE_BROWSING_SAFE_TTL,
+                 unsafe_ttl: float = SAFE_BROWSING_UNSAFE_TTL):
+        self.max_size = max_size
+        self.safe_ttl = safe_ttl
+        self.unsafe_ttl = unsafe_ttl
+        self._entries: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, canonical_url: str) -> Optional[bool]:
+        """Возвращает True/False (опасна ли ссылка) или None, если вердикта нет."""
+        entry = self._entries.get(canonical_url)
+        if entry is not None:
+            expires_at, dangerous = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(canonical_url)
+                self.hits += 1
+                return dangerous
+            del self._entries[canonical_url]
+        self.misses += 1
+        return None
+
+    def put(self, canonical_url: str, dangerous: bool, ttl: Optional[float] = None) -> None:
+        """Сохраняет вердикт; ttl (например, cacheDuration из API) заменяет TTL по умолчанию."""
+        if ttl is None:
+            ttl = self.unsafe_ttl if dangerous else self.safe_ttl
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._entries[canonical_url] = (time.monotonic() + ttl, dangerous)
+        self._entries.move_to_end(canonical_url)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+verdict_cache = VerdictCache()
+
+
+# ========================================
+# ОБЪЕДИНЕНИЕ ЗАПРОСОВ (MICRO-BATCHING)
+# ========================================
+Threats = Dict[str, Optional[float]]
+
+
+class LookupBatcher:
+    """
+    Собирает ссылки из одновременно обрабатываемых сообщений в течение
+    короткого окна (или до max_size ссылок) и проверяет их одним запросом,
+    затем раздает вердикты всем ожидающим обработчикам.
+
+    Одна и та же ссылка из разных сообщений проверяется один раз.
+    """
+
+    def __init__(self, resolve: Callable[[List[str]], Awaitable[Threats]],
+                 window: float = SAFE_BROWSING_BATCH_WINDOW_MS / 1000,
+                 max_size: int = SAFE_BROWSING_BATCH_SIZE):
+        self._resolve = resolve
+        self.window = window
+        self.max_size = max(1, max_size)
+        self._pending: "OrderedDict[str, Tuple[asyncio.Future, float]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Ссылки на запущенные пакеты, чтобы задачи не собрал сборщик мусора
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.entries = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    async def submit(self, urls: Iterable[str]) -> Threats:
+        """Возвращает опасные ссылки из urls с их cacheDuration (как find_threats)."""
+        urls = list(dict.fromkeys(urls))
+        if self.window <= 0:
+            self._record(len(urls), 0.0, 0.0)
+            return await self._resolve(urls)
+
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        futures = []
+        for url in urls:
+            if url not in self._pending:
+                self._pending[url] = (loop.create_future(), now)
+            futures.append(self._pending[url][0])
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        results = await asyncio.gather(*(asyncio.shield(f) for f in futures))
+        return {url: ttl for url, (dangerous, ttl) in zip(urls, results) if dangerous}
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < self.max_size:
+                batch.append(self._pending.popitem(last=False))
+            # Добавленная задержка — сколько ссылка ждала в окне до отправки
+            delays = [now - enqueued for _, (_, enqueued) in batch]
+            self._record(len(batch), sum(delays), max(delays))
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _record(self, size: int, delay_sum: float, delay_max: float) -> None:
+        self.batches += 1
+        self.entries += size
+        self.total_delay += delay_sum
+        self.max_delay = max(self.max_delay, delay_max)
+
+    async def _run_batch(self, batch: List[Tuple[str, Tuple[asyncio.Future, float]]]) -> None:
+        try:
+            threats = await self._resolve([url for url, _ in batch])
+        except Exception as e:
+            for _, (future, _) in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    # Ожидавшие могли уже уйти по таймауту — иначе asyncio
+                    # пишет "Future exception was never retrieved"
+                    future.exception()
+            return
+        for url, (future, _) in batch:
+            if not future.done():
+                future.set_result((url in threats, threats.get(url)))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'batches': self.batches,
+            'entries': self.entries,
+            'fill_ratio': self.entries / (self.batches * self.max_size) if self.batches else 0.0,
+            'avg_added_latency': self.total_delay / self.entries if self.entries else 0.0,
+            'max_added_latency': self.max_delay,
+        }
+
+
+async def _resolve_misses(urls: List[str], client: Optional[SafeBrowsingClient] = None) -> Threats:
+    client = client or get_client()
+    if SAFE_BROWSING_MODE == 'update' and local_database.ready:
+        return await local_database.find_threats(urls, client)
+    return await client.find_threats(urls)
+
+
+lookup_batcher = LookupBatcher(_resolve_misses)
+
+
+async def lookup_urls(urls: Iterable[str], client: Optional[SafeBrowsingClient] = None) -> Set[str]:
+    """
+    Возвращает опасные ссылки из urls (в исходном виде).
+
+    Ссылки канонизируются, вердикты берутся из verdict_cache, а промахи
+    кеша проверяются через lookup_batcher вместе со ссылками из других
+    сообщений (с отдельным client — сразу, без объединения).
+
+    Raises:
+        SafeBrowsingError: если запрос для промахов кеша не удался
+    """
+    canonical: Dict[str, List[str]] = {}
+    for url in urls:
+        canonical.setdefault(canonicalize_url(url), []).append(url)
+
+    dangerous: Set[str] = set()
+    misses = []
+    for key, originals in canonical.items():
+        verdict = verdict_cache.get(key)
+        if verdict is None:
+            misses.append(key)
+        elif verdict:
+            dangerous.update(originals)
+
+    if misses:
+        if client is None:
+            threats = await lookup_batcher.submit(misses)
+        else:
+            threats = await _resolve_misses(misses, client)
+        for key in misses:
+            is_dangerous = key in threats
+            verdict_cache.put(key, is_dangerous, threats.get(key))
+            if is_dangerous:
+                dangerous.update(canonical[key])
+
+    if canonical:
+        logger.debug(f"Safe Browsing: {len(canonical) - len(misses)} из кеша, {len(misses)} в API")
+    return dangerous
+
+
+def _extract_urls(update: Update) -> List[str]:
+    urls = []
+    if update.message.entities:
+        for entity in update.message.entities:
+            if entity.type == 'url':
+                url = update.message.text[entity.offset:entity.offset + entity.length]
+                urls.append(url)
+                logger.info(f"Найдена ссылка: {url}")
+            elif entity.type == 'text_link':
+                urls.append(entity.url)
+                logger.info(f"Найдена текстово-гиперссылка: {entity.url}")
+    return urls
+
 
 async def check_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -45,16 +865,7 @@ async def check_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     
     # Извлекаем все ссылки из сообщения
-    urls = []
-    if update.message.entities:
-        for entity in update.message.entities:
-            if entity.type == 'url':
-                url = update.message.text[entity.offset:entity.offset + entity.length]
-                urls.append(url)
-                logger.info(f"Найдена ссылка: {url}")
-            elif entity.type == 'text_link':
-                urls.append(entity.url)
-                logger.info(f"Найдена текстово-гиперссылка: {entity.url}")
+    urls = _extract_urls(update)
     
     # Если ссылок нет, выходим
     if not urls:
@@ -62,40 +873,12 @@ async def check_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
     logger.info(f"Проверяем {len(urls)} ссылок через Google Safe Browsing...")
     
-    # Подготавливаем запрос к Google Safe Browsing API
-    payload = {
-        "client": {
-            "clientId": "telegram-bot-safety-check",
-            "clientVersion": "1.0.0"
-        },
-        "threatInfo": {
-            "threatTypes": [
-                "MALWARE", 
-                "SOCIAL_ENGINEERING", 
-                "UNWANTED_SOFTWARE", 
-                "POTENTIALLY_HARMFUL_APPLICATION"
-            ],
-            "platformTypes": ["ANY_PLATFORM"],
-            "threatEntryTypes": ["URL"],
-            "threatEntries": [{"url": url} for url in urls]
-        }
-    }
-    
     try:
-        # Отправляем запрос к Google Safe Browsing API
-        response = requests.post(
-            f'{GOOGLE_SAFE_BROWSING_URL}?key={GOOGLE_SAFE_BROWSING_API_KEY}',
-            json=payload,
-            timeout=5  # Таймаут 5 секунд
-        )
-        response.raise_for_status()  # Проверяем на ошибки HTTP
-        
-        data = response.json()
-        
+        dangerous_urls = await lookup_urls(urls)
+
         # Анализируем ответ
-        if 'matches' in data and data['matches']:
-            dangerous_urls = [match['threat']['url'] for match in data['matches']]
-            logger.warning(f"Обнаружены опасные ссылки: {dangerous_urls}")
+        if dangerous_urls:
+            logger.warning(f"Обнаружены опасные ссылки: {sorted(dangerous_urls)}")
             
             # Уведомляем пользователя в чате (без реакций)
             warning_msg = "⚠️ *Внимание!* В сообщении обнаружены потенциально опасные ссылки."
@@ -110,7 +893,7 @@ async def check_links(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             # safe_msg = "✅ Все ссылки в сообщении безопасны."
             # await update.message.reply_text(safe_msg, reply_to_message_id=update.message.message_id)
     
-    except requests.exceptions.RequestException as e:
+    except SafeBrowsingError as e:
         logger.error(f"Ошибка при обращении к Google Safe Browsing API: {e}")
     except Exception as e:
         logger.error(f"Неожиданная ошибка при проверке ссылок: {e}")
@@ -141,53 +924,54 @@ async def check_links_simple(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(f"В сообщении найдены ссылки: {urls}")
         # Можно добавить базовую логику проверки по черным спискам и т.д.
 
-# Вспомогательная функция для проверки одной ссылки (синхронная)
-def check_single_url(url: str) -> bool:
+# Вспомогательная функция для проверки одной ссылки (асинхронная)
+async def check_single_url_async(url: str, client: Optional[SafeBrowsingClient] = None) -> bool:
     """
-    Проверяет одну ссылку через Google Safe Browsing API (синхронно).
-    
+    Проверяет одну ссылку через Google Safe Browsing API.
+
     Args:
         url: Ссылка для проверки
-        
+        client: Клиент Safe Browsing (по умолчанию общий клиент бота)
+
     Returns:
-        True если ссылка безопасна, False если опасна или произошла ошибка
+        True если ссылка безопасна, False если опасна
+        (в случае ошибки считаем ссылку безопасной)
     """
     if not GOOGLE_SAFE_BROWSING_API_KEY:
         logger.warning("API ключ не настроен, возвращаем True")
         return True
-    
-    payload = {
-        "client": {
-            "clientId": "telegram-bot-safety-check",
-            "clientVersion": "1.0.0"
-        },
-        "threatInfo": {
-            "threatTypes": [
-                "MALWARE", 
-                "SOCIAL_ENGINEERING", 
-                "UNWANTED_SOFTWARE", 
-                "POTENTIALLY_HARMFUL_APPLICATION"
-            ],
-            "platformTypes": ["ANY_PLATFORM"],
-            "threatEntryTypes": ["URL"],
-            "threatEntries": [{"url": url}]
-        }
-    }
-    
+
+    client = client or get_client()
     try:
-        response = requests.post(
-            f'{GOOGLE_SAFE_BROWSING_URL}?key={GOOGLE_SAFE_BROWSING_API_KEY}',
-            json=payload,
-            timeout=5
-        )
-        response.raise_for_status()
-        
-        data = response.json()
-        return 'matches' not in data or not data['matches']
-    
-    except requests.exceptions.RequestException as e:
+        return url not in await lookup_urls([url], client)
+
+    except SafeBrowsingError as e:
         logger.error(f"Ошибка при проверке ссылки {url}: {e}")
         return True  # В случае ошибки считаем ссылку безопасной
     except Exception as e:
         logger.error(f"Неожиданная ошибка при проверке {url}: {e}")
-        return True
\ No newline at end of file
+        return True
+
+# Синхронная обертка для скриптов вне цикла событий бота
+def check_single_url(url: str) -> bool:
+    """
+    Проверяет одну ссылку через Google Safe Browsing API (синхронно).
+
+    Нельзя вызывать из работающего цикла событий — там используйте
+    check_single_url_async.
+
+    Args:
+        url: Ссылка для проверки
+
+    Returns:
+        True если ссылка безопасна, False если опасна
+    """
+    async def _run() -> bool:
+        # Отдельный клиент: общий пул привязан к циклу событий бота
+        client = SafeBrowsingClient(GOOGLE_SAFE_BROWSING_API_KEY)
+        try:
+            return await check_single_url_async(url, client)
+        finally:
+            await client.close()
+
+    return asyncio.run(_run())
@@ -0,0 +1,289 @@
+# shard.py
+"""
+Горизонтальное масштабирование: фронт и несколько процессов-воркеров.
+
+Фронт (SHARD_WORKERS > 0 или SHARD_WORKER_URLS) получает обновления как
+обычно — polling или webhook, — но сам их не обрабатывает, а пересылает
+воркеру, выбранному консистентным хешем id чата (для обновлений без чата —
+ключа ChatUpdateProcessor.update_key). Все обновления чата, включая заявки
+на вступление, всегда попадают в один воркер и идут в нем по порядку,
+поэтому память разговоров ИИ, диалог /font, пакетные приветствия и лимиты
+чатов остаются локальными. Общие квоты и кеш
+членства воркеры делят через shared_state. Изменения членства (chat_member,
+my_chat_member) рассылаются всем воркерам: выход из клуба должен отменить
+запросы пользователя к ИИ, где бы они ни ждали.
+
+Воркер — тот же main.py с SHARD_ROLE=worker: полный Application без polling
+и webhook, обновления приходят пакетами на POST SHARD_PATH. Локальных воркеров
+фронт запускает сам на портах SHARD_BASE_PORT + i и перезапускает при падении;
+воркеры на других машинах перечисляются в SHARD_WORKER_URLS и запускаются
+там с тем же SHARD_SECRET. При изменении числа воркеров консистентный хеш
+переносит на другие воркеры только около 1/N чатов.
+"""
+
+import os
+import sys
+import time
+import bisect
+import asyncio
+import hashlib
+import logging
+import secrets
+import signal
+from typing import Dict, Hashable, List, Optional
+
+import aiohttp
+from telegram import Update
+
+from processor import ChatUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))  # номер воркера (задает фронт)
+SHARD_PARENT_PID = int(os.getenv('SHARD_PARENT_PID', 0))  # фронт, запустивший воркер на этой машине
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', int(os.getenv('PORT', 8080)) + 1))
+# Один секрет на фронт и всех воркеров; без него фронт создает новый для своих воркеров
+SHARD_SECRET = os.getenv('SHARD_SECRET') or secrets.token_urlsafe(32)
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', 64))  # точек на кольце на воркер — равномерность
+SHARD_BATCH = int(os.getenv('SHARD_BATCH', 100))  # обновлений в одном запросе к воркеру
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', 10000))  # ждущих отправки к одному воркеру
+SHARD_TIMEOUT = float(os.getenv('SHARD_TIMEOUT', 10))  # таймаут запроса к воркеру, сек
+SHARD_DRAIN_TIMEOUT = float(os.getenv('SHARD_DRAIN_TIMEOUT', 10))  # дослать очереди при остановке фронта, сек
+
+SHARD_PATH = '/shard/updates'
+SECRET_HEADER = 'X-Shard-Secret'
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Консистентный хеш: у каждого узла vnodes точек на кольце, ключ достается ближайшей по часовой стрелке."""
+
+    def __init__(self, nodes: List[str], vnodes: int = SHARD_VNODES):
+        if not nodes:
+            raise ValueError("нужен хотя бы один воркер")
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: Hashable) -> str:
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+class WorkerLink:
+    """
+    Очередь обновлений к одному воркеру. Пакеты отправляются по одному, следующий —
+    только после ответа на предыдущий, поэтому воркер получает обновления в том же
+    порядке. Пока воркер недоступен (перезапуск), пакет повторяется с паузой.
+    """
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url.rstrip('/') + SHARD_PATH
+        self.queue: asyncio.Queue = asyncio.Queue(SHARD_QUEUE_SIZE)
+        self.sent = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def put(self, data: dict) -> None:
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # Воркер недоступен слишком долго — не держим остальных воркеров
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"Очередь к воркеру {self.name} переполнена, отброшено обновлений: {self.dropped}")
+
+    async def run(self, session: aiohttp.ClientSession) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < SHARD_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self._deliver(session, batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _deliver(self, session: aiohttp.ClientSession, batch: List[dict]) -> None:
+        delay = 0.5
+        while True:
+            try:
+                async with session.post(self.url, json=batch, headers={SECRET_HEADER: SHARD_SECRET}) as response:
+                    if response.status == 200:
+                        self.sent += len(batch)
+                        self.batches += 1
+                        return
+                    if response.status in (400, 403):
+                        # Повтор не поможет: неверный секрет или данные
+                        self.errors += 1
+                        self.dropped += len(batch)
+                        logger.error(f"Воркер {self.name} отклонил пакет: HTTP {response.status}")
+                        return
+                    raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.errors += 1
+                if self.errors == 1 or delay >= 8:
+                    logger.warning(f"Воркер {self.name} недоступен ({e!r}), повтор через {delay:.1f} сек.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10.0)
+
+
+class ShardRouter:
+    """Раздает обновления воркерам: один чат — один воркер, изменения членства — всем."""
+
+    def __init__(self, workers: Dict[str, str]):
+        self.ring = HashRing(list(workers))
+        self.links = {name: WorkerLink(name, url) for name, url in workers.items()}
+        self.routed = 0
+        self.broadcast = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def worker_for(self, update: Update) -> str:
+        if update.chat_join_request:
+            # Одобрение заявки и new_chat_members того же чата должны попасть в один
+            # воркер: там WelcomeBatcher собирает приветствие и убирает повторы.
+            # Внутри воркера заявки по-прежнему упорядочиваются по пользователю.
+            return self.ring.node_for(update.chat_join_request.chat.id)
+        key = ChatUpdateProcessor.update_key(update)
+        # Обновления без чата и пользователя (опросы и т.п.) порядка не требуют
+        return self.ring.node_for(update.update_id if key is None else key)
+
+    def route(self, update: Update) -> None:
+        data = update.to_dict()
+        if update.chat_member or update.my_chat_member:
+            self.broadcast += 1
+            for link in self.links.values():
+                link.put(data)
+            return
+        self.routed += 1
+        self.links[self.worker_for(update)].put(data)
+
+    async def start(self) -> None:
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=SHARD_TIMEOUT))
+        self._tasks = [asyncio.create_task(link.run(self._session)) for link in self.links.values()]
+
+    async def drain(self, timeout: float = SHARD_DRAIN_TIMEOUT) -> bool:
+        """Ждет, пока воркеры примут все обновления из очередей, включая отправляемые пакеты."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(link.queue.join() for link in self.links.values())), timeout)
+            return True
+        except asyncio.TimeoutError:
+            left = {name: depth for name, depth in self.queue_depths().items() if depth}
+            logger.warning(f"Не дослано воркерам за {timeout:g} сек.: {left or 'пакеты в пути'}")
+            return False
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def queue_depths(self) -> Dict[str, int]:
+        return {name: link.queue.qsize() for name, link in self.links.items()}
+
+    def stats(self) -> Dict[str, float]:
+        links = self.links.values()
+        return {
+            'workers': len(self.links),
+            'routed': self.routed,
+            'broadcast': self.broadcast,
+            'queued': sum(link.queue.qsize() for link in links),
+            'sent': sum(link.sent for link in links),
+            'batches': sum(link.batches for link in links),
+            'errors': sum(link.errors for link in links),
+            'dropped': sum(link.dropped for link in links),
+        }
+
+
+# ========================================
+# ЛОКАЛЬНЫЕ ВОРКЕРЫ
+# ========================================
+def _shard_path(path: str, index: int) -> str:
+    """bot_state.sqlite3 -> bot_state.shard1.sqlite3: у каждого воркера свои файлы состояния."""
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def worker_env(index: int, port: int) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'SHARD_ROLE': 'worker',
+        'SHARD_INDEX': str(index),
+        'SHARD_SECRET': SHARD_SECRET,
+        'SHARD_PARENT_PID': str(os.getpid()),
+        'PORT': str(port),
+        # user_data/chat_data и хранилище артов — по чатам воркера; общие лимиты — в shared_state
+        'PERSISTENCE_PATH': _shard_path(os.getenv('PERSISTENCE_PATH', 'bot_state.sqlite3'), index),
+        'ART_STORE_PATH': _shard_path(os.getenv('ART_STORE_PATH', 'art_store'), index),
+    })
+    return env
+
+
+class WorkerProcess:
+    """Воркер на этой машине: запускается как main.py с SHARD_ROLE=worker и перезапускается при падении."""
+
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.restarts = 0
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._stopping = False
+
+    async def run(self) -> None:
+        while not self._stopping:
+            started = time.monotonic()
+            self._process = await asyncio.create_subprocess_exec(
+                sys.executable, MAIN_PATH, env=worker_env(self.index, self.port)
+            )
+            code = await self._process.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            # Если воркер падает сразу после старта, не перезапускаем его в цикле без паузы
+            delay = 1.0 if time.monotonic() - started > 30 else 5.0
+            logger.error(f"Воркер {self.index} завершился с кодом {code}, перезапуск через {delay:.0f} сек.")
+            await asyncio.sleep(delay)
+
+    def stop(self) -> None:
+        self._stopping = True
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+
+    def kill(self) -> None:
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+
+
+def local_workers(count: int, base_port: int = SHARD_BASE_PORT) -> List[WorkerProcess]:
+    return [WorkerProcess(index, base_port + index) for index in range(count)]
+
+
+async def wait_for_stop() -> None:
+    """
+    Воркер: ждет SIGTERM от фронта или завершения самого фронта (если его убили
+    без очистки, родителем воркера становится init), чтобы остановиться штатно
+    и сохранить состояние.
+    """
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=2)
+        except asyncio.TimeoutError:
+            pass
+        if SHARD_PARENT_PID and os.getppid() != SHARD_PARENT_PID:
+            logger.warning("Фронт завершился — воркер останавливается")
+            return
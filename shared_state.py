@@ -0,0 +1,215 @@
+# shared_state.py
+"""
+Общее состояние процессов бота при шардировании (см. shard.py).
+
+Воркеры обрабатывают разные чаты, но часть ограничений у них общая: квоты
+Gemini (в минуту, в сутки, на пользователя), общий лимит исходящих
+сообщений бота, заявки и /font одного пользователя из разных чатов и кеш
+членства в клубе. Это состояние лежит в одном файле SQLite (WAL), который
+открывают все процессы машины. Каждая операция ограничителя — одна короткая
+транзакция BEGIN IMMEDIATE, поэтому GCRA остается атомарным и между
+процессами; TAT хранится по time.time(), а не по time.monotonic().
+
+Запросы синхронные (десятки микросекунд на локальном файле) и выполняются
+прямо в цикле событий — так же, как и методы RateLimiter, которые их вызывают.
+Поэтому блокировку файла ждем не дольше SHARED_STATE_BUSY_MS: если другой
+воркер держит ее дольше, операция бросает sqlite3.OperationalError, и
+ограничитель (или кеш членства) выполняет ее по своему локальному состоянию.
+Цикл событий так задерживается на миллисекунды, а не на секунды.
+Для нескольких машин SharedState заменяется реализацией с тем же
+интерфейсом поверх сетевого хранилища; остальной код бота не меняется.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+from typing import Hashable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', 'shared_state.sqlite3')
+# Сколько ждать блокировку файла, занятую другим воркером, прежде чем перейти на локальное состояние
+SHARED_STATE_BUSY_MS = int(os.getenv('SHARED_STATE_BUSY_MS', 5))
+# Ограничители (ratelimit.limiters по имени), общие для всех воркеров; лимиты чатов
+# остаются локальными — все обновления чата и так приходят в один воркер
+SHARED_LIMITERS = [name.strip() for name in os.getenv(
+    'SHARED_LIMITERS', 'gemini_minute,gemini_day,gemini_user,outbound_global,join_requests,font'
+).split(',') if name.strip()]
+
+
+def _wall_offset() -> float:
+    # Перевод time.monotonic() текущего процесса во время, общее для всех процессов
+    return time.time() - time.monotonic()
+
+
+def _key(key: Hashable) -> str:
+    return json.dumps(key)
+
+
+class SharedState:
+    """Таблицы limits (ограничитель, ключ -> TAT) и members (пользователь -> член клуба, срок)."""
+
+    def __init__(self, path: str = SHARED_STATE_PATH, busy_ms: int = SHARED_STATE_BUSY_MS):
+        self.path = path
+        self.busy_ms = busy_ms
+        self._db: Optional[sqlite3.Connection] = None
+        self.operations = 0
+        self.busy_seconds = 0.0
+        self.fallbacks = 0
+        self._members = 0  # последнее прочитанное число членов клуба для stats()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None: транзакции открываются явно (BEGIN IMMEDIATE).
+            # Схема создается один раз при запуске (enable) — тут можно подождать дольше
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(
+                "CREATE TABLE IF NOT EXISTS limits ("
+                " name TEXT NOT NULL, key TEXT NOT NULL, tat REAL NOT NULL,"
+                " PRIMARY KEY (name, key)) WITHOUT ROWID;"
+                "CREATE TABLE IF NOT EXISTS members ("
+                " user_id INTEGER PRIMARY KEY, is_member INTEGER NOT NULL, expires REAL NOT NULL) WITHOUT ROWID;"
+            )
+            db.execute(f"PRAGMA busy_timeout = {int(self.busy_ms)}")
+            self._db = db
+        return self._db
+
+    def fallback(self, error: sqlite3.Error) -> None:
+        """Учитывает операцию, выполненную по локальному состоянию, потому что файл занят."""
+        self.fallbacks += 1
+        if self.fallbacks == 1 or self.fallbacks % 1000 == 0:
+            logger.warning(f"Общее состояние недоступно ({error}), локальных операций: {self.fallbacks}")
+
+    def _tat(self, db: sqlite3.Connection, name: str, key: str) -> Optional[float]:
+        row = db.execute("SELECT tat FROM limits WHERE name = ? AND key = ?", (name, key)).fetchone()
+        return row[0] if row else None
+
+    def _update(self, name: str, key: Hashable, change) -> object:
+        """Чтение и запись TAT одной транзакцией: change(tat или None) -> (новый TAT или None, результат)."""
+        started = time.perf_counter()
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            new_tat, result = change(self._tat(db, name, _key(key)))
+            if new_tat is not None:
+                db.execute("INSERT OR REPLACE INTO limits VALUES (?, ?, ?)", (name, _key(key), new_tat))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self.operations += 1
+        self.busy_seconds += time.perf_counter() - started
+        return result
+
+    # --- ограничители (вызываются из RateLimiter, если limiter.shared задан) ---
+
+    def retry_after(self, limiter, key: Hashable, now: float) -> float:
+        wall = now + _wall_offset()
+        tat = self._tat(self._connect(), limiter.name, _key(key))
+        self.operations += 1
+        return max(0.0, (wall if tat is None else tat) - limiter.tolerance - wall)
+
+    def try_acquire(self, limiter, key: Hashable, now: float) -> bool:
+        wall = now + _wall_offset()
+
+        def change(tat):
+            tat = wall if tat is None else max(tat, wall)
+            if tat - wall > limiter.tolerance:
+                return None, False
+            return tat + limiter.emission, True
+
+        return self._update(limiter.name, key, change)
+
+    def defer(self, limiter, key: Hashable, seconds: float, now: float) -> None:
+        wall = now + _wall_offset()
+        self._update(limiter.name, key, lambda tat: (
+            max(wall if tat is None else tat, wall + seconds + limiter.tolerance), None
+        ))
+
+    def refund(self, limiter, key: Hashable, now: float) -> None:
+        self._update(limiter.name, key, lambda tat: (None if tat is None else tat - limiter.emission, None))
+
+    def sweep(self, limiter, now: float) -> int:
+        cursor = self._connect().execute(
+            "DELETE FROM limits WHERE name = ? AND tat <= ?", (limiter.name, now + _wall_offset())
+        )
+        return cursor.rowcount
+
+    def count(self, limiter) -> int:
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM limits WHERE name = ? AND tat > ?", (limiter.name, time.time())
+        ).fetchone()[0]
+
+    # --- кеш членства (ai.MembershipCache, если membership_cache.shared задан) ---
+
+    def get_member(self, user_id: int) -> Optional[bool]:
+        row = self._connect().execute(
+            "SELECT is_member FROM members WHERE user_id = ? AND expires > ?", (user_id, time.time())
+        ).fetchone()
+        self.operations += 1
+        return None if row is None else bool(row[0])
+
+    def set_member(self, user_id: int, is_member: bool, ttl: float) -> None:
+        self._connect().execute(
+            "INSERT OR REPLACE INTO members VALUES (?, ?, ?)", (user_id, int(is_member), time.time() + ttl)
+        )
+        self.operations += 1
+
+    def invalidate_members(self, user_id: Optional[int] = None) -> None:
+        if user_id is None:
+            self._connect().execute("DELETE FROM members")
+        else:
+            self._connect().execute("DELETE FROM members WHERE user_id = ?", (user_id,))
+        self.operations += 1
+
+    def count_members(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM members WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        # Сбор метрик не должен падать, пока другой воркер держит запись: отдаем прошлое значение
+        try:
+            self._members = self.count_members()
+        except sqlite3.OperationalError as e:
+            logger.debug(f"Число членов клуба не прочитано: {e}")
+        return {
+            'operations': self.operations,
+            'write_seconds': self.busy_seconds,
+            'fallbacks': self.fallbacks,
+            'members': self._members,
+        }
+
+
+def enable(path: str = SHARED_STATE_PATH, names: Iterable[str] = SHARED_LIMITERS) -> SharedState:
+    """
+    Переводит ограничители names и кеш членства на общее состояние.
+
+    Вызывается в воркере после импорта модулей бота (ограничители создаются при импорте).
+    """
+    import ratelimit
+    from ai import membership_cache
+
+    state = SharedState(path)
+    state._connect()  # схема и WAL — до приема обновлений
+    shared = []
+    for name in names:
+        limiter = ratelimit.limiters.get(name)
+        if limiter is None:
+            logger.warning(f"Ограничитель {name} из SHARED_LIMITERS не найден")
+            continue
+        limiter.shared = state
+        shared.append(name)
+    membership_cache.shared = state
+    logger.info(f"✅ Общее состояние воркеров: {path} (ограничители: {', '.join(shared)})")
+    return state
@@ -0,0 +1,61 @@
+# startup.py
+"""
+Профиль холодного старта: сколько заняла каждая фаза запуска (импорты
+модулей бота, сборка Application, initialize, старт HTTP сервера и
+polling/webhook) и через сколько после старта процесса обработано первое
+обновление. Отчет пишется в лог, а фазы экспортируются в /metrics.
+Бенчмарк: python -m bench.startup
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Отсчет от импорта этого модуля — main.py импортирует его первым
+STARTED = time.perf_counter()
+
+phases: Dict[str, float] = {}  # фаза -> секунды, в порядке выполнения
+ready_at: Optional[float] = None  # бот начал принимать обновления (с начала старта, сек)
+first_update_at: Optional[float] = None  # первое обновление обработано
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - started
+
+
+def mark_ready() -> None:
+    global ready_at
+    if ready_at is None:
+        ready_at = time.perf_counter() - STARTED
+        report()
+
+
+def mark_first_update() -> None:
+    global first_update_at
+    if first_update_at is None:
+        first_update_at = time.perf_counter() - STARTED
+        logger.info(f"⏱ Первое обновление обработано через {first_update_at:.3f} сек. после старта")
+
+
+def report() -> None:
+    lines = [f"  {name:<28} {seconds * 1000:8.1f} мс" for name, seconds in phases.items()]
+    logger.info("⏱ Профиль запуска:\n" + "\n".join(lines) + f"\n  {'готов принимать обновления':<28} "
+                f"{(ready_at or 0.0) * 1000:8.1f} мс")
+
+
+def stats() -> Dict[str, float]:
+    """Секунды по фазам плюс ready и first_update (с начала старта)."""
+    result = dict(phases)
+    if ready_at is not None:
+        result['ready'] = ready_at
+    if first_update_at is not None:
+        result['first_update'] = first_update_at
+    return result
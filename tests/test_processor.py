@@ -0,0 +1,72 @@
+# tests/test_processor.py
+import asyncio
+import datetime
+import random
+
+from telegram import Chat, Message, Update
+
+from processor import ChatUpdateProcessor
+
+
+def _update(update_id, chat_id):
+    message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), Chat(chat_id, 'group'), text='x')
+    return Update(update_id, message=message)
+
+
+def test_updates_of_one_chat_keep_their_order():
+    async def run():
+        processor = ChatUpdateProcessor(max_concurrent_updates=4)
+        rng = random.Random(1)
+        done = {chat_id: [] for chat_id in range(3)}
+        running = 0
+        peak = 0
+
+        async def handle(update_id, chat_id):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            # Случайные задержки: без замка чата поздние обновления обгоняли бы ранние
+            await asyncio.sleep(rng.random() / 100)
+            done[chat_id].append(update_id)
+            running -= 1
+
+        tasks = []
+        for update_id in range(60):
+            chat_id = update_id % 3
+            update = _update(update_id, chat_id)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update_id, chat_id))))
+        await asyncio.gather(*tasks)
+        return processor, done, peak
+
+    processor, done, peak = asyncio.run(run())
+    for chat_id, ids in done.items():
+        assert ids == list(range(chat_id, 60, 3))
+    # Разные чаты шли одновременно, но не больше, чем по одному обновлению на чат
+    assert peak == 3
+    assert processor.processed == 60
+    assert processor.depths() == {}
+
+
+def test_concurrency_limit_across_chats():
+    async def run():
+        processor = ChatUpdateProcessor(max_concurrent_updates=2)
+        running = 0
+        peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(_update(i, i), handle()) for i in range(10)))
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+
+def test_update_key():
+    assert ChatUpdateProcessor.update_key(_update(1, -100)) == -100
+    assert ChatUpdateProcessor.update_key(Update(2)) is None
+    assert ChatUpdateProcessor.update_key(object()) is None
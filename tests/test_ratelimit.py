@@ -0,0 +1,71 @@
+# tests/test_ratelimit.py
+import pytest
+
+from ratelimit import RateLimiter
+from shared_state import SharedState
+
+
+def test_burst_then_steady_rate():
+    limiter = RateLimiter(max_requests=6, period=60, burst=3, name='test_burst')
+    assert [limiter.try_acquire('a', now=0.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.retry_after('a', now=0.0) == pytest.approx(10.0)
+    assert not limiter.try_acquire('a', now=9.9)
+    assert limiter.try_acquire('a', now=10.0)
+    # Ключи независимы
+    assert limiter.try_acquire('b', now=0.0)
+
+
+def test_idle_key_starts_fresh():
+    limiter = RateLimiter(max_requests=2, period=10, name='test_idle')
+    assert limiter.try_acquire('a', now=0.0) and limiter.try_acquire('a', now=0.0)
+    assert not limiter.try_acquire('a', now=0.0)
+    assert [limiter.try_acquire('a', now=100.0) for _ in range(3)] == [True, True, False]
+
+
+def test_defer_blocks_key():
+    limiter = RateLimiter(max_requests=10, period=10, name='test_defer')
+    limiter.defer('a', 30, now=0.0)
+    assert not limiter.try_acquire('a', now=29.0)
+    assert limiter.retry_after('a', now=0.0) == pytest.approx(30.0)
+    assert limiter.try_acquire('a', now=30.0)
+    # Отсрочка не сокращает уже назначенное ожидание
+    limiter.defer('a', 1, now=30.0)
+    assert limiter.retry_after('a', now=30.0) == pytest.approx(1.0)
+
+
+def test_refund_returns_slot():
+    limiter = RateLimiter(max_requests=1, period=10, name='test_refund')
+    assert limiter.try_acquire('a', now=0.0)
+    assert not limiter.try_acquire('a', now=0.0)
+    limiter.refund('a', now=0.0)
+    assert limiter.try_acquire('a', now=0.0)
+
+
+def test_sweep_removes_only_idle_keys():
+    limiter = RateLimiter(max_requests=1, period=10, name='test_sweep')
+    limiter.try_acquire('old', now=0.0)
+    limiter.try_acquire('new', now=5.0)
+    assert len(limiter) == 2
+    assert limiter.sweep(now=10.0) == 1
+    assert len(limiter) == 1
+    assert not limiter.try_acquire('new', now=10.0)
+    assert limiter.sweep(now=15.0) == 1
+    assert len(limiter) == 0
+
+
+def test_shared_state_is_common_to_limiters(tmp_path):
+    state = SharedState(str(tmp_path / 'shared.sqlite3'))
+    first = RateLimiter(max_requests=2, period=10, name='test_shared')
+    second = RateLimiter(max_requests=2, period=10, name='test_shared')
+    first.shared = second.shared = state
+    try:
+        assert first.try_acquire('a', now=0.0)
+        assert second.try_acquire('a', now=0.0)
+        assert not first.try_acquire('a', now=0.0)
+        second.refund('a', now=0.0)
+        assert first.try_acquire('a', now=0.0)
+        first.defer('b', 20, now=0.0)
+        assert not second.try_acquire('b', now=19.0)
+        assert second.sweep(now=40.0) == 2
+    finally:
+        state.close()
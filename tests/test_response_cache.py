@@ -0,0 +1,37 @@
+# tests/test_response_cache.py
+import pytest
+
+from ai import ConversationMemory, ResponseCache, _normalize_prompt
+
+
+@pytest.mark.parametrize('first, second', [
+    ('2+2', '2-2'),
+    ('2+2', '2*2'),
+    ('c++', 'c#'),
+    ('що таке c++?', 'що таке c#?'),
+])
+def test_different_questions_do_not_share_a_key(first, second):
+    assert _normalize_prompt(first) != _normalize_prompt(second)
+
+
+@pytest.mark.parametrize('first, second', [
+    ('Що таке Python?', 'що   таке python'),
+    ('привіт!!!', 'Привіт'),
+    ('ＡＢＣ...', 'abc'),
+])
+def test_equivalent_questions_share_a_key(first, second):
+    assert _normalize_prompt(first) == _normalize_prompt(second)
+
+
+def test_history_is_part_of_the_key():
+    memory = ConversationMemory()
+    cache = ResponseCache(path='')
+    assert memory.digest(1) is None
+    memory.append(1, 'розкажи про python', 'це мова програмування')
+    memory.append(2, 'розкажи про rust', 'це теж мова програмування')
+
+    first, second = memory.digest(1), memory.digest(2)
+    assert first and second and first != second
+    assert cache.key('а чому?', first) != cache.key('а чому?', second)
+    assert cache.key('а чому?', first) != cache.key('а чому?')
+    assert cache.key('а чому?', first) == cache.key('а чому', memory.digest(1))
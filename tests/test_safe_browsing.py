@@ -0,0 +1,102 @@
+# tests/test_safe_browsing.py
+import hashlib
+
+import pytest
+
+from safe import HashPrefixSet, canonicalize_url, url_expressions
+
+
+# Примеры из раздела "URLs and Hashing" документации Safe Browsing v4
+@pytest.mark.parametrize('url, canonical', [
+    ('http://host/%25%32%35', 'http://host/%25'),
+    ('http://host/%25%32%35%25%32%35', 'http://host/%25%25'),
+    ('http://host/%2525252525252525', 'http://host/%25'),
+    ('http://host/asdf%25%32%35asd', 'http://host/asdf%25asd'),
+    ('http://host/%%%25%32%35asd%%', 'http://host/%25%25%25asd%25%25'),
+    ('http://www.google.com/', 'http://www.google.com/'),
+    ('http://%31%36%38%2e%31%38%38%2e%39%39%2e%32%36/%2E%73%65%63%75%72%65/%77%77%77%2E%65%62%61%79%2E%63%6F%6D/',
+     'http://168.188.99.26/.secure/www.ebay.com/'),
+    ('http://host%23.com/%257Ea%2521b%2540c%2523d%2524e%25f%255E00%252611%252A22%252833%252944_55%252B',
+     'http://host%23.com/~a!b@c%23d$e%25f^00&11*22(33)44_55+'),
+    ('http://3279880203/blah', 'http://195.127.0.11/blah'),
+    ('http://www.google.com/blah/..', 'http://www.google.com/'),
+    ('www.google.com/', 'http://www.google.com/'),
+    ('www.google.com', 'http://www.google.com/'),
+    ('http://www.evil.com/blah#frag', 'http://www.evil.com/blah'),
+    ('http://www.GOOgle.com/', 'http://www.google.com/'),
+    ('http://www.google.com.../', 'http://www.google.com/'),
+    ('http://www.google.com/foo\tbar\rbaz\n2', 'http://www.google.com/foobarbaz2'),
+    ('http://www.google.com/q?', 'http://www.google.com/q?'),
+    ('http://www.google.com/q?r?', 'http://www.google.com/q?r?'),
+    ('http://www.google.com/q?r?s', 'http://www.google.com/q?r?s'),
+    ('http://evil.com/foo#bar#baz', 'http://evil.com/foo'),
+    ('http://evil.com/foo;', 'http://evil.com/foo;'),
+    ('http://evil.com/foo?bar;', 'http://evil.com/foo?bar;'),
+    ('http://notrailingslash.com', 'http://notrailingslash.com/'),
+    ('  http://www.google.com/  ', 'http://www.google.com/'),
+    ('http://%20leadingspace.com/', 'http://%20leadingspace.com/'),
+    ('%20leadingspace.com/', 'http://%20leadingspace.com/'),
+    ('https://www.securesite.com/', 'https://www.securesite.com/'),
+    ('http://host.com/ab%23cd', 'http://host.com/ab%23cd'),
+    ('http://host.com//twoslashes?more//slashes', 'http://host.com/twoslashes?more//slashes'),
+])
+def test_canonicalize_url(url, canonical):
+    assert canonicalize_url(url) == canonical
+
+
+def test_default_port_is_dropped():
+    assert canonicalize_url('http://example.com:80/a') == 'http://example.com/a'
+    assert canonicalize_url('https://example.com:443/a') == 'https://example.com/a'
+
+
+def test_expressions_with_query():
+    assert sorted(url_expressions('http://a.b.c/1/2.html?param=1')) == sorted([
+        'a.b.c/1/2.html?param=1', 'a.b.c/1/2.html', 'a.b.c/', 'a.b.c/1/',
+        'b.c/1/2.html?param=1', 'b.c/1/2.html', 'b.c/', 'b.c/1/',
+    ])
+
+
+def test_expressions_limit_host_suffixes():
+    assert sorted(url_expressions('http://a.b.c.d.e.f.g/1.html')) == sorted([
+        'a.b.c.d.e.f.g/1.html', 'a.b.c.d.e.f.g/',
+        'c.d.e.f.g/1.html', 'c.d.e.f.g/',
+        'd.e.f.g/1.html', 'd.e.f.g/',
+        'e.f.g/1.html', 'e.f.g/',
+        'f.g/1.html', 'f.g/',
+    ])
+
+
+def test_expressions_keep_ip_host_whole():
+    assert sorted(url_expressions('http://1.2.3.4/1/')) == ['1.2.3.4/', '1.2.3.4/1/']
+
+
+def _sha(text):
+    return hashlib.sha256(text.encode()).digest()
+
+
+def test_prefix_set_matches_only_stored_prefixes():
+    stored = [_sha(f'evil{i}.com/')[:4] for i in range(1000)] + [_sha('long.com/')[:8], _sha('full.com/')]
+    prefixes = HashPrefixSet(stored)
+    assert len(prefixes) == 1002
+
+    assert prefixes.match(_sha('evil7.com/')) == _sha('evil7.com/')[:4]
+    assert prefixes.match(_sha('long.com/')) == _sha('long.com/')[:8]
+    assert prefixes.match(_sha('full.com/')) == _sha('full.com/')
+    assert prefixes.match(_sha('good.com/')) is None
+    assert HashPrefixSet().match(_sha('evil7.com/')) is None
+
+
+def test_prefix_set_update_and_checksum():
+    stored = sorted({_sha(str(i))[:4] for i in range(10)})
+    prefixes = HashPrefixSet(stored)
+    assert list(prefixes.sorted_prefixes()) == stored
+
+    added = _sha('added')[:4]
+    updated, checksum = prefixes.apply_update([added], [0, 3])
+    expected = sorted([p for i, p in enumerate(stored) if i not in (0, 3)] + [added])
+    assert list(updated.sorted_prefixes()) == expected
+    assert checksum == hashlib.sha256(b''.join(expected)).digest()
+    assert updated.match(_sha('added')) == added
+    assert updated.match(stored[0] + bytes(28)) is None
+    # Исходное множество не меняется
+    assert prefixes.match(stored[0] + bytes(28)) == stored[0]
@@ -0,0 +1,42 @@
+# tests/test_shard.py
+import datetime
+from collections import Counter
+
+from telegram import Chat, ChatJoinRequest, Message, Update, User
+
+from shard import HashRing, ShardRouter
+
+
+def _nodes(count):
+    return [f"worker-{i}" for i in range(count)]
+
+
+def test_ring_is_deterministic():
+    first, second = HashRing(_nodes(4)), HashRing(list(reversed(_nodes(4))))
+    assert all(first.node_for(chat) == second.node_for(chat) for chat in range(-5000, 5000))
+
+
+def test_ring_is_balanced():
+    ring = HashRing(_nodes(4))
+    counts = Counter(ring.node_for(chat) for chat in range(20000))
+    assert set(counts) == set(_nodes(4))
+    assert max(counts.values()) < 2 * min(counts.values())
+
+
+def test_adding_a_worker_moves_only_its_share():
+    before, after = HashRing(_nodes(4)), HashRing(_nodes(5))
+    moved = [chat for chat in range(20000) if before.node_for(chat) != after.node_for(chat)]
+    # Переезжают только на новый воркер и примерно 1/5 чатов
+    assert all(after.node_for(chat) == 'worker-4' for chat in moved)
+    assert 0.1 < len(moved) / 20000 < 0.3
+
+
+def test_join_request_goes_with_its_chat():
+    router = ShardRouter({name: f"http://{name}" for name in _nodes(4)})
+    now = datetime.datetime.now(datetime.timezone.utc)
+    chat = Chat(-1001, 'supergroup')
+    for user_id in range(50):
+        user = User(user_id, 'user', False)
+        join = Update(user_id, chat_join_request=ChatJoinRequest(chat, user, now, user_chat_id=user_id))
+        message = Update(1000 + user_id, message=Message(user_id, now, chat, from_user=user, text='x'))
+        assert router.worker_for(join) == router.worker_for(message) == router.ring.node_for(chat.id)
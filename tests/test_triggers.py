@@ -0,0 +1,48 @@
+# tests/test_triggers.py
+import random
+
+import pytest
+
+from triggers import AhoCorasick, SubstringMatcher, Trigger, TriggerEngine
+
+
+def _brute_force(patterns, text):
+    return sorted(
+        (start + len(pattern) - 1, index)
+        for index, pattern in enumerate(patterns)
+        for start in range(len(text) - len(pattern) + 1)
+        if text.startswith(pattern, start)
+    )
+
+
+@pytest.mark.parametrize('matcher', [AhoCorasick, SubstringMatcher])
+def test_matchers_find_every_occurrence(matcher):
+    rng = random.Random(1)
+    for _ in range(200):
+        # Маленький алфавит — много пересечений и вложенных фраз
+        patterns = list({''.join(rng.choice('абв') for _ in range(rng.randint(1, 4))) for _ in range(8)})
+        text = ''.join(rng.choice('абвг') for _ in range(rng.randint(0, 40)))
+        assert sorted(matcher(patterns).find(text)) == _brute_force(patterns, text)
+
+
+def test_overlapping_patterns():
+    automaton = AhoCorasick(['he', 'she', 'his', 'hers'])
+    assert sorted(automaton.find('ushers')) == [(3, 0), (3, 1), (5, 3)]
+
+
+TRIGGERS = [
+    Trigger('ало', 'ai'),
+    Trigger('кот', 'reply', whole_word=True, text='мяу'),
+    Trigger('правила', 'reply', chat_id=-1, text='/rules'),
+    Trigger('Правила', 'reply', chat_id=-1, text='/rules'),
+]
+
+
+@pytest.mark.parametrize('automaton_min', [1, 64])
+def test_engine_matches_the_same_with_either_matcher(automaton_min):
+    engine = TriggerEngine(TRIGGERS, automaton_min=automaton_min)
+    assert engine.match('Мало ли') == [TRIGGERS[0]]
+    assert engine.match('котлета') == []
+    assert engine.match('мой кот, ало!') == [TRIGGERS[1], TRIGGERS[0]]
+    assert engine.match('где ПРАВИЛА?', chat_id=-1) == [TRIGGERS[2]]
+    assert engine.match('где правила?', chat_id=-2) == []
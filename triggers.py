@@ -0,0 +1,259 @@
+# triggers.py
+"""
+Триггеры групповых сообщений: все ключевые слова и фразы всех чатов
+собраны в один автомат Ахо — Корасик, и каждое сообщение проходится
+один раз, сколько бы триггеров ни было настроено. Пока фраз меньше
+TRIGGERS_AUTOMATON_MIN (обычный случай — одно "ало"), автомат не строится:
+поиск подстрок str.find на C быстрее прохода автомата на Python.
+
+Триггеры берутся из JSON-файла TRIGGERS_PATH (если он есть), иначе из
+DEFAULT_TRIGGERS. Формат — список объектов:
+
+    {"phrase": "ало", "action": "ai"}
+    {"phrase": "правила", "action": "reply", "text": "...", "chat_id": -100123, "whole_word": true}
+
+Действия (action) регистрируются через register_action (встроено "reply" —
+ответить текстом text); обработчик handle_triggers вызывает их для совпавших
+триггеров.
+Бенчмарк: python -m bench.triggers
+"""
+
+import os
+import json
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from telegram import Message, Update
+from telegram.ext import ContextTypes, filters
+
+import outbound
+
+logger = logging.getLogger(__name__)
+
+TRIGGERS_PATH = os.getenv('TRIGGERS_PATH', 'triggers.json')
+TRIGGERS_AUTOMATON_MIN = int(os.getenv('TRIGGERS_AUTOMATON_MIN', 64))  # с какого числа фраз строить автомат
+
+DEFAULT_TRIGGERS = [
+    {'phrase': 'ало', 'action': 'ai'},
+]
+
+Action = Callable[[Update, ContextTypes.DEFAULT_TYPE, 'Trigger'], Awaitable[None]]
+
+
+class Trigger(NamedTuple):
+    phrase: str
+    action: str
+    chat_id: Optional[int] = None  # None — во всех чатах
+    whole_word: bool = False  # иначе совпадает и как часть слова ("ало" в "мало")
+    text: Optional[str] = None  # параметр действия, например текст ответа
+
+
+class AhoCorasick:
+    """
+    Автомат Ахо — Корасик по строкам в нижнем регистре (casefold).
+
+    Переходы хранятся словарями по символам, выходы каждого состояния уже
+    включают выходы по суффиксным ссылкам, поэтому поиск — один проход по
+    тексту без возвратов.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        for index, pattern in enumerate(patterns):
+            self._insert(pattern, index)
+        self._link()
+
+    def _insert(self, pattern: str, index: int) -> None:
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (index,)
+
+    def _link(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] += self._out[self._fail[child]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Пары (индекс последнего символа совпадения, номер шаблона) в text (уже casefold)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                for index in out[state]:
+                    yield position, index
+
+
+class SubstringMatcher:
+    """Тот же интерфейс, что у AhoCorasick, для нескольких фраз: str.find по каждой."""
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+
+    def find(self, text: str) -> Iterator[Tuple[int, int]]:
+        hits = []
+        for index, pattern in enumerate(self.patterns):
+            start = text.find(pattern)
+            while start >= 0:
+                hits.append((start + len(pattern) - 1, index))
+                start = text.find(pattern, start + 1)
+        hits.sort()
+        return iter(hits)
+
+
+def _is_word_boundary(text: str, start: int, end: int) -> bool:
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+class TriggerEngine:
+    """Набор триггеров и автомат по их фразам (перестраивается лениво после изменений)."""
+
+    def __init__(self, triggers: Optional[List[Trigger]] = None, automaton_min: int = TRIGGERS_AUTOMATON_MIN):
+        self._triggers: List[Trigger] = list(triggers or [])
+        self.automaton_min = automaton_min
+        self._automaton = None  # AhoCorasick или SubstringMatcher
+        self._owners: List[List[int]] = []  # номер шаблона -> номера триггеров с этой фразой
+        self.messages = 0
+        self.matches = 0
+
+    def add(self, trigger: Trigger) -> None:
+        self._triggers.append(trigger)
+        self._automaton = None
+
+    def clear(self) -> None:
+        self._triggers.clear()
+        self._automaton = None
+
+    def __len__(self) -> int:
+        return len(self._triggers)
+
+    def _compile(self):
+        phrases: Dict[str, int] = {}
+        self._owners = []
+        for number, trigger in enumerate(self._triggers):
+            phrase = trigger.phrase.casefold()
+            if not phrase:
+                continue
+            if phrase not in phrases:
+                phrases[phrase] = len(phrases)
+                self._owners.append([])
+            self._owners[phrases[phrase]].append(number)
+        matcher = AhoCorasick if len(phrases) >= self.automaton_min else SubstringMatcher
+        self._automaton = matcher(list(phrases))
+        return self._automaton
+
+    def match(self, text: str, chat_id: Optional[int] = None) -> List[Trigger]:
+        """Триггеры чата, совпавшие с text, в порядке первого появления; каждое действие — один раз."""
+        automaton = self._automaton or self._compile()
+        folded = text.casefold()
+        self.messages += 1
+        found: List[Trigger] = []
+        seen = set()
+        for end, index in automaton.find(folded):
+            for number in self._owners[index]:
+                trigger = self._triggers[number]
+                if trigger.chat_id is not None and trigger.chat_id != chat_id:
+                    continue
+                key = (trigger.action, trigger.text)
+                if key in seen:
+                    continue
+                if trigger.whole_word:
+                    start = end - len(automaton.patterns[index]) + 1
+                    if not _is_word_boundary(folded, start, end + 1):
+                        continue
+                seen.add(key)
+                found.append(trigger)
+        self.matches += bool(found)
+        return found
+
+    def load(self, path: str = TRIGGERS_PATH) -> None:
+        """Загружает триггеры из JSON-файла; если его нет — DEFAULT_TRIGGERS."""
+        entries = DEFAULT_TRIGGERS
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    entries = json.load(file)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка загрузки триггеров из {path}: {e}")
+        self.clear()
+        for entry in entries:
+            try:
+                self.add(Trigger(**entry))
+            except TypeError as e:
+                logger.error(f"Некорректный триггер {entry}: {e}")
+        logger.info(f"✅ Загружено триггеров: {len(self)}")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'triggers': len(self._triggers),
+            'messages': self.messages,
+            'matched_messages': self.matches,
+        }
+
+
+trigger_engine = TriggerEngine(Trigger(**entry) for entry in DEFAULT_TRIGGERS)
+_actions: Dict[str, Action] = {}
+
+
+def register_action(name: str, action: Action) -> None:
+    _actions[name] = action
+
+
+async def _reply_action(update: Update, context: ContextTypes.DEFAULT_TYPE, trigger: Trigger) -> None:
+    if trigger.text:
+        await outbound.reply_text(update.message, trigger.text)
+
+
+register_action('reply', _reply_action)
+
+
+class TriggerFilter(filters.MessageFilter):
+    """
+    Фильтр-данные для MessageHandler: пропускает сообщение, если совпал хотя бы
+    один триггер, и кладет совпавшие в context.triggers (как Regex — в context.matches).
+    """
+
+    __slots__ = ('engine',)
+
+    def __init__(self, engine: TriggerEngine = trigger_engine):
+        super().__init__(name='TriggerFilter', data_filter=True)
+        self.engine = engine
+
+    def filter(self, message: Message) -> Optional[Dict[str, List[Trigger]]]:
+        text = message.text or message.caption
+        if not text:
+            return None
+        found = self.engine.match(text, message.chat_id)
+        return {'triggers': found} if found else None
+
+
+async def handle_triggers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выполняет действия совпавших триггеров по порядку."""
+    for trigger in getattr(context, 'triggers', ()):
+        action = _actions.get(trigger.action)
+        if action is None:
+            logger.warning(f"Неизвестное действие триггера: {trigger.action}")
+            continue
+        await action(update, context, trigger)
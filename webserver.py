@@ -0,0 +1,112 @@
+# webserver.py
+"""
+HTTP сервер бота на aiohttp в том же цикле событий, что и Application.
+
+Всегда отдает health checks для Koyeb (/ и /health) и метрики (/metrics), а в режиме webhook
+еще и принимает обновления от Telegram на WEBHOOK_PATH — без отдельного
+потока, WSGI и задержки long polling. У воркера (shard.py) вместо этого —
+прием пакетов обновлений от фронта на shard.SHARD_PATH.
+"""
+
+import os
+import hmac
+import json
+import logging
+import secrets
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+import shard
+from config import WEBHOOK_URL
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv('PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Если секрет не задан, генерируем новый при каждом запуске — set_webhook все равно вызывается заново
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+APPLICATION_KEY = web.AppKey('application', Application)
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="✅ Бот работает")
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Принимает обновление от Telegram и сразу отвечает 200, обработка идет через update_queue."""
+    received = request.headers.get(SECRET_HEADER, '')
+    if not hmac.compare_digest(received.encode(), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+
+    application = request.app[APPLICATION_KEY]
+    try:
+        data = json.loads(await request.read())
+        update = Update.de_json(data, application.bot)
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Некорректное обновление от Telegram: {e}")
+        return web.Response(status=400)
+
+    await application.update_queue.put(update)
+    return web.Response()
+
+
+async def shard_updates(request: web.Request) -> web.Response:
+    """Пакет обновлений от фронта: в update_queue в том же порядке, в каком их получил фронт."""
+    received = request.headers.get(shard.SECRET_HEADER, '')
+    if not hmac.compare_digest(received.encode(), shard.SHARD_SECRET.encode()):
+        return web.Response(status=403)
+
+    application = request.app[APPLICATION_KEY]
+    try:
+        updates = [Update.de_json(data, application.bot) for data in json.loads(await request.read())]
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Некорректный пакет обновлений от фронта: {e}")
+        return web.Response(status=400)
+
+    for update in updates:
+        await application.update_queue.put(update)
+    return web.Response()
+
+
+def build_web_app(application: Application, webhook: bool, shard_worker: bool = False) -> web.Application:
+    app = web.Application()
+    app[APPLICATION_KEY] = application
+    app.router.add_get('/', health)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_endpoint)
+    if webhook:
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    if shard_worker:
+        app.router.add_post(shard.SHARD_PATH, shard_updates)
+    return app
+
+
+async def start_web_server(application: Application, webhook: bool, port: int = PORT,
+                           shard_worker: bool = False) -> web.AppRunner:
+    """Запускает HTTP сервер в текущем цикле событий."""
+    runner = web.AppRunner(build_web_app(application, webhook, shard_worker), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info(f"✅ HTTP сервер запущен на порту {port}")
+    return runner
+
+
+async def set_webhook(application: Application, url: Optional[str] = WEBHOOK_URL) -> None:
+    """Регистрирует webhook в Telegram (старые обновления сбрасываются, как и в режиме polling)."""
+    await application.bot.set_webhook(
+        url=url.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True
+    )
+    logger.info(f"✅ Webhook установлен: {url.rstrip('/')}{WEBHOOK_PATH}")